@@ -0,0 +1,222 @@
+"""
+التحكم في القبول - Admission Control
+حدود معدل لكل عميل عبر دلاء الرموز (token buckets) بأوزان لكل مسار، وحد تزامن عام للمسارات المكلفة
+"""
+
+import asyncio
+import os
+import re
+import threading
+import time
+import logging
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import orjson
+
+from auth_service import AuthService
+
+logger = logging.getLogger(__name__)
+
+
+class BucketBackend(ABC):
+    """واجهة تخزين الدلاء (داخل العملية أو مشتركة بين العمليات)"""
+
+    @abstractmethod
+    def consume(self, key: str, cost: float, rate: float, capacity: float) -> Tuple[bool, float]:
+        """محاولة استهلاك cost رموز. يُعاد (مسموح؟، ثوانٍ حتى يتوفر ما يكفي)"""
+
+
+class InMemoryBucketBackend(BucketBackend):
+    """دلاء في ذاكرة العملية، محدودة العدد (تُحذف الأقدم استخداماً)"""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, cost: float, rate: float, capacity: float) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = [capacity, now]
+                self._buckets[key] = bucket
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                tokens, last = bucket
+                bucket[0] = min(capacity, tokens + (now - last) * rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return True, 0.0
+            return False, (cost - bucket[0]) / rate
+
+
+class RoutePolicy:
+    """وزن المسار (عدد الرموز المستهلكة) ومجموعة التزامن التي ينتمي إليها"""
+
+    def __init__(self, pattern: str, cost: float = 1.0, methods: Optional[Sequence[str]] = None,
+                 concurrency_group: Optional[str] = None):
+        self.pattern = re.compile(pattern)
+        self.cost = cost
+        self.methods = set(methods) if methods else None
+        self.concurrency_group = concurrency_group
+
+    def matches(self, method: str, path: str) -> bool:
+        return (self.methods is None or method in self.methods) and bool(self.pattern.match(path))
+
+
+# الأوزان: البحث (regex غير مفهرس) واستدعاءات بوابة الدفع وbcrypt أغلى من الطلبات العادية
+ROUTE_POLICIES: List[RoutePolicy] = [
+    RoutePolicy(r"^/api/search/lawyers$", cost=5, concurrency_group="search"),
+    RoutePolicy(r"^/api/payments/(verify|create|refund)$", cost=10, methods=["POST"], concurrency_group="gateway"),
+    RoutePolicy(r"^/api/(lawyer|client)/(dashboard|stats)$", cost=3, concurrency_group="dashboards"),
+    RoutePolicy(r"^/api/auth/(login|register)$", cost=3, methods=["POST"]),
+    RoutePolicy(r"^/api/admin/", cost=2),
+]
+
+# مسارات معفاة: فحص الصحة وإشعارات البوابة
+EXEMPT_PATHS = re.compile(r"^/api/(health|live|ready)|^/api/payments/webhook/")
+
+
+class ConcurrencyLimiter:
+    """حد أقصى للطلبات المتزامنة في مجموعة مسارات، مع انتظار قصير ثم رفض"""
+
+    def __init__(self, limit: int, queue_timeout: float):
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.rejected = 0
+
+    async def acquire(self) -> bool:
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+class AdmissionController:
+    """حالة التحكم في القبول: الدلاء، أوزان المسارات وحدود التزامن"""
+
+    def __init__(self, backend: Optional[BucketBackend] = None, policies: Sequence[RoutePolicy] = ROUTE_POLICIES):
+        self.backend = backend or InMemoryBucketBackend()
+        self.policies = policies
+        self.enabled = os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower() == "true"
+        self.rate = float(os.getenv("ADMISSION_RATE_PER_SECOND", "10"))
+        self.capacity = float(os.getenv("ADMISSION_BURST", "40"))
+        self.trust_forwarded = os.getenv("ADMISSION_TRUST_FORWARDED_FOR", "false").lower() == "true"
+        queue_timeout = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.1"))
+        self.limiters: Dict[str, ConcurrencyLimiter] = {
+            "search": ConcurrencyLimiter(int(os.getenv("ADMISSION_SEARCH_CONCURRENCY", "20")), queue_timeout),
+            "gateway": ConcurrencyLimiter(int(os.getenv("ADMISSION_GATEWAY_CONCURRENCY", "30")), queue_timeout),
+            "dashboards": ConcurrencyLimiter(int(os.getenv("ADMISSION_DASHBOARD_CONCURRENCY", "30")), queue_timeout),
+        }
+        self.rejected_rate = 0
+
+    def client_key(self, scope) -> str:
+        """معرف المستخدم من JWT إن وُجد وإلا عنوان IP"""
+        authorization = _header(scope, b"authorization")
+        if authorization and authorization.lower().startswith("bearer "):
+            try:
+                payload = AuthService.verify_token(authorization[7:])
+                if payload.get("user_id"):
+                    return f"user:{payload['user_id']}"
+            except Exception:
+                pass
+        if self.trust_forwarded:
+            forwarded = _header(scope, b"x-forwarded-for")
+            if forwarded:
+                return f"ip:{forwarded.split(',')[0].strip()}"
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
+
+    def policy_for(self, method: str, path: str) -> Optional[RoutePolicy]:
+        for policy in self.policies:
+            if policy.matches(method, path):
+                return policy
+        return None
+
+    def get_metrics(self) -> Dict[str, object]:
+        return {
+            "rate_limited": self.rejected_rate,
+            "concurrency": {
+                name: {"limit": limiter.limit, "active": limiter.active, "rejected": limiter.rejected}
+                for name, limiter in self.limiters.items()
+            },
+        }
+
+
+class AdmissionControlMiddleware:
+    """
+    يرفض الطلبات الزائدة بـ 429 (تجاوز معدل العميل) أو 503 (المسارات المكلفة مشبعة)
+    قبل وصولها لقاعدة البيانات أو ماي فاتورة.
+    """
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    @staticmethod
+    async def _reject(send, status_code: int, detail: str, retry_after: float):
+        body = orjson.dumps({"detail": detail})
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(max(1, int(retry_after + 0.999))).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller
+        if (not controller.enabled or scope["type"] != "http" or scope["method"] == "OPTIONS"
+                or EXEMPT_PATHS.match(scope["path"])):
+            await self.app(scope, receive, send)
+            return
+
+        policy = controller.policy_for(scope["method"], scope["path"])
+        cost = policy.cost if policy else 1.0
+
+        allowed, retry_after = controller.backend.consume(
+            controller.client_key(scope), cost, controller.rate, controller.capacity
+        )
+        if not allowed:
+            controller.rejected_rate += 1
+            await self._reject(send, 429, "عدد الطلبات كبير جداً، يرجى المحاولة لاحقاً", retry_after)
+            return
+
+        limiter = controller.limiters.get(policy.concurrency_group) if policy and policy.concurrency_group else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not await limiter.acquire():
+            await self._reject(send, 503, "الخدمة مشغولة حالياً، يرجى المحاولة بعد قليل", 1)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,196 @@
+"""
+تحليلات الإدارة - Admin Analytics
+تحميل أعمدة محددة من المواعيد والدفعات والتقييمات على دفعات إلى جداول pandas
+وحساب مؤشرات المنصة بعمليات متجهة، مع تخزين التقرير مؤقتاً لكل نافذة زمنية.
+"""
+
+import os
+import time
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from caching import TTLCache
+from records import DEFAULT_WORKING_HOURS
+
+logger = logging.getLogger(__name__)
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+
+APPOINTMENT_COLUMNS = ("id", "lawyer_id", "specialization", "status", "date", "created_at")
+PAYMENT_COLUMNS = ("appointment_id", "status", "amount", "refund_amount", "created_at")
+REVIEW_COLUMNS = ("lawyer_id", "rating")
+LAWYER_COLUMNS = ("id", "name", "specialization", "working_hours")
+
+
+def _hours(start: str, end: str) -> float:
+    start_h, start_m = map(int, start.split(":"))
+    end_h, end_m = map(int, end.split(":"))
+    return max(0.0, (end_h * 60 + end_m - start_h * 60 - start_m) / 60)
+
+
+def _weekly_hours(working_hours: Optional[Dict[str, Dict[str, Any]]]) -> list:
+    """ساعات العمل المتاحة لكل يوم من أيام الأسبوع (الاثنين أولاً كما في pandas)"""
+    working_hours = working_hours or DEFAULT_WORKING_HOURS
+    hours = []
+    for day in WEEKDAYS:
+        slot = working_hours.get(day) or {}
+        hours.append(_hours(slot["start"], slot["end"]) if slot.get("available") else 0.0)
+    return hours
+
+
+def _ratio(numerator: pd.Series, denominator: pd.Series) -> pd.Series:
+    return (numerator / denominator.replace(0, np.nan)).fillna(0.0).round(4)
+
+
+class PlatformAnalytics:
+    """تقرير المنصة الكامل: التحويل، الإلغاء، الاسترداد، ونسبة إشغال المحامين"""
+
+    def __init__(self, appointments_collection, payments_collection, reviews_collection, lawyers_collection):
+        self.appointments = appointments_collection
+        self.payments = payments_collection
+        self.reviews = reviews_collection
+        self.lawyers = lawyers_collection
+        self.batch_size = int(os.getenv("ANALYTICS_BATCH_SIZE", "5000"))
+        # مدة الموعد بالساعات لحساب الإشغال
+        self.slot_hours = float(os.getenv("ANALYTICS_SLOT_HOURS", "1"))
+        self.cache = TTLCache(ttl=float(os.getenv("ANALYTICS_CACHE_TTL", "300")), max_size=64)
+
+    def _frame(self, collection, criteria: Dict[str, Any], columns: Sequence[str]) -> pd.DataFrame:
+        """تحميل الأعمدة المطلوبة فقط بمؤشر مجمّع، مباشرة إلى قوائم أعمدة"""
+        data: Dict[str, list] = {column: [] for column in columns}
+        projection = {column: 1 for column in columns}
+        projection["_id"] = 0
+        for document in collection.find(criteria, projection, batch_size=self.batch_size):
+            for column in columns:
+                data[column].append(document.get(column))
+        # الإطار الفارغ بأعمدة object (وإلا تصبح float64 وتفشل مقارنتها بالنصوص)
+        return pd.DataFrame(
+            {column: pd.Series(values, dtype=None if values else object) for column, values in data.items()},
+            columns=list(columns),
+        )
+
+    def report(self, since: date, until: date) -> Dict[str, Any]:
+        """تقرير النافذة [since, until) من الذاكرة المؤقتة أو بحسابه"""
+        key = (since, until)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        result = self.compute(since, until)
+        self.cache.set(key, result)
+        return result
+
+    def compute(self, since: date, until: date) -> Dict[str, Any]:
+        started = time.perf_counter()
+        since_dt = datetime.combine(since, datetime.min.time())
+        until_dt = datetime.combine(until, datetime.min.time())
+
+        # المواعيد المحجوزة في النافذة أو المجدولة فيها
+        appointments = self._frame(self.appointments, {"$or": [
+            {"created_at": {"$gte": since_dt, "$lt": until_dt}},
+            {"date": {"$gte": since.isoformat(), "$lt": until.isoformat()}},
+        ]}, APPOINTMENT_COLUMNS)
+        # الدفعات تُنشأ بعد الحجز، فيكفي تحميل ما أُنشئ منذ بداية النافذة
+        payments = self._frame(self.payments, {"created_at": {"$gte": since_dt}}, PAYMENT_COLUMNS)
+        reviews = self._frame(self.reviews, {"created_at": {"$gte": since_dt, "$lt": until_dt}}, REVIEW_COLUMNS)
+        lawyers = self._frame(self.lawyers, {}, LAWYER_COLUMNS)
+        loaded = time.perf_counter()
+
+        appointments["specialization"] = appointments["specialization"].fillna("").replace("", "غير محدد")
+        appointments["created_at"] = pd.to_datetime(appointments["created_at"])
+        booked = appointments[(appointments["created_at"] >= since_dt) & (appointments["created_at"] < until_dt)]
+
+        # آخر حالة دفع لكل موعد
+        payments["amount"] = pd.to_numeric(payments["amount"], errors="coerce").fillna(0.0)
+        payments["refund_amount"] = pd.to_numeric(payments["refund_amount"], errors="coerce").fillna(0.0)
+        payments = payments.sort_values("created_at", kind="stable").drop_duplicates("appointment_id", keep="last")
+        payments = payments.drop(columns="created_at")
+        booked = booked.merge(
+            payments.rename(columns={"status": "payment_status", "appointment_id": "id"}), on="id", how="left"
+        )
+        booked["is_paid"] = booked["payment_status"].isin(["paid", "refunded"])
+        booked["is_refunded"] = booked["payment_status"].eq("refunded")
+        booked["is_cancelled"] = booked["status"].eq("cancelled")
+        booked["paid_amount"] = booked["amount"].where(booked["is_paid"], 0.0).fillna(0.0)
+        booked["refunded_amount"] = booked["refund_amount"].where(booked["is_refunded"], 0.0).fillna(0.0)
+
+        by_specialization = booked.groupby("specialization").agg(
+            appointments=("id", "size"),
+            paid=("is_paid", "sum"),
+            cancelled=("is_cancelled", "sum"),
+            refunded=("is_refunded", "sum"),
+            paid_amount=("paid_amount", "sum"),
+            refunded_amount=("refunded_amount", "sum"),
+        )
+        by_specialization["conversion_rate"] = _ratio(by_specialization["paid"], by_specialization["appointments"])
+        by_specialization["cancellation_rate"] = _ratio(by_specialization["cancelled"], by_specialization["appointments"])
+        by_specialization["refund_ratio"] = _ratio(by_specialization["refunded"], by_specialization["paid"])
+        by_specialization["refund_amount_ratio"] = _ratio(
+            by_specialization["refunded_amount"], by_specialization["paid_amount"]
+        )
+
+        totals = booked[["is_paid", "is_cancelled", "is_refunded", "paid_amount", "refunded_amount"]].sum()
+        total_appointments = len(booked)
+
+        return {
+            "window": {"since": since, "until": until},
+            "summary": {
+                "appointments": total_appointments,
+                "paid": int(totals["is_paid"]),
+                "cancelled": int(totals["is_cancelled"]),
+                "refunded": int(totals["is_refunded"]),
+                "paid_amount": float(totals["paid_amount"]),
+                "refunded_amount": float(totals["refunded_amount"]),
+                "conversion_rate": round(int(totals["is_paid"]) / total_appointments, 4) if total_appointments else 0.0,
+                "cancellation_rate": round(int(totals["is_cancelled"]) / total_appointments, 4) if total_appointments else 0.0,
+                "refund_ratio": round(int(totals["is_refunded"]) / int(totals["is_paid"]), 4) if totals["is_paid"] else 0.0,
+            },
+            "by_specialization": by_specialization.reset_index().to_dict("records"),
+            "lawyer_utilization": self._utilization(appointments, reviews, lawyers, since, until),
+            "timings_ms": {
+                "load": round((loaded - started) * 1000, 2),
+                "compute": round((time.perf_counter() - loaded) * 1000, 2),
+            },
+        }
+
+    def _utilization(self, appointments: pd.DataFrame, reviews: pd.DataFrame, lawyers: pd.DataFrame,
+                     since: date, until: date) -> list:
+        """الساعات المحجوزة مقابل ساعات العمل المتاحة في النافذة لكل محامٍ"""
+        if lawyers.empty:
+            return []
+
+        # عدد مرات تكرار كل يوم من أيام الأسبوع في النافذة × ساعات كل يوم لكل محامٍ
+        weekday_counts = np.bincount(pd.date_range(since, until, inclusive="left").weekday, minlength=7)
+        weekly = np.array([_weekly_hours(hours) for hours in lawyers["working_hours"]], dtype=float).reshape(-1, 7)
+        lawyers = lawyers.assign(available_hours=weekly @ weekday_counts)
+
+        scheduled = appointments[
+            (appointments["date"] >= since.isoformat()) & (appointments["date"] < until.isoformat())
+            & ~appointments["status"].isin(["cancelled", "payment_failed", "payment_expired"])
+        ]
+        booked_hours = scheduled.groupby("lawyer_id").size().mul(self.slot_hours).rename("booked_hours")
+        ratings = reviews.groupby("lawyer_id")["rating"].agg(["mean", "size"]).rename(
+            columns={"mean": "average_rating", "size": "reviews"}
+        )
+
+        lawyers = lawyers.set_index("id").join(booked_hours).join(ratings)
+        lawyers["booked_hours"] = lawyers["booked_hours"].fillna(0.0)
+        lawyers["reviews"] = lawyers["reviews"].fillna(0).astype(int)
+        lawyers["average_rating"] = lawyers["average_rating"].round(2).astype(object).where(
+            lawyers["average_rating"].notna(), None
+        )
+        lawyers["utilization"] = _ratio(lawyers["booked_hours"], lawyers["available_hours"])
+        lawyers = lawyers.sort_values("utilization", ascending=False)
+        return lawyers.reset_index()[[
+            "id", "name", "specialization", "available_hours", "booked_hours", "utilization",
+            "average_rating", "reviews",
+        ]].rename(columns={"id": "lawyer_id"}).to_dict("records")
+
+
+def default_window(days: int = 30) -> tuple:
+    """آخر days يوماً حتى نهاية اليوم الحالي"""
+    until = date.today() + timedelta(days=1)
+    return until - timedelta(days=days), until
@@ -0,0 +1,372 @@
+"""
+جدولة تذكيرات المواعيد وانتهاء مهلة الدفع - Appointment Scheduler
+كل تذكير أو انتهاء مهلة مهمة في scheduled_tasks بوقت استحقاق due_at مفهرس؛ كل دورة تحجز
+المهام المستحقة فقط (مسح محدود على الفهرس) مهما كان عدد المهام المستقبلية.
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from appointment_slots import UPCOMING_STATUSES, utc_now
+from payment_transitions import DUPLICATE_KEY_ERROR
+
+logger = logging.getLogger(__name__)
+
+REMINDER = "appointment_reminder"
+PAYMENT_EXPIRY = "payment_expiry"
+
+SCHEDULED, CLAIMED, DONE, FAILED = "scheduled", "claimed", "done", "failed"
+
+
+def _task_id(kind: str, appointment_id: str, suffix: str = "") -> str:
+    """معرف ثابت للمهمة: إعادة الجدولة لنفس الموعد لا تنشئ مهمة مكررة"""
+    return f"{kind}:{appointment_id}:{suffix}" if suffix else f"{kind}:{appointment_id}"
+
+
+class AppointmentScheduler:
+    """
+    الحجز ذري لكل مهمة (scheduled ← claimed بعلامة حجز)، لذلك لا تنفذ عمليتان نفس المهمة؛
+    والمهام المحجوزة من عملية توقفت تُستعاد بعد انتهاء مهلة الحجز. آثار المهمة نفسها آمنة للتكرار:
+    الإشعارات تُكتب في الصندوق الصادر بمعرف المهمة، وانتهاء المهلة تحديث مشروط بحالة الموعد.
+    """
+
+    def __init__(self, tasks_collection, appointments_collection, outbox_collection,
+                 on_events: Optional[Callable[[], None]] = None, payments_collection=None):
+        self.tasks = tasks_collection
+        self.appointments = appointments_collection
+        self.outbox = outbox_collection
+        self.payments = payments_collection
+        self.on_events = on_events
+        self.batch_size = int(os.getenv("SCHEDULER_BATCH_SIZE", "200"))
+        self.chunk_size = int(os.getenv("SCHEDULER_CHUNK_SIZE", "50"))
+        self.concurrency = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))
+        self.interval = float(os.getenv("SCHEDULER_POLL_INTERVAL", "15"))
+        self.lease_seconds = float(os.getenv("SCHEDULER_LEASE_SECONDS", "120"))
+        self.max_attempts = int(os.getenv("SCHEDULER_MAX_ATTEMPTS", "5"))
+        self.retention_days = int(os.getenv("SCHEDULER_RETENTION_DAYS", "7"))
+        self.payment_timeout = timedelta(minutes=int(os.getenv("PAYMENT_TIMEOUT_MINUTES", "30")))
+        self.reminder_leads = [
+            int(hours) for hours in os.getenv("APPOINTMENT_REMINDER_HOURS", "24,1").split(",") if hours.strip()
+        ]
+        self.handlers: Dict[str, Callable[[List[Dict[str, Any]]], Dict[str, int]]] = {
+            REMINDER: self._fire_reminders,
+            PAYMENT_EXPIRY: self._fire_expiries,
+        }
+        self._task: Optional[asyncio.Task] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.counters: Dict[str, Dict[str, int]] = {kind: {"fired": 0, "skipped": 0, "failed": 0} for kind in self.handlers}
+        self.ticks = 0
+        self.last_tick_ms = 0.0
+        self.last_lag_seconds = 0.0
+
+    def ensure_indexes(self):
+        self.tasks.create_index([("status", ASCENDING), ("due_at", ASCENDING)])
+        # حذف المهام المنتهية بعد مدة الاحتفاظ (المهام المعلقة لا تحتوي finished_at)
+        self.tasks.create_index("finished_at", expireAfterSeconds=self.retention_days * 86400)
+
+    # ---- الجدولة ----
+
+    def tasks_for(self, appointment: Dict[str, Any], now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """مهام الموعد المستقبلية: انتهاء مهلة الدفع للمعلق غير المدفوع، وتذكير قبل كل مهلة في reminder_leads"""
+        now = now or utc_now()
+        tasks = []
+        if appointment.get("status") == "pending" and appointment.get("payment_status") != "paid":
+            tasks.append({
+                "_id": _task_id(PAYMENT_EXPIRY, appointment["id"]),
+                "kind": PAYMENT_EXPIRY,
+                "due_at": now + self.payment_timeout,
+                "payload": {"appointment_id": appointment["id"]},
+            })
+        slot_start = appointment.get("slot_start")
+        if slot_start and appointment.get("status") in UPCOMING_STATUSES:
+            for hours in self.reminder_leads:
+                due_at = slot_start - timedelta(hours=hours)
+                if due_at <= now:
+                    continue
+                tasks.append({
+                    # الوقت بدقة الدقيقة في المعرف (تعيد قاعدة البيانات التواريخ بدقة الميلي ثانية)
+                    "_id": _task_id(REMINDER, appointment["id"], f"{slot_start:%Y%m%dT%H%M}:{hours}h"),
+                    "kind": REMINDER,
+                    "due_at": due_at,
+                    "payload": {"appointment_id": appointment["id"], "slot_start": slot_start, "hours": hours},
+                })
+        return tasks
+
+    def _upsert(self, tasks: List[Dict[str, Any]], now: datetime) -> int:
+        if not tasks:
+            return 0
+        operations = [
+            UpdateOne(
+                {"_id": task["_id"]},
+                {"$setOnInsert": {**task, "status": SCHEDULED, "attempts": 0, "created_at": now}},
+                upsert=True,
+            )
+            for task in tasks
+        ]
+        return self.tasks.bulk_write(operations, ordered=False).upserted_count
+
+    def schedule(self, appointment: Dict[str, Any]) -> int:
+        """جدولة مهام موعد جديد أو معدل (كتابة واحدة؛ المهام الموجودة لا تتغير)"""
+        now = utc_now()
+        return self._upsert(self.tasks_for(appointment, now), now)
+
+    def backfill(self) -> Dict[str, int]:
+        """
+        جدولة المواعيد القائمة التي سبقت المجدول على دفعات. آمن للتكرار: المعرفات ثابتة.
+        المواعيد المعلقة القديمة تُمنح مهلة دفع كاملة من وقت الجدولة.
+        """
+        now = utc_now()
+        appointments = scheduled = 0
+        batch: List[Dict[str, Any]] = []
+        cursor = self.appointments.find(
+            {"status": {"$in": UPCOMING_STATUSES}, "$or": [{"status": "pending"}, {"slot_start": {"$gt": now}}]},
+            {"_id": 0, "id": 1, "status": 1, "payment_status": 1, "slot_start": 1},
+            batch_size=self.batch_size,
+        )
+        for appointment in cursor:
+            appointments += 1
+            batch.extend(self.tasks_for(appointment, now))
+            if len(batch) >= self.batch_size:
+                scheduled, batch = scheduled + self._upsert(batch, now), []
+        scheduled += self._upsert(batch, now)
+        logger.info(f"Appointment tasks backfilled: {scheduled} scheduled for {appointments} appointments")
+        return {"appointments": appointments, "scheduled": scheduled}
+
+    # ---- التنفيذ ----
+
+    def _due_filter(self, now: datetime) -> Dict[str, Any]:
+        stale = now - timedelta(seconds=self.lease_seconds)
+        return {"$or": [
+            {"status": SCHEDULED, "due_at": {"$lte": now}},
+            {"status": CLAIMED, "claimed_at": {"$lt": stale}},
+        ]}
+
+    def _claim_batch(self) -> List[Dict[str, Any]]:
+        """حجز دفعة من المهام المستحقة (أو المحجوزة من عملية توقفت) بأقدمها استحقاقاً"""
+        now = utc_now()
+        ids = [
+            doc["_id"] for doc in
+            self.tasks.find(self._due_filter(now), {"_id": 1}).sort("due_at", ASCENDING).limit(self.batch_size)
+        ]
+        if not ids:
+            return []
+        claim = str(uuid.uuid4())
+        self.tasks.update_many(
+            {"_id": {"$in": ids}, **self._due_filter(now)},
+            {"$set": {"status": CLAIMED, "claim": claim, "claimed_at": now}, "$inc": {"attempts": 1}}
+        )
+        return list(self.tasks.find({"_id": {"$in": ids}, "claim": claim}))
+
+    def _finish(self, tasks: List[Dict[str, Any]], error: Optional[str] = None):
+        # مقيد بعلامة الحجز: إذا انتهت المهلة وحجزتها عملية أخرى فلا يُكتب فوق حجزها
+        claim = tasks[0]["claim"]
+        ids = [task["_id"] for task in tasks]
+        if error is None:
+            self.tasks.update_many(
+                {"_id": {"$in": ids}, "claim": claim},
+                {"$set": {"status": DONE, "finished_at": utc_now()}, "$unset": {"claim": ""}}
+            )
+            return
+        retry = [task["_id"] for task in tasks if task.get("attempts", 0) < self.max_attempts]
+        failed = [task_id for task_id in ids if task_id not in retry]
+        if retry:
+            self.tasks.update_many(
+                {"_id": {"$in": retry}, "claim": claim},
+                {"$set": {"status": SCHEDULED, "error": error}, "$unset": {"claim": ""}}
+            )
+        if failed:
+            self.tasks.update_many(
+                {"_id": {"$in": failed}, "claim": claim},
+                {"$set": {"status": FAILED, "error": error, "finished_at": utc_now()}, "$unset": {"claim": ""}}
+            )
+
+    def _write_events(self, events: List[Dict[str, Any]]):
+        """إدراج أحداث الإشعار بمعرفات ثابتة؛ الحدث المدرج سابقاً (تنفيذ مكرر للمهمة) يُتجاهل"""
+        if not events:
+            return
+        try:
+            self.outbox.insert_many(events, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+
+    @staticmethod
+    def _event(event_id: str, recipient: str, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        # created_at بنفس ساعة أحداث الصندوق الصادر الأخرى (ترتيب التفريغ)
+        return {
+            "_id": event_id,
+            "type": "notification",
+            "payload": {**payload, "kind": kind, "recipient": recipient},
+            "status": "pending",
+            "attempts": 0,
+            "created_at": datetime.now(),
+        }
+
+    def _fire_reminders(self, tasks: List[Dict[str, Any]]) -> Dict[str, int]:
+        """تذكير العميل والمحامي؛ الموعد الملغى أو المعاد جدولته بعد إنشاء المهمة يُتخطى"""
+        appointment_ids = [task["payload"]["appointment_id"] for task in tasks]
+        appointments = {
+            appointment["id"]: appointment for appointment in self.appointments.find(
+                {"id": {"$in": appointment_ids}},
+                {"_id": 0, "id": 1, "status": 1, "slot_start": 1, "date": 1, "time": 1, "lawyer_name": 1}
+            )
+        }
+        events = []
+        for task in tasks:
+            payload = task["payload"]
+            appointment = appointments.get(payload["appointment_id"])
+            if (not appointment or appointment.get("status") not in UPCOMING_STATUSES
+                    or appointment.get("slot_start") != payload["slot_start"]):
+                continue
+            data = {
+                "appointment_id": appointment["id"],
+                "date": appointment.get("date"),
+                "time": appointment.get("time"),
+                "lawyer_name": appointment.get("lawyer_name"),
+                "hours": payload["hours"],
+            }
+            for recipient in ("client_id", "lawyer_id"):
+                events.append(self._event(f"{task['_id']}:{recipient}", recipient, REMINDER, data))
+        self._write_events(events)
+        fired = len(events) // 2
+        return {"fired": fired, "skipped": len(tasks) - fired}
+
+    def _defer_for_open_invoices(self, appointment_ids: List[str]) -> List[str]:
+        """
+        المواعيد التي لها فاتورة معلقة ما زالت قابلة للدفع لا تنتهي مهلتها الآن (تحرير وقتها يسمح بحجزه
+        ثم دفع الفاتورة): تُجدول لها مهلة جديدة عند انتهاء صلاحية الفاتورة ويعاد معرفاتها.
+        """
+        if self.payments is None or not appointment_ids:
+            return []
+        # expires_at في سجلات الدفع بالتوقيت المحلي للخادم مثل باقي تواريخها
+        invoices = self.payments.find(
+            {"appointment_id": {"$in": appointment_ids}, "status": "pending", "expires_at": {"$gt": datetime.now()}},
+            {"_id": 0, "appointment_id": 1, "expires_at": 1}
+        )
+        latest: Dict[str, datetime] = {}
+        for invoice in invoices:
+            current = latest.get(invoice["appointment_id"])
+            if current is None or invoice["expires_at"] > current:
+                latest[invoice["appointment_id"]] = invoice["expires_at"]
+        now = utc_now()
+        self._upsert([
+            {
+                "_id": _task_id(PAYMENT_EXPIRY, appointment_id, f"{expires_at:%Y%m%dT%H%M}"),
+                "kind": PAYMENT_EXPIRY,
+                "due_at": expires_at.astimezone(timezone.utc).replace(tzinfo=None),
+                "payload": {"appointment_id": appointment_id},
+            }
+            for appointment_id, expires_at in latest.items()
+        ], now)
+        return list(latest)
+
+    def _fire_expiries(self, tasks: List[Dict[str, Any]]) -> Dict[str, int]:
+        """تحويل المواعيد التي لم يكتمل دفعها إلى payment_expired (تحديث واحد مشروط للدفعة)"""
+        appointment_ids = [task["payload"]["appointment_id"] for task in tasks]
+        deferred = set(self._defer_for_open_invoices(appointment_ids))
+        appointment_ids = [appointment_id for appointment_id in appointment_ids if appointment_id not in deferred]
+        if not appointment_ids:
+            return {"fired": 0, "skipped": len(tasks)}
+        # الطابع الزمني يميز المواعيد التي انتهت مهلتها في هذه الدفعة تحديداً
+        expired_at = utc_now()
+        self.appointments.update_many(
+            {"id": {"$in": appointment_ids}, "status": "pending", "payment_status": {"$ne": "paid"}},
+            {"$set": {"status": "payment_expired", "payment_expired_at": expired_at}}
+        )
+        expired = [
+            appointment["id"] for appointment in self.appointments.find(
+                {"id": {"$in": appointment_ids}, "status": "payment_expired", "payment_expired_at": expired_at},
+                {"_id": 0, "id": 1}
+            )
+        ]
+        self._write_events([
+            self._event(f"{_task_id(PAYMENT_EXPIRY, appointment_id)}:client_id", "client_id", "payment_expired",
+                        {"appointment_id": appointment_id})
+            for appointment_id in expired
+        ])
+        return {"fired": len(expired), "skipped": len(tasks) - len(expired)}
+
+    async def _run_chunk(self, kind: str, tasks: List[Dict[str, Any]]) -> bool:
+        async with self._semaphore:
+            counters = self.counters.setdefault(kind, {"fired": 0, "skipped": 0, "failed": 0})
+            handler = self.handlers.get(kind)
+            try:
+                if handler is None:
+                    raise ValueError(f"no handler for {kind}")
+                result = await asyncio.to_thread(handler, tasks)
+                await asyncio.to_thread(self._finish, tasks)
+            except Exception as e:
+                logger.error(f"خطأ في تنفيذ مهام {kind}: {e}")
+                counters["failed"] += len(tasks)
+                await asyncio.to_thread(self._finish, tasks, str(e))
+                return False
+            counters["fired"] += result["fired"]
+            counters["skipped"] += result["skipped"]
+            return result["fired"] > 0
+
+    async def tick(self) -> int:
+        """دورة واحدة: حجز دفعة وتنفيذها على أجزاء بتزامن محدود؛ تعيد عدد المهام المحجوزة"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        batch = await asyncio.to_thread(self._claim_batch)
+        if batch:
+            self.last_lag_seconds = max(0.0, (utc_now() - min(task["due_at"] for task in batch)).total_seconds())
+            by_kind: Dict[str, List[Dict[str, Any]]] = {}
+            for task in batch:
+                by_kind.setdefault(task["kind"], []).append(task)
+            chunks = [
+                (kind, tasks[i:i + self.chunk_size])
+                for kind, tasks in by_kind.items()
+                for i in range(0, len(tasks), self.chunk_size)
+            ]
+            fired = await asyncio.gather(*(self._run_chunk(kind, tasks) for kind, tasks in chunks))
+            if any(fired) and self.on_events is not None:
+                self.on_events()
+        self.ticks += 1
+        self.last_tick_ms = (time.perf_counter() - started) * 1000
+        return len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                # دفعة ممتلئة تعني تأخراً متراكماً: المتابعة فوراً حتى يفرغ
+                while await self.tick() >= self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في مجدول المواعيد: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """إيقاف الدورة؛ المهام المحجوزة غير المكتملة تُستعاد بعد مهلة الحجز"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "ticks": self.ticks,
+            "last_tick_ms": round(self.last_tick_ms, 2),
+            "last_lag_seconds": round(self.last_lag_seconds, 2),
+            "batch_size": self.batch_size,
+            "concurrency": self.concurrency,
+            "tasks": self.counters,
+        }
@@ -0,0 +1,225 @@
+"""
+أوقات المواعيد الموحدة - Appointment Slots
+تحويل تاريخ ووقت الموعد (بتوقيت المحامي) إلى بداية ونهاية بتوقيت UTC في slot_start و slot_end،
+لتصبح استعلامات المواعيد القادمة والتداخل والتقويم مسحاً لنطاق على فهارس مركبة.
+"""
+
+import os
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from payment_transitions import DUPLICATE_KEY_ERROR
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "Asia/Riyadh")
+SLOT_MINUTES = int(os.getenv("APPOINTMENT_SLOT_MINUTES", "60"))
+
+# المواعيد القائمة التي تظهر كقادمة، والحالات التي تحرر الوقت المحجوز
+UPCOMING_STATUSES = ["pending", "confirmed"]
+RELEASED_STATUSES = ["cancelled", "payment_failed", "payment_expired"]
+
+
+def is_valid_timezone(name: str) -> bool:
+    try:
+        ZoneInfo(name)
+        return True
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+
+
+def resolve_timezone(name: Optional[str]) -> ZoneInfo:
+    """المنطقة الزمنية للمحامي، أو الافتراضية إذا لم تُحدد أو كانت غير معروفة"""
+    if name and is_valid_timezone(name):
+        return ZoneInfo(name)
+    return ZoneInfo(DEFAULT_TIMEZONE)
+
+
+def utc_now() -> datetime:
+    """الوقت الحالي بتوقيت UTC بدون tzinfo (كما يخزن pymongo التواريخ ويعيدها)"""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def to_utc(value: datetime) -> datetime:
+    """تاريخ بمنطقة زمنية إلى UTC بدون tzinfo؛ التاريخ بدون منطقة يُعامل كتوقيت UTC"""
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def slot_bounds(date_value: str, time_value: str, timezone_name: Optional[str] = None,
+                minutes: int = SLOT_MINUTES) -> Tuple[datetime, datetime]:
+    """بداية ونهاية الموعد بتوقيت UTC. ValueError إذا لم يكن التاريخ YYYY-MM-DD والوقت HH:MM"""
+    local = datetime.strptime(f"{date_value} {time_value}", "%Y-%m-%d %H:%M")
+    start = local.replace(tzinfo=resolve_timezone(timezone_name)).astimezone(timezone.utc).replace(tzinfo=None)
+    return start, start + timedelta(minutes=minutes)
+
+
+class AppointmentSlots:
+    """
+    الفهرسان (lawyer_id, slot_start) و (client_id, slot_start) يخدمان جميع الاستعلامات الزمنية:
+    كل استعلام يحدد slot_start من الطرفين فيقرأ المواعيد الواقعة في النطاق فقط.
+    """
+
+    def __init__(self, appointments_collection, lawyers_collection):
+        self.appointments = appointments_collection
+        self.lawyers = lawyers_collection
+        self.batch_size = int(os.getenv("SLOT_BACKFILL_BATCH_SIZE", "1000"))
+        # أطول مدة موعد ممكنة: تحد بداية نطاق البحث عن التداخل
+        self.max_slot = timedelta(minutes=max(SLOT_MINUTES, int(os.getenv("APPOINTMENT_MAX_SLOT_MINUTES", "240"))))
+
+    def ensure_indexes(self):
+        self.appointments.create_index([("lawyer_id", ASCENDING), ("slot_start", ASCENDING)])
+        self.appointments.create_index([("client_id", ASCENDING), ("slot_start", ASCENDING)])
+
+    def ensure_unique_slots(self):
+        """
+        موعد قائم واحد لكل وقت بداية للمحامي: الحجوزات المتزامنة لنفس الوقت يفشل إدراج إحداها.
+        slot_conflict فارغ لجميع المواعيد عدا الحجوزات المكررة القديمة (قبل التحقق من التداخل)،
+        فتُعلَّم بمعرفها وتبقى للمراجعة بدل منع إنشاء الفهرس. المواعيد بدون slot_start خارج الفهرس.
+        """
+        conflicts = self.flag_conflicts()
+        if conflicts:
+            logger.warning(f"{conflicts} duplicate legacy bookings flagged with slot_conflict")
+        # الفهرس الفريد السابق بدون slot_conflict
+        if "slot_start_1_lawyer_id_1" in self.appointments.index_information():
+            self.appointments.drop_index("slot_start_1_lawyer_id_1")
+        self.appointments.create_index(
+            [("slot_start", ASCENDING), ("lawyer_id", ASCENDING), ("slot_conflict", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"status": {"$in": UPCOMING_STATUSES}, "slot_start": {"$type": "date"}}
+        )
+
+    def flag_conflicts(self) -> int:
+        """تعليم كل موعد قائم يكرر وقت موعد أقدم لنفس المحامي بـ slot_conflict (آمن للتكرار)"""
+        duplicates = self.appointments.aggregate([
+            {"$match": {
+                "status": {"$in": UPCOMING_STATUSES},
+                "slot_start": {"$type": "date"},
+                "slot_conflict": None,
+            }},
+            {"$sort": {"created_at": ASCENDING}},
+            {"$group": {"_id": {"lawyer_id": "$lawyer_id", "slot_start": "$slot_start"}, "ids": {"$push": "$id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ], allowDiskUse=True)
+        operations = [
+            UpdateOne({"id": appointment_id}, {"$set": {"slot_conflict": appointment_id}})
+            for group in duplicates
+            for appointment_id in group["ids"][1:]
+        ]
+        if operations:
+            self.appointments.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    @staticmethod
+    def slot_fields(lawyer: Dict[str, Any], date_value: str, time_value: str) -> Dict[str, Any]:
+        """حقول الوقت الموحد لموعد جديد بحسب المنطقة الزمنية للمحامي"""
+        timezone_name = resolve_timezone(lawyer.get("timezone")).key
+        start, end = slot_bounds(date_value, time_value, timezone_name)
+        return {"slot_start": start, "slot_end": end, "timezone": timezone_name}
+
+    def upcoming(self, client_id: str, limit: int = 5, now: Optional[datetime] = None) -> List[Dict[str, Any]]:
+        """المواعيد القادمة للعميل بترتيب وقتها الفعلي"""
+        return list(self.appointments.find(
+            {
+                "client_id": client_id,
+                "slot_start": {"$gte": now or utc_now()},
+                "status": {"$in": UPCOMING_STATUSES},
+            },
+            {"_id": 0}
+        ).sort("slot_start", ASCENDING).limit(limit))
+
+    def overlapping(self, lawyer_id: str, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        """المواعيد القائمة للمحامي المتداخلة مع [start, end)"""
+        return list(self.appointments.find(
+            {
+                "lawyer_id": lawyer_id,
+                "slot_start": {"$gt": start - self.max_slot, "$lt": end},
+                "slot_end": {"$gt": start},
+                "status": {"$nin": RELEASED_STATUSES},
+            },
+            {"_id": 0, "id": 1, "slot_start": 1, "slot_end": 1, "status": 1}
+        ))
+
+    def calendar(self, lawyer_id: str, since: datetime, until: datetime) -> List[Dict[str, Any]]:
+        """الأوقات المحجوزة للمحامي في [since, until) بالترتيب"""
+        return list(self.appointments.find(
+            {
+                "lawyer_id": lawyer_id,
+                "slot_start": {"$gte": since, "$lt": until},
+                "status": {"$nin": RELEASED_STATUSES},
+            },
+            {"_id": 0, "id": 1, "date": 1, "time": 1, "slot_start": 1, "slot_end": 1, "timezone": 1, "status": 1}
+        ).sort("slot_start", ASCENDING))
+
+    def _backfill_batch(self, appointments: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+        lawyer_ids = list({appointment.get("lawyer_id") for appointment in appointments})
+        timezones = {
+            lawyer["id"]: lawyer.get("timezone")
+            for lawyer in self.lawyers.find({"id": {"$in": lawyer_ids}}, {"_id": 0, "id": 1, "timezone": 1})
+        }
+        updates = []
+        skipped = 0
+        for appointment in appointments:
+            timezone_name = resolve_timezone(timezones.get(appointment.get("lawyer_id"))).key
+            try:
+                start, end = slot_bounds(appointment.get("date", ""), appointment.get("time", ""), timezone_name)
+                fields = {"slot_start": start, "slot_end": end, "timezone": timezone_name}
+            except (TypeError, ValueError):
+                # تاريخ أو وقت غير صالح: يُعلّم حتى لا يُعاد فحصه، ولا يظهر في الاستعلامات الزمنية
+                fields = {"slot_start": None, "slot_end": None, "timezone": timezone_name}
+                skipped += 1
+            updates.append((appointment["id"], fields))
+        if not updates:
+            return 0, skipped, 0
+        try:
+            self._write_slots(updates)
+            return len(updates) - skipped, skipped, 0
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+        # حجز قديم مكرر لوقت موعد قائم: يُكتب وقته مع تعليم التعارض بدل إيقاف التحديث
+        conflicting = [updates[error["index"]] for error in errors]
+        self._write_slots([
+            (appointment_id, {**fields, "slot_conflict": appointment_id}) for appointment_id, fields in conflicting
+        ])
+        return len(updates) - skipped - len(conflicting), skipped, len(conflicting)
+
+    def _write_slots(self, updates: List[Tuple[str, Dict[str, Any]]]):
+        self.appointments.bulk_write([
+            UpdateOne({"id": appointment_id, "slot_start": {"$exists": False}}, {"$set": fields})
+            for appointment_id, fields in updates
+        ], ordered=False)
+
+    def backfill(self) -> Dict[str, int]:
+        """
+        إضافة slot_start و slot_end للمواعيد القديمة على دفعات. آمن للتكرار والاستئناف:
+        يعالج فقط المواعيد التي لا تحتوي slot_start. الحجوزات القديمة المكررة لوقت موعد قائم
+        تُحدّث مع slot_conflict وتُعد في conflicts.
+        """
+        updated = skipped = conflicts = 0
+        batch: List[Dict[str, Any]] = []
+        cursor = self.appointments.find(
+            {"slot_start": {"$exists": False}},
+            {"_id": 0, "id": 1, "lawyer_id": 1, "date": 1, "time": 1},
+            batch_size=self.batch_size,
+        )
+        for appointment in cursor:
+            batch.append(appointment)
+            if len(batch) >= self.batch_size:
+                done, bad, duplicate = self._backfill_batch(batch)
+                updated, skipped, conflicts, batch = updated + done, skipped + bad, conflicts + duplicate, []
+        if batch:
+            done, bad, duplicate = self._backfill_batch(batch)
+            updated, skipped, conflicts = updated + done, skipped + bad, conflicts + duplicate
+        logger.info(
+            f"Appointment slots backfilled: {updated} updated, {skipped} with invalid date/time, "
+            f"{conflicts} duplicate bookings flagged with slot_conflict"
+        )
+        return {"updated": updated, "skipped": skipped, "conflicts": conflicts}
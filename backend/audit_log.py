@@ -0,0 +1,161 @@
+"""
+سجل التدقيق - Audit Log Writer
+كتابة سجلات الإدارة على دفعات من ذاكرة مؤقتة مع مدة احتفاظ وفهارس للاستعلام
+"""
+
+import asyncio
+import os
+import hashlib
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from json_response import dumps
+from payment_transitions import DUPLICATE_KEY_ERROR
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLogWriter:
+    """
+    يجمع سجلات الإدارة في الذاكرة ويكتبها بـ insert_many عند بلوغ حجم الدفعة
+    أو انقضاء فترة التفريغ، ويفرّغ ما تبقى عند إيقاف الخادم.
+    """
+
+    def __init__(self, admin_logs_collection):
+        self.collection = admin_logs_collection
+        self.batch_size = int(os.getenv("AUDIT_LOG_BATCH_SIZE", "100"))
+        self.flush_interval = float(os.getenv("AUDIT_LOG_FLUSH_INTERVAL", "2"))
+        self.max_buffer = int(os.getenv("AUDIT_LOG_MAX_BUFFER", "10000"))
+        self.retention_days = int(os.getenv("AUDIT_LOG_RETENTION_DAYS", "365"))
+        self._buffer: List[Dict[str, Any]] = []
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def ensure_indexes(self):
+        """فهرس TTL للاحتفاظ وفهارس الاستعلام حسب المستخدم المستهدف والمدير"""
+        self.collection.create_index("timestamp", expireAfterSeconds=self.retention_days * 24 * 3600)
+        self.collection.create_index([("target_user_id", ASCENDING), ("timestamp", DESCENDING)])
+        self.collection.create_index([("admin_id", ASCENDING), ("timestamp", DESCENDING)])
+
+    def log(self, admin_id: Optional[str], action: str, target_user_id: Optional[str] = None,
+            details: Optional[Dict[str, Any]] = None, **extra):
+        """إضافة سجل للذاكرة المؤقتة دون انتظار الكتابة"""
+        entry = {
+            "admin_id": admin_id,
+            "action": action,
+            "target_user_id": target_user_id,
+            "timestamp": datetime.now(),
+            **extra,
+        }
+        if details is not None:
+            entry["details"] = details
+        self.extend([entry])
+
+    def extend(self, entries: List[Dict[str, Any]]):
+        """إضافة عدة سجلات جاهزة (مثل أحداث الصندوق الصادر)"""
+        self._buffer.extend(entries)
+        if len(self._buffer) > self.max_buffer:
+            dropped = len(self._buffer) - self.max_buffer
+            del self._buffer[:dropped]
+            logger.warning(f"Audit log buffer overflow, dropped {dropped} oldest entries")
+        if len(self._buffer) >= self.batch_size and self._task is not None:
+            asyncio.ensure_future(self.flush())
+
+    def write(self, entries: List[Dict[str, Any]]) -> int:
+        """
+        كتابة مباشرة لسجلات من مصدر دائم (الصندوق الصادر) دون المرور بالذاكرة المؤقتة؛ الاستثناء يعني
+        إعادة المحاولة. _id مشتق من محتوى السجل فالإعادة لا تكرر ما كُتب.
+        """
+        if not entries:
+            return 0
+        documents = [
+            {"_id": hashlib.sha256(dumps(entry, sort_keys=True)).hexdigest(), **entry} for entry in entries
+        ]
+        try:
+            self.collection.insert_many(documents, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+        return len(documents)
+
+    async def flush(self) -> int:
+        """كتابة السجلات المتراكمة دفعة واحدة"""
+        async with self._flush_lock:
+            if not self._buffer:
+                return 0
+            batch, self._buffer = self._buffer, []
+            # _id ثابت لكل سجل قبل الكتابة: إعادة دفعة كُتب جزء منها تصطدم بمفتاح مكرر للمكتوب فقط
+            for entry in batch:
+                entry.setdefault("_id", ObjectId())
+            try:
+                await asyncio.to_thread(self.collection.insert_many, batch, ordered=False)
+            except BulkWriteError as e:
+                failed = sorted({
+                    error["index"] for error in e.details.get("writeErrors", [])
+                    if error.get("code") != DUPLICATE_KEY_ERROR
+                })
+                if failed:
+                    logger.error(f"خطأ في كتابة {len(failed)} من سجلات الإدارة: {e}")
+                    self._buffer[:0] = [batch[index] for index in failed]
+                return len(batch) - len(failed)
+            except Exception as e:
+                logger.error(f"خطأ في كتابة سجلات الإدارة: {e}")
+                # إعادة السجلات للذاكرة لمحاولة لاحقة (المكتوب منها يُتجاهل كمفتاح مكرر)
+                self._buffer[:0] = batch
+                return 0
+            return len(batch)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def query(
+        self,
+        admin_id: Optional[str] = None,
+        target_user_id: Optional[str] = None,
+        action: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        page: int = 1,
+        limit: int = 50,
+    ) -> List[Dict[str, Any]]:
+        """استعلام السجلات الأحدث أولاً (يستخدم فهارس المستخدم/المدير مع التاريخ)"""
+        criteria: Dict[str, Any] = {}
+        if admin_id:
+            criteria["admin_id"] = admin_id
+        if target_user_id:
+            criteria["target_user_id"] = target_user_id
+        if action:
+            criteria["action"] = action
+        if since or until:
+            criteria["timestamp"] = {}
+            if since:
+                criteria["timestamp"]["$gte"] = since
+            if until:
+                criteria["timestamp"]["$lt"] = until
+        return list(
+            self.collection.find(criteria, {"_id": 0})
+            .sort("timestamp", DESCENDING)
+            .skip((page - 1) * limit)
+            .limit(limit)
+        )
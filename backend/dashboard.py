@@ -0,0 +1,105 @@
+"""
+تجميع لوحات التحكم - Dashboard Composition
+تنفيذ أقسام لوحة التحكم معاً بدل تسلسلها، مع مهلة لكل قسم ونتائج جزئية عند تأخره،
+وذاكرة مؤقتة لكل قسم بمدة صلاحية مختلفة حسب تحمّله للتقادم.
+"""
+
+import asyncio
+import os
+import time
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Sequence
+
+import pymongo
+
+from caching import TTLCache
+from metrics import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+
+class DashboardSection:
+    """
+    قسم واحد: loader دالة متزامنة (pymongo) تُنفذ في خيط منفصل، واستعلاماتها محدودة بنفس المهلة.
+    ttl = 0 يعني عدم التخزين (بيانات يجب أن تكون حديثة دائماً مثل المواعيد القادمة).
+    """
+
+    def __init__(self, name: str, loader: Callable[[], Any], timeout: float,
+                 ttl: float = 0, default: Any = None):
+        self.name = name
+        self.loader = loader
+        self.timeout = timeout
+        self.ttl = ttl
+        self.default = default
+
+
+class DashboardComposer:
+    """تنفيذ الأقسام بـ asyncio.gather وإرجاع {اسم القسم: النتيجة} مع قائمة الأقسام الناقصة"""
+
+    def __init__(self):
+        self.cache = TTLCache(ttl=60, max_size=int(os.getenv("DASHBOARD_CACHE_SIZE", "20000")))
+        self.latency: Dict[str, LatencyTracker] = {}
+        self.timeouts: Dict[str, int] = {}
+
+    def _tracker(self, name: str) -> LatencyTracker:
+        tracker = self.latency.get(name)
+        if tracker is None:
+            tracker = self.latency[name] = LatencyTracker(window=256)
+        return tracker
+
+    @staticmethod
+    def _run(section: DashboardSection) -> Any:
+        # مهلة pymongo (maxTimeMS ومهلة الاتصال) تنهي استعلامات القسم المتأخر، فلا يبقى خيطه
+        # مشغولاً في المجمع الافتراضي بعد أن تتخلى عنه wait_for
+        with pymongo.timeout(section.timeout):
+            return section.loader()
+
+    def _timed_out(self, section: DashboardSection, started: float) -> tuple:
+        self._tracker(section.name).record(time.perf_counter() - started, error=True)
+        self.timeouts[section.name] = self.timeouts.get(section.name, 0) + 1
+        logger.warning(f"Dashboard section {section.name} timed out after {section.timeout}s")
+        return section.name, section.default, False
+
+    async def _load(self, owner: Hashable, section: DashboardSection) -> tuple:
+        cache_key = (section.name, owner)
+        if section.ttl:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return section.name, cached, True
+
+        started = time.perf_counter()
+        try:
+            value = await asyncio.wait_for(asyncio.to_thread(self._run, section), timeout=section.timeout)
+        except asyncio.TimeoutError:
+            return self._timed_out(section, started)
+        except Exception as e:
+            if isinstance(e, pymongo.errors.PyMongoError) and e.timeout:
+                return self._timed_out(section, started)
+            self._tracker(section.name).record(time.perf_counter() - started, error=True)
+            logger.error(f"خطأ في قسم لوحة التحكم {section.name}: {e}")
+            return section.name, section.default, False
+
+        self._tracker(section.name).record(time.perf_counter() - started)
+        if section.ttl:
+            self.cache.set(cache_key, value, ttl=section.ttl)
+        return section.name, value, True
+
+    async def compose(self, owner: Hashable, sections: Sequence[DashboardSection]) -> Dict[str, Any]:
+        results = await asyncio.gather(*(self._load(owner, section) for section in sections))
+        composed: Dict[str, Any] = {}
+        partial: List[str] = []
+        for name, value, complete in results:
+            composed[name] = value
+            if not complete:
+                partial.append(name)
+        composed["partial"] = partial
+        return composed
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "cached_sections": len(self.cache),
+            "sections": {
+                name: {"timeouts": self.timeouts.get(name, 0), "latency": tracker.snapshot()}
+                for name, tracker in self.latency.items()
+            },
+        }
@@ -0,0 +1,73 @@
+"""
+قاعدة البيانات - Database Connection
+عميل MongoDB بمهلات محدودة ومجموعات التطبيق (الاتصال الفعلي يتم لاحقاً في مراحل بدء التشغيل)
+"""
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from http_caching import VersionedCollection
+
+logger = logging.getLogger(__name__)
+
+mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/')
+
+# MongoClient لا يتصل عند الإنشاء؛ المهلات تمنع تعليق الطلبات إذا كانت قاعدة البيانات غير متاحة
+client = MongoClient(
+    mongo_url,
+    serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    connectTimeoutMS=int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", "100")),
+    minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+)
+DATABASE_NAME = os.getenv("MONGO_DB_NAME", "debra_legal")
+db = client[DATABASE_NAME]
+
+# مجموعات قاعدة البيانات (الكتابة فيها ترفع عداد الإصدار المستخدم في ETag)
+lawyers_collection = VersionedCollection(db['lawyers'])
+appointments_collection = VersionedCollection(db['appointments'])
+consultations_collection = VersionedCollection(db['consultations'])
+users_collection = VersionedCollection(db['users'])
+payments_collection = VersionedCollection(db['payments'])
+sessions_collection = db['sessions']  # جلسات المستخدمين
+notifications_collection = db['notifications']  # الإشعارات
+reviews_collection = VersionedCollection(db['reviews'])  # التقييمات
+admin_logs_collection = db['admin_logs']  # سجلات الإدارة
+outbox_collection = db['outbox']  # الصندوق الصادر للآثار الجانبية
+revenue_rollups_collection = VersionedCollection(db['revenue_rollups'])  # حاويات الإيرادات اليومية والشهرية
+revenue_events_collection = db['revenue_events']  # أحداث الإيراد المطبقة (لمنع التكرار)
+scheduled_tasks_collection = db['scheduled_tasks']  # تذكيرات المواعيد وانتهاء مهلة الدفع
+jobs_collection = db['jobs']  # طابور المهام الخلفية
+idempotency_collection = db['idempotency_keys']  # استجابات الطلبات المحفوظة حسب Idempotency-Key
+
+# سياسة القراءة: قراءات الدفع والحجز (الحساسة للاتساق) تبقى على الخادم الأساسي عبر المجموعات أعلاه،
+# والقراءات المتسامحة مع التقادم (الإحصائيات ولوحات التحكم وقوائم التقييمات) تذهب للثانويين
+# بحد أقصى للتقادم (MongoDB يشترط 90 ثانية على الأقل). المجموعات أدناه للقراءة فقط.
+READ_MAX_STALENESS_SECONDS = max(90, int(os.getenv("READ_MAX_STALENESS_SECONDS", "90")))
+if os.getenv("READ_ROUTING_ENABLED", "true").lower() == "true":
+    TOLERANT_READ_PREFERENCE = SecondaryPreferred(max_staleness=READ_MAX_STALENESS_SECONDS)
+else:
+    TOLERANT_READ_PREFERENCE = Primary()
+
+tolerant_db = client.get_database(DATABASE_NAME, read_preference=TOLERANT_READ_PREFERENCE)
+lawyers_reads = tolerant_db['lawyers']
+appointments_reads = tolerant_db['appointments']
+consultations_reads = tolerant_db['consultations']
+users_reads = tolerant_db['users']
+payments_reads = tolerant_db['payments']
+reviews_reads = tolerant_db['reviews']
+
+
+def ping(timeout_ms: int = 2000) -> None:
+    """التحقق من الاتصال بمهلة محدودة"""
+    client.admin.command("ping", maxTimeMS=timeout_ms)
+
+
+def warm_pool(connections: int = 4) -> None:
+    """فتح عدة اتصالات مسبقاً بأوامر ping متزامنة لتجنب تكلفة الاتصال في أول الطلبات"""
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        list(executor.map(lambda _: client.admin.command("ping"), range(connections)))
@@ -0,0 +1,257 @@
+"""
+مرونة بوابة الدفع - Gateway Resilience
+إعادة المحاولة، قاطع الدائرة، الطلبات المتحوطة والمهلة التكيفية لاستدعاءات ماي فاتورة
+"""
+
+import asyncio
+import os
+import random
+import time
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+from metrics import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """قاطع الدائرة مفتوح - البوابة متدهورة ونرفض الطلب فوراً"""
+
+
+class RetryPolicy:
+    """سياسة إعادة المحاولة بتراجع أسي مع تشويش كامل"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """مدة الانتظار قبل المحاولة التالية (attempt يبدأ من 0)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """قاطع الدائرة: مغلق ← مفتوح عند تكرار الفشل ← نصف مفتوح للتجربة"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, recovery_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.half_open_calls = 0
+        self.total_rejections = 0
+        self.total_trips = 0
+
+    def allow_request(self) -> bool:
+        """هل يُسمح بتمرير الطلب للبوابة؟"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self.half_open_calls = 0
+            else:
+                self.total_rejections += 1
+                return False
+
+        if self.state == self.HALF_OPEN:
+            if self.half_open_calls >= self.half_open_max_calls:
+                self.total_rejections += 1
+                return False
+            self.half_open_calls += 1
+
+        return True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        if self.state != self.CLOSED:
+            logger.info("MyFatoorah circuit breaker closed")
+        self.state = self.CLOSED
+
+    def release(self) -> None:
+        """تحرير خانة التجربة في الحالة نصف المفتوحة لطلب انتهى دون حكم على صحة البوابة"""
+        if self.state == self.HALF_OPEN and self.half_open_calls > 0:
+            self.half_open_calls -= 1
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.total_trips += 1
+                logger.warning(f"MyFatoorah circuit breaker opened after {self.consecutive_failures} failures")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "recovery_timeout": self.recovery_timeout,
+            "total_trips": self.total_trips,
+            "total_rejections": self.total_rejections,
+        }
+
+
+class AdaptiveTimeout:
+    """مهلة تكيفية مبنية على زمن الاستجابة الملاحظ (p99 × معامل) ضمن حدود دنيا وعليا"""
+
+    def __init__(self, default: float = 30.0, minimum: float = 2.0, maximum: float = 30.0,
+                 multiplier: float = 3.0, min_samples: int = 20):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.latency = LatencyTracker()
+
+    def current(self) -> float:
+        if len(self.latency) < self.min_samples:
+            return self.default
+        p99 = self.latency.percentile(99)
+        return max(self.minimum, min(self.maximum, p99 * self.multiplier))
+
+    def hedge_delay(self) -> float:
+        """مدة الانتظار قبل إرسال الطلب المتحوط (p95 الملاحظ)"""
+        p95 = self.latency.percentile(95) if len(self.latency) >= self.min_samples else None
+        return p95 if p95 is not None else self.minimum
+
+
+def is_retryable(error: Exception) -> bool:
+    """أخطاء الشبكة و 5xx و 429 قابلة لإعادة المحاولة، أما 4xx فلا"""
+    if isinstance(error, httpx.HTTPStatusError):
+        code = error.response.status_code
+        return code >= 500 or code == 429
+    return isinstance(error, httpx.TransportError)
+
+
+class GatewayResilience:
+    """طبقة المرونة المشتركة لجميع استدعاءات بوابة الدفع"""
+
+    def __init__(self):
+        max_timeout = float(os.getenv("MYFATOORAH_TIMEOUT", "30"))
+        self.min_timeout = float(os.getenv("MYFATOORAH_MIN_TIMEOUT", "2"))
+        self.max_timeout = max_timeout
+        self.retry_policy = RetryPolicy(
+            max_attempts=int(os.getenv("MYFATOORAH_RETRY_ATTEMPTS", "3")),
+            base_delay=float(os.getenv("MYFATOORAH_RETRY_BASE_DELAY", "0.2")),
+            max_delay=float(os.getenv("MYFATOORAH_RETRY_MAX_DELAY", "2")),
+        )
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("MYFATOORAH_BREAKER_THRESHOLD", "5")),
+            recovery_timeout=float(os.getenv("MYFATOORAH_BREAKER_RECOVERY", "30")),
+        )
+        self.hedging_enabled = os.getenv("MYFATOORAH_HEDGE_VERIFY", "false").lower() == "true"
+        self.timeouts: Dict[str, AdaptiveTimeout] = {}
+
+    def timeout_for(self, operation: str) -> AdaptiveTimeout:
+        if operation not in self.timeouts:
+            self.timeouts[operation] = AdaptiveTimeout(
+                default=self.max_timeout, minimum=self.min_timeout, maximum=self.max_timeout
+            )
+        return self.timeouts[operation]
+
+    async def _attempt(self, operation: str, func: Callable[[float], Awaitable[Any]],
+                       idempotent: bool = True) -> Any:
+        """
+        محاولة واحدة عبر قاطع الدائرة مع تسجيل زمن الاستجابة. العمليات غير الآمنة للتكرار (الدفع
+        والاسترداد) تأخذ المهلة الكاملة: المهلة القصيرة تحول النجاح البطيء إلى نتيجة مجهولة لا تُعاد.
+        """
+        if not self.breaker.allow_request():
+            raise CircuitOpenError(operation)
+
+        adaptive = self.timeout_for(operation)
+        started = time.monotonic()
+        recorded = False
+        try:
+            result = await func(adaptive.current() if idempotent else self.max_timeout)
+            adaptive.latency.record(time.monotonic() - started)
+            self.breaker.record_success()
+            recorded = True
+            return result
+        except Exception as e:
+            adaptive.latency.record(time.monotonic() - started, error=True)
+            if is_retryable(e):
+                self.breaker.record_failure()
+                recorded = True
+            elif isinstance(e, httpx.HTTPStatusError):
+                # أخطاء العميل (4xx) تعني أن البوابة أجابت، فلا تدل على تدهورها
+                self.breaker.record_success()
+                recorded = True
+            raise
+        finally:
+            # أي نتيجة أخرى (استثناء غير HTTP أو إلغاء) تحرر خانة التجربة كي لا يبقى القاطع نصف مفتوح
+            if not recorded:
+                self.breaker.release()
+
+    async def _hedged_attempt(self, operation: str, func: Callable[[float], Awaitable[Any]]) -> Any:
+        """إرسال طلب ثانٍ إذا تأخر الأول أكثر من p95 واعتماد أول نتيجة ناجحة"""
+        primary = asyncio.ensure_future(self._attempt(operation, func))
+        done, _ = await asyncio.wait({primary}, timeout=self.timeout_for(operation).hedge_delay())
+        if done:
+            return primary.result()
+
+        hedge = asyncio.ensure_future(self._attempt(operation, func))
+        pending = {primary, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def call(
+        self,
+        operation: str,
+        func: Callable[[float], Awaitable[Any]],
+        idempotent: bool = False,
+        hedge: bool = False,
+    ) -> Any:
+        """
+        تنفيذ استدعاء للبوابة. func تستقبل المهلة الحالية بالثواني.
+        إعادة المحاولة والتحوط للعمليات الآمنة التكرار (idempotent) فقط.
+        """
+        attempts = self.retry_policy.max_attempts if idempotent else 1
+        use_hedge = idempotent and hedge and self.hedging_enabled
+
+        for attempt in range(attempts):
+            try:
+                if use_hedge:
+                    return await self._hedged_attempt(operation, func)
+                return await self._attempt(operation, func, idempotent=idempotent)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                if attempt + 1 >= attempts or not is_retryable(e):
+                    raise
+                delay = self.retry_policy.delay(attempt)
+                logger.warning(f"Retrying MyFatoorah {operation} in {delay:.2f}s after error: {e}")
+                await asyncio.sleep(delay)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """حالة قاطع الدائرة وزمن الاستجابة لكل عملية"""
+        return {
+            "circuit_breaker": self.breaker.snapshot(),
+            "hedging_enabled": self.hedging_enabled,
+            "operations": {
+                name: {
+                    "timeout_seconds": round(adaptive.current(), 3),
+                    "latency": adaptive.latency.snapshot(),
+                }
+                for name, adaptive in self.timeouts.items()
+            },
+        }
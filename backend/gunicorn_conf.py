@@ -0,0 +1,43 @@
+"""
+إعداد التشغيل بعدة عمليات - Gunicorn Configuration
+gunicorn -c gunicorn_conf.py server:app
+
+WEB_CONCURRENCY: عدد العمليات (الافتراضي عدد المعالجات المتاحة)
+WORKER_CPU_AFFINITY: تثبيت العمليات على المعالجات: "auto" (معالج لكل عملية بالتناوب)،
+أو قائمة مثل "0,1,2,3"، أو فارغ لعدم التثبيت
+SHARED_STATE_BACKEND: يجب أن يكون sqlite أو redis لتُشارك الذاكرة المؤقتة وأحداث الإبطال بين العمليات
+"""
+
+import os
+
+available_cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+
+bind = os.getenv("BIND", "0.0.0.0:8001")
+workers = int(os.getenv("WEB_CONCURRENCY", str(len(available_cpus))))
+worker_class = "uvicorn.workers.UvicornWorker"
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("KEEPALIVE", "5"))
+
+
+def _affinity_cpus():
+    setting = os.getenv("WORKER_CPU_AFFINITY", "").strip().lower()
+    if not setting:
+        return []
+    if setting == "auto":
+        return available_cpus
+    return [int(cpu) for cpu in setting.split(",") if cpu.strip()]
+
+
+def post_fork(server, worker):
+    """تثبيت كل عملية على معالج واحد بالتناوب حسب ترتيب إنشائها"""
+    cpus = _affinity_cpus()
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return
+    cpu = cpus[worker.age % len(cpus)]
+    os.sched_setaffinity(0, {cpu})
+    server.log.info(f"Worker {worker.pid} pinned to CPU {cpu}")
+
+
+def on_starting(server):
+    if workers > 1 and os.getenv("SHARED_STATE_BACKEND", "memory").lower() == "memory":
+        server.log.warning("SHARED_STATE_BACKEND=memory: caches and invalidation are per worker")
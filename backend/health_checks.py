@@ -0,0 +1,198 @@
+"""
+فحوصات الصحة - Health Checks
+فحوصات الاعتماديات (MongoDB، تأخر النسخ المتماثل، بوابة الدفع) تُنفذ دورياً في الخلفية
+وتُخزن نتائجها، فلا تكلف نقاط /live و /ready و /health/details أي استدعاء خارجي.
+"""
+
+import asyncio
+import inspect
+import os
+import time
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, Union
+
+from metrics import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+ProbeResult = Optional[Dict[str, Any]]
+
+
+class DependencyProbe:
+    """فحص اعتمادية واحدة ونتيجته الأخيرة"""
+
+    def __init__(self, name: str, func: Callable[[], Union[ProbeResult, Awaitable[ProbeResult]]],
+                 critical: bool, timeout: float):
+        self.name = name
+        self.func = func
+        self.critical = critical
+        self.timeout = timeout
+        self.latency = LatencyTracker(window=256)
+        self.healthy: Optional[bool] = None
+        self.details: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self.last_success: Optional[datetime] = None
+        self.consecutive_failures = 0
+
+    async def run(self) -> None:
+        started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(self.func):
+                result = await asyncio.wait_for(self.func(), timeout=self.timeout)
+            else:
+                result = await asyncio.wait_for(asyncio.to_thread(self.func), timeout=self.timeout)
+        except Exception as e:
+            self.latency.record(time.perf_counter() - started, error=True)
+            self.healthy = False
+            self.error = str(e) or type(e).__name__
+            self.consecutive_failures += 1
+            if self.consecutive_failures == 1:
+                logger.warning(f"فشل فحص {self.name}: {self.error}")
+        else:
+            self.latency.record(time.perf_counter() - started)
+            self.healthy = True
+            self.details = result or {}
+            self.error = None
+            self.consecutive_failures = 0
+            self.last_success = datetime.now()
+        finally:
+            self.checked_at = time.monotonic()
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "status": "unknown" if self.healthy is None else ("healthy" if self.healthy else "unhealthy"),
+            "critical": self.critical,
+            "details": self.details,
+            "error": self.error,
+            "consecutive_failures": self.consecutive_failures,
+            "last_success": self.last_success,
+            "checked_seconds_ago": round(time.monotonic() - self.checked_at, 2) if self.checked_at else None,
+            "latency": self.latency.snapshot(),
+        }
+
+
+class HealthMonitor:
+    """
+    يشغل الفحوصات المسجلة معاً كل interval ثانية.
+    الجاهزية تتطلب نجاح آخر فحص لكل اعتمادية حرجة وألا تكون نتيجته قديمة.
+    """
+
+    def __init__(self):
+        self.interval = float(os.getenv("HEALTH_PROBE_INTERVAL", "5"))
+        self.timeout = float(os.getenv("HEALTH_PROBE_TIMEOUT", "3"))
+        # نتيجة أقدم من هذا تعتبر غير صالحة (مثلاً توقف حلقة الفحص)
+        self.stale_after = float(os.getenv("HEALTH_PROBE_STALE_AFTER", str(self.interval * 3)))
+        self.probes: Dict[str, DependencyProbe] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, func: Callable[[], Any], critical: bool = True,
+                 timeout: Optional[float] = None) -> None:
+        """تسجيل فحص؛ الدوال المتزامنة (pymongo) تُنفذ في خيط منفصل"""
+        self.probes[name] = DependencyProbe(name, func, critical, timeout or self.timeout)
+
+    async def run_once(self) -> None:
+        await asyncio.gather(*(probe.run() for probe in self.probes.values()))
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"خطأ في حلقة فحوصات الصحة: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _fresh(self, probe: DependencyProbe) -> bool:
+        return probe.checked_at is not None and time.monotonic() - probe.checked_at <= self.stale_after
+
+    @property
+    def healthy(self) -> bool:
+        """نجاح آخر فحص حديث لكل اعتمادية حرجة"""
+        return all(probe.healthy and self._fresh(probe) for probe in self.probes.values() if probe.critical)
+
+    @property
+    def degraded(self) -> bool:
+        """اعتمادية غير حرجة معطلة (الخدمة تعمل بوظائف ناقصة)"""
+        return any(probe.healthy is False for probe in self.probes.values() if not probe.critical)
+
+    def probe_status(self, name: str) -> Optional[bool]:
+        probe = self.probes.get(name)
+        return probe.healthy if probe else None
+
+    def report(self) -> Dict[str, Any]:
+        if not self.healthy:
+            overall = "unhealthy"
+        elif self.degraded:
+            overall = "degraded"
+        else:
+            overall = "healthy"
+        return {
+            "status": overall,
+            "probe_interval_seconds": self.interval,
+            "dependencies": {name: probe.report() for name, probe in self.probes.items()},
+        }
+
+
+def mongo_primary_probe(client) -> Callable[[], Dict[str, Any]]:
+    """فحص وجود خادم أساسي قابل للكتابة"""
+
+    def probe() -> Dict[str, Any]:
+        hello = client.admin.command("hello")
+        if not hello.get("isWritablePrimary", hello.get("ismaster", False)):
+            raise RuntimeError("لا يوجد خادم أساسي قابل للكتابة")
+        return {"set_name": hello.get("setName"), "primary": hello.get("primary")}
+
+    return probe
+
+
+def replication_lag_probe(client, max_lag_seconds: float) -> Callable[[], Dict[str, Any]]:
+    """فحص تأخر الأعضاء الثانويين عن الأساسي (يُتجاوز إذا لم تكن مجموعة نسخ متماثل)"""
+
+    def probe() -> Dict[str, Any]:
+        hello = client.admin.command("hello")
+        if not hello.get("setName"):
+            return {"replica_set": False}
+
+        status = client.admin.command("replSetGetStatus")
+        members = status.get("members", [])
+        primary = next((m for m in members if m.get("stateStr") == "PRIMARY"), None)
+        if primary is None:
+            raise RuntimeError("لا يوجد عضو أساسي في مجموعة النسخ المتماثل")
+
+        lags = {
+            m["name"]: (primary["optimeDate"] - m["optimeDate"]).total_seconds()
+            for m in members
+            if m.get("stateStr") == "SECONDARY" and m.get("optimeDate")
+        }
+        max_lag = max(lags.values(), default=0.0)
+        if max_lag > max_lag_seconds:
+            raise RuntimeError(f"تأخر النسخ المتماثل {max_lag:.1f} ثانية يتجاوز الحد {max_lag_seconds}")
+        return {"replica_set": True, "secondaries": len(lags), "max_lag_seconds": max_lag}
+
+    return probe
+
+
+def gateway_probe(service) -> Callable[[], Awaitable[Dict[str, Any]]]:
+    """فحص الوصول لبوابة الدفع عبر العميل المشترك، مع حالة قاطع الدائرة"""
+
+    async def probe() -> Dict[str, Any]:
+        status_code = await service.probe()
+        if status_code >= 500:
+            raise RuntimeError(f"البوابة ترد بالحالة {status_code}")
+        return {"http_status": status_code, "circuit_breaker": service.get_metrics()["circuit_breaker"]}
+
+    return probe
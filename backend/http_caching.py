@@ -0,0 +1,321 @@
+"""
+ضغط الاستجابات والطلبات الشرطية - Compression & Conditional GET
+ضغط gzip/brotli حسب الحجم، و ETag مبني على عدادات إصدار المجموعات مع الرد بـ 304 قبل أي عمل على قاعدة البيانات
+"""
+
+import gzip
+import hashlib
+import os
+import re
+import threading
+import uuid
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import brotli
+except ImportError:  # مدرج في requirements.txt؛ بدونه يُستخدم gzip فقط
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# المجموعات المكتوبة داخل معاملة جارية (ترفع عداداتها بعد انتهائها)
+_deferred_bumps: ContextVar[Optional[set]] = ContextVar("deferred_bumps", default=None)
+
+
+class CollectionVersions:
+    """
+    عدادات إصدار لكل مجموعة تزداد مع كل كتابة.
+    بعد share() تصبح العدادات والمعرف مشتركة بين العمليات عبر الحالة المشتركة،
+    فتتطابق الوسوم بين العمليات وتصل الزيادات لها عبر apply().
+    """
+
+    KEY_PREFIX = "collection_versions:"
+
+    def __init__(self):
+        # معرف العملية يمنع تطابق وسوم عمليات مختلفة تحمل نفس أرقام العدادات
+        self.epoch = uuid.uuid4().hex[:8]
+        self.backend = None
+        self._versions: Dict[str, int] = {}
+        self._listeners: List[Callable[[str, int], None]] = []
+        self._lock = threading.Lock()
+
+    def share(self, backend, names: Iterable[str]) -> None:
+        """استخدام عدادات ومعرف مشتركين (استدعاء واحد عند بدء التشغيل)"""
+        self.epoch = backend.add(self.KEY_PREFIX + "epoch", self.epoch)
+        for name in names:
+            value = backend.get(self.KEY_PREFIX + name)
+            if value is not None:
+                self.apply(name, int(value))
+        self.backend = backend
+
+    def add_listener(self, listener: Callable[[str, int], None]) -> None:
+        """مستمع يُستدعى بعد كل زيادة محلية (مثلاً لنشرها لباقي العمليات)"""
+        self._listeners.append(listener)
+
+    @contextmanager
+    def deferred(self):
+        """
+        تأجيل الزيادات حتى الخروج من الكتلة (حول معاملة MongoDB): زيادة قبل الالتزام تسمح لطلب متزامن
+        بقراءة الحالة القديمة وتخزينها بالوسم الجديد. تُرفع العدادات عند الخروج حتى مع الاستثناء.
+        """
+        names: set = set()
+        token = _deferred_bumps.set(names)
+        try:
+            yield
+        finally:
+            _deferred_bumps.reset(token)
+            for name in sorted(names):
+                self.bump(name)
+
+    def bump(self, name: str) -> None:
+        deferred = _deferred_bumps.get()
+        if deferred is not None:
+            deferred.add(name)
+            return
+        if self.backend is not None:
+            version = self.backend.incr(self.KEY_PREFIX + name)
+            self.apply(name, version)
+        else:
+            with self._lock:
+                version = self._versions.get(name, 0) + 1
+                self._versions[name] = version
+        for listener in self._listeners:
+            listener(name, version)
+
+    def apply(self, name: str, version: int) -> None:
+        """تطبيق إصدار وارد من عملية أخرى (لا يرجع العداد للخلف)"""
+        with self._lock:
+            if version > self._versions.get(name, 0):
+                self._versions[name] = version
+
+    def get(self, names: Iterable[str]) -> Tuple[int, ...]:
+        return tuple(self._versions.get(name, 0) for name in names)
+
+
+collection_versions = CollectionVersions()
+
+
+class VersionedCollection:
+    """غلاف لمجموعة pymongo يرفع عداد الإصدار بعد كل عملية كتابة (أو بعد المعاملة ضمن deferred)"""
+
+    WRITE_METHODS = {
+        "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+        "delete_one", "delete_many", "bulk_write", "find_one_and_update",
+        "find_one_and_replace", "find_one_and_delete",
+    }
+
+    def __init__(self, collection, versions: CollectionVersions = collection_versions):
+        self._collection = collection
+        self._versions = versions
+
+    def __getattr__(self, name):
+        attribute = getattr(self._collection, name)
+        if name not in self.WRITE_METHODS:
+            return attribute
+
+        def write(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            self._versions.bump(self._collection.name)
+            return result
+
+        return write
+
+    def __getitem__(self, name):
+        return self._collection[name]
+
+    def __repr__(self):
+        return f"VersionedCollection({self._collection.name!r})"
+
+
+class CacheRule:
+    """قاعدة ETag لمسار: المجموعات التي تعتمد عليها الاستجابة، وهل تختلف حسب المستخدم أو اليوم"""
+
+    def __init__(self, pattern: str, collections: Sequence[str], per_user: bool = False, daily: bool = False):
+        self.pattern = re.compile(pattern)
+        self.collections = tuple(collections)
+        self.per_user = per_user
+        self.daily = daily
+
+
+# المسارات القابلة للتخزين الشرطي والمجموعات التي تعتمد عليها
+CACHE_RULES: List[CacheRule] = [
+    CacheRule(r"^/api/lawyers$", ["lawyers"]),
+    CacheRule(r"^/api/search/lawyers$", ["lawyers"]),
+    CacheRule(r"^/api/lawyers/[^/]+$", ["lawyers"]),
+    CacheRule(r"^/api/lawyers/[^/]+/appointments$", ["appointments"]),
+    CacheRule(r"^/api/lawyers/[^/]+/consultations$", ["consultations"]),
+    CacheRule(r"^/api/lawyers/[^/]+/stats$", ["appointments", "consultations", "lawyers"]),
+    CacheRule(r"^/api/lawyers/[^/]+/availability$", ["lawyers", "appointments"], daily=True),
+    CacheRule(r"^/api/appointments$", ["appointments"]),
+    CacheRule(r"^/api/consultations/[^/]+$", ["consultations"]),
+    CacheRule(r"^/api/reviews/lawyer/[^/]+$", ["reviews", "users"]),
+    CacheRule(r"^/api/payments/history/[^/]+$", ["payments"]),
+    CacheRule(r"^/api/stats$", ["lawyers", "appointments", "consultations"]),
+    CacheRule(r"^/api/lawyer/(stats|dashboard)$",
+              ["appointments", "payments", "reviews", "consultations", "revenue_rollups"], per_user=True, daily=True),
+    CacheRule(r"^/api/client/(stats|dashboard)$",
+              ["appointments", "payments", "lawyers"], per_user=True, daily=True),
+]
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """مقارنة ضعيفة كما يتطلب If-None-Match (تجاهل البادئة W/)"""
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+
+class ConditionalGetMiddleware:
+    """
+    ETag قوي من عدادات إصدار المجموعات. إذا طابق If-None-Match يُرد بـ 304
+    مباشرة دون استدعاء نقطة النهاية (ودون أي استعلام لقاعدة البيانات).
+    """
+
+    def __init__(self, app, versions: CollectionVersions = collection_versions,
+                 rules: Sequence[CacheRule] = CACHE_RULES):
+        self.app = app
+        self.versions = versions
+        self.rules = rules
+        self.enabled = os.getenv("ETAG_ENABLED", "true").lower() == "true"
+
+    def _rule_for(self, path: str) -> Optional[CacheRule]:
+        for rule in self.rules:
+            if rule.pattern.match(path):
+                return rule
+        return None
+
+    def _etag(self, scope, rule: CacheRule) -> str:
+        parts = [
+            getattr(self.versions, "epoch", ""),
+            scope["path"],
+            scope.get("query_string", b"").decode("latin-1"),
+            ",".join(map(str, self.versions.get(rule.collections))),
+        ]
+        if rule.per_user:
+            parts.append(_header(scope, b"authorization") or "")
+        if rule.daily:
+            parts.append(date.today().isoformat())
+        return '"' + hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest() + '"'
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or scope["method"] not in ("GET", "HEAD"):
+            await self.app(scope, receive, send)
+            return
+
+        rule = self._rule_for(scope["path"])
+        if rule is None:
+            await self.app(scope, receive, send)
+            return
+
+        etag = self._etag(scope, rule)
+        if_none_match = _header(scope, b"if-none-match")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            await send({
+                "type": "http.response.start",
+                "status": 304,
+                "headers": [(b"etag", etag.encode()), (b"cache-control", b"private, no-cache")],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_etag(message):
+            if message["type"] == "http.response.start" and message["status"] == 200:
+                headers = [(k, v) for k, v in message.get("headers", []) if k not in (b"etag", b"cache-control")]
+                headers.append((b"etag", etag.encode()))
+                headers.append((b"cache-control", b"private, no-cache"))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
+
+
+class CompressionMiddleware:
+    """
+    ضغط استجابات JSON/النصوص الكاملة (غير المتدفقة) بـ brotli إن توفر وطلبه العميل وإلا gzip،
+    عندما يتجاوز الحجم الحد الأدنى. عند الضغط يتحول ETag إلى وسم ضعيف لأن التمثيل تغيّر.
+    """
+
+    COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+    def __init__(self, app):
+        self.app = app
+        self.enabled = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+        self.minimum_size = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+        self.gzip_level = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+        self.brotli_quality = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+    def _choose_encoding(self, scope) -> Optional[str]:
+        accept = (_header(scope, b"accept-encoding") or "").lower()
+        if brotli is not None and "br" in accept:
+            return "br"
+        if "gzip" in accept:
+            return "gzip"
+        return None
+
+    def _compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = self._choose_encoding(scope)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        passthrough = False
+
+        async def send_compressed(message):
+            nonlocal start_message, passthrough
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            headers = start_message.get("headers", [])
+            content_type = next((v.decode("latin-1") for k, v in headers if k == b"content-type"), "")
+            already_encoded = any(k == b"content-encoding" for k, _ in headers)
+            body = message.get("body", b"")
+
+            if (message.get("more_body") or already_encoded or len(body) < self.minimum_size
+                    or not content_type.startswith(self.COMPRESSIBLE_TYPES)):
+                # استجابة متدفقة أو صغيرة أو مضغوطة مسبقاً: تمرير كما هي
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            compressed = self._compress(body, encoding)
+            new_headers = []
+            for key, value in headers:
+                if key == b"content-length":
+                    continue
+                if key == b"etag" and not value.startswith(b"W/"):
+                    value = b"W/" + value
+                new_headers.append((key, value))
+            new_headers.append((b"content-encoding", encoding.encode()))
+            new_headers.append((b"content-length", str(len(compressed)).encode()))
+            new_headers.append((b"vary", b"Accept-Encoding"))
+            await send({**start_message, "headers": new_headers})
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
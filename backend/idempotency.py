@@ -0,0 +1,181 @@
+"""
+مفاتيح عدم التكرار - Idempotency Keys
+الطلب الذي يحمل ترويسة Idempotency-Key يُنفذ مرة واحدة: تُحفظ بصمته واستجابته المسلسلة
+في مجموعة بفهرس TTL مع ذاكرة أمامية داخل العملية، وتُعاد الاستجابة نفسها للمحاولات المكررة
+دون إعادة العمل. المحاولات المتزامنة تنتظر التنفيذ الأول.
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+from pymongo.errors import DuplicateKeyError
+
+from caching import TTLCache, SingleFlight
+from json_response import dumps
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAY_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+IN_PROGRESS, COMPLETED = "in_progress", "completed"
+
+
+def fingerprint(payload: Any) -> str:
+    """بصمة جسم الطلب (JSON بمفاتيح مرتبة) لرفض إعادة استخدام المفتاح مع طلب مختلف"""
+    canonical = dumps(payload, sort_keys=True)
+    return hashlib.sha256(canonical).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    المفتاح محجوز بإدراج سجل in_progress (_id فريد)؛ من ينجح في الإدراج ينفذ الطلب ثم يحفظ
+    الاستجابة. داخل العملية تُدمج المحاولات المتزامنة بـ SingleFlight، وبين العمليات ينتظر
+    من فشل إدراجه اكتمال السجل. الحجز المنتهي (عملية توقفت أثناء التنفيذ) يُستولى عليه.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.ttl = timedelta(hours=float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+        self.lock_seconds = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+        self.wait_seconds = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+        self.poll_interval = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.1"))
+        self.cache = TTLCache(
+            ttl=float(os.getenv("IDEMPOTENCY_CACHE_TTL", "300")),
+            max_size=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000")),
+        )
+        self.flight = SingleFlight()
+        self.replayed = 0
+        self.executed = 0
+
+    def ensure_indexes(self):
+        self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def run(self, key: Optional[str], scope: str, payload: Any,
+                  func: Callable[[], Awaitable[Any]], status_code: int = 200) -> Any:
+        """
+        تنفيذ func مرة واحدة لكل (scope, key). بدون مفتاح تُنفذ func مباشرة كما هي.
+        النتائج وأخطاء HTTPException أقل من 500 تُحفظ وتُعاد؛ أخطاء الخادم تحرر المفتاح لإعادة المحاولة.
+        """
+        if not key:
+            return await func()
+        if len(key) > MAX_KEY_LENGTH:
+            raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} أطول من {MAX_KEY_LENGTH} حرفاً")
+
+        record_id = f"{scope}:{key}"
+        request_fingerprint = fingerprint(payload)
+        record = self.cache.get(record_id)
+        replayed = record is not None
+        if record is None:
+            leader = False
+
+            async def execute():
+                nonlocal leader
+                leader = True
+                return await self._execute(record_id, request_fingerprint, func, status_code)
+
+            record, replayed = await self.flight.do(record_id, execute)
+            # المحاولات المتزامنة المدموجة تأخذ نتيجة الطلب الأول كإعادة
+            replayed = replayed or not leader
+        if record["fingerprint"] != request_fingerprint:
+            raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} مستخدم لطلب مختلف")
+        if replayed:
+            self.replayed += 1
+        return Response(
+            content=record["body"],
+            status_code=record["status_code"],
+            media_type="application/json",
+            headers={REPLAY_HEADER: "true"} if replayed else None,
+        )
+
+    async def _execute(self, record_id: str, request_fingerprint: str,
+                       func: Callable[[], Awaitable[Any]], status_code: int):
+        """(السجل المكتمل، هل هو إعادة) بعد التنفيذ هنا أو انتظار تنفيذ عملية أخرى"""
+        existing = await asyncio.to_thread(self._reserve, record_id, request_fingerprint)
+        if existing is None:
+            return await self._perform(record_id, request_fingerprint, func, status_code)
+        if existing.get("status") == COMPLETED:
+            self.cache.set(record_id, existing)
+            return existing, True
+        return await self._wait(record_id, request_fingerprint, func, status_code)
+
+    async def _perform(self, record_id: str, request_fingerprint: str,
+                       func: Callable[[], Awaitable[Any]], status_code: int):
+        """تنفيذ الطلب بعد حجز المفتاح وحفظ استجابته بنفس تسلسل FastJSONResponse"""
+        try:
+            result = await func()
+            record = {"status_code": status_code, "body": dumps(result)}
+        except HTTPException as e:
+            if e.status_code >= 500:
+                await asyncio.to_thread(self.collection.delete_one, {"_id": record_id, "status": IN_PROGRESS})
+                raise
+            record = {"status_code": e.status_code, "body": dumps({"detail": e.detail})}
+        except BaseException:
+            await asyncio.to_thread(self.collection.delete_one, {"_id": record_id, "status": IN_PROGRESS})
+            raise
+
+        record.update(fingerprint=request_fingerprint, status=COMPLETED)
+        await asyncio.to_thread(
+            self.collection.update_one,
+            {"_id": record_id},
+            {"$set": {**record, "expires_at": datetime.now() + self.ttl}, "$unset": {"locked_until": ""}}
+        )
+        self.cache.set(record_id, record)
+        self.executed += 1
+        return record, False
+
+    def _reserve(self, record_id: str, request_fingerprint: str) -> Optional[Dict[str, Any]]:
+        """حجز المفتاح؛ يعيد None عند النجاح أو السجل القائم إذا سبقنا طلب آخر"""
+        now = datetime.now()
+        reservation = {
+            "fingerprint": request_fingerprint,
+            "status": IN_PROGRESS,
+            "locked_until": now + timedelta(seconds=self.lock_seconds),
+            "created_at": now,
+            "expires_at": now + self.ttl,
+        }
+        try:
+            self.collection.insert_one({"_id": record_id, **reservation})
+            return None
+        except DuplicateKeyError:
+            # حُذف الحجز بين الإدراج والقراءة (فشل التنفيذ الأول): الانتظار يعيد المحاولة
+            return self.collection.find_one({"_id": record_id}) or {"status": IN_PROGRESS}
+
+    def _take_over(self, record_id: str, request_fingerprint: str) -> bool:
+        """الاستيلاء على حجز انتهت مهلته (العملية المنفذة توقفت)"""
+        now = datetime.now()
+        taken = self.collection.update_one(
+            {"_id": record_id, "status": IN_PROGRESS, "locked_until": {"$lt": now}},
+            {"$set": {"fingerprint": request_fingerprint,
+                      "locked_until": now + timedelta(seconds=self.lock_seconds)}}
+        )
+        return taken.modified_count == 1
+
+    async def _wait(self, record_id: str, request_fingerprint: str,
+                    func: Callable[[], Awaitable[Any]], status_code: int):
+        """انتظار اكتمال التنفيذ في عملية أخرى، أو تولي التنفيذ إذا انتهى حجزها"""
+        deadline = time.monotonic() + self.wait_seconds
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            existing = await asyncio.to_thread(self.collection.find_one, {"_id": record_id})
+            if existing is None:
+                return await self._execute(record_id, request_fingerprint, func, status_code)
+            if existing.get("status") == COMPLETED:
+                self.cache.set(record_id, existing)
+                return existing, True
+            if existing.get("locked_until") and existing["locked_until"] < datetime.now():
+                if await asyncio.to_thread(self._take_over, record_id, request_fingerprint):
+                    logger.warning(f"Idempotency key {record_id}: taking over an expired reservation")
+                    return await self._perform(record_id, request_fingerprint, func, status_code)
+        raise HTTPException(status_code=409, detail="طلب بنفس مفتاح عدم التكرار قيد التنفيذ، أعد المحاولة لاحقاً")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {"executed": self.executed, "replayed": self.replayed, "in_flight": self.flight.in_flight()}
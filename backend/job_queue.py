@@ -0,0 +1,309 @@
+"""
+طابور المهام الخلفية - Job Queue
+مهام دائمة في مجموعة MongoDB تُحجز ذرياً بـ find_one_and_update مع مهلة رؤية، وتُعاد
+المحاولة بتأخير متزايد، وتنفذها مجموعة عمال غير متزامنين بحسب الأولوية.
+"""
+
+import os
+import uuid
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from metrics import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+JobHandler = Callable[[Dict[str, Any]], Awaitable[Optional[Dict[str, Any]]]]
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+# الحقول الداخلية التي لا تظهر في حالة المهمة المعروضة
+_INTERNAL_FIELDS = ("lease", "dedupe_key")
+
+
+class JobError(Exception):
+    """فشل المهمة برسالة تُحفظ في حالتها (يُعاد المحاولة حسب max_attempts)"""
+
+
+class JobQueue:
+    """
+    الحجز: find_one_and_update يحول أعلى مهمة مستحقة أولوية من queued إلى running مع رمز حجز
+    ووقت انتهاء للحجز؛ المهمة التي تجاوزت مهلة الرؤية (عامل توقف) تعود للطابور أو تفشل
+    إذا استنفدت محاولاتها. إتمام المهمة مشروط برمز الحجز.
+    """
+
+    def __init__(self, jobs_collection):
+        self.jobs = jobs_collection
+        self.handlers: Dict[str, Dict[str, Any]] = {}
+        self.workers = int(os.getenv("JOB_WORKERS", "4"))
+        self.visibility_timeout = float(os.getenv("JOB_VISIBILITY_TIMEOUT", "60"))
+        self.interval = float(os.getenv("JOB_POLL_INTERVAL", "2"))
+        self.max_attempts = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+        self.backoff_base = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+        self.backoff_max = float(os.getenv("JOB_RETRY_MAX_SECONDS", "300"))
+        self.retention_days = int(os.getenv("JOB_RETENTION_DAYS", "7"))
+        self._tasks: List[asyncio.Task] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.wait_latency: Dict[str, LatencyTracker] = {}
+        self.run_latency: Dict[str, LatencyTracker] = {}
+
+    def register(self, job_type: str, handler: JobHandler, max_attempts: Optional[int] = None,
+                 timeout: Optional[float] = None):
+        """
+        تسجيل معالج لنوع مهمة (يستقبل payload ويعيد نتيجة اختيارية تُحفظ مع المهمة).
+        max_attempts=1 للمهام غير الآمنة للتكرار: الحجز المنتهي يفشلها بدلاً من إعادة تنفيذها.
+        المهمة التي قد تتجاوز مهلة الرؤية تحدد timeout أطول؛ حجزها يُمدد دورياً طوال تنفيذها.
+        """
+        self.handlers[job_type] = {
+            "handler": handler,
+            "max_attempts": max_attempts or self.max_attempts,
+            "timeout": timeout or self.visibility_timeout,
+        }
+        self.counters[job_type] = {"completed": 0, "retried": 0, "failed": 0}
+        self.wait_latency[job_type] = LatencyTracker()
+        self.run_latency[job_type] = LatencyTracker()
+
+    def ensure_indexes(self):
+        # مطابقة على الحالة ثم ترتيب الأولوية ثم نطاق run_at
+        self.jobs.create_index([("status", ASCENDING), ("priority", DESCENDING), ("run_at", ASCENDING)])
+        self.jobs.create_index([("status", ASCENDING), ("lease_expires_at", ASCENDING)])
+        self.jobs.create_index("finished_at", expireAfterSeconds=self.retention_days * 86400)
+        # مهمة واحدة في الانتظار لكل مفتاح دمج (الفهرس الفريد أخيراً: فشله لا يمنع الفهارس الأخرى)
+        self.jobs.create_index(
+            "dedupe_key", unique=True, partialFilterExpression={"status": QUEUED, "dedupe_key": {"$exists": True}}
+        )
+
+    # ---- الإضافة ----
+
+    def enqueue(self, job_type: str, payload: Dict[str, Any], priority: int = 0, delay: float = 0,
+                job_id: Optional[str] = None, dedupe_key: Optional[str] = None) -> str:
+        """
+        إضافة مهمة وإرجاع معرفها (كتابة واحدة). مع dedupe_key تُدمج المهمة في مهمة منتظرة بنفس
+        المفتاح إن وجدت (مثل إعادة حساب تقييم نفس المحامي)، ويُعاد معرف المهمة القائمة.
+        """
+        spec = self.handlers.get(job_type)
+        if spec is None:
+            raise ValueError(f"no handler registered for job type {job_type}")
+        now = datetime.now()
+        job = {
+            "_id": job_id or str(uuid.uuid4()),
+            "type": job_type,
+            "payload": payload,
+            "priority": priority,
+            "status": QUEUED,
+            "attempts": 0,
+            "max_attempts": spec["max_attempts"],
+            "run_at": now + timedelta(seconds=delay),
+            "enqueued_at": now,
+        }
+        if dedupe_key is None:
+            self.jobs.insert_one(job)
+        else:
+            try:
+                job = self.jobs.find_one_and_update(
+                    {"dedupe_key": dedupe_key, "status": QUEUED},
+                    {"$setOnInsert": {**job, "dedupe_key": dedupe_key}},
+                    projection={"_id": 1},
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER,
+                )
+            except DuplicateKeyError:
+                # إضافة متزامنة بنفس المفتاح سبقتنا: المهمة المنتظرة ستغطي هذا الطلب
+                job = self.jobs.find_one({"dedupe_key": dedupe_key, "status": QUEUED}, {"_id": 1}) or job
+        self.notify()
+        return job["_id"]
+
+    def notify(self):
+        """إيقاظ العمال فوراً (آمن من أي خيط)"""
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """حالة المهمة ونتيجتها"""
+        job = self.jobs.find_one({"_id": job_id}, {field: 0 for field in _INTERNAL_FIELDS})
+        if job is not None:
+            job["id"] = job.pop("_id")
+        return job
+
+    def update_progress(self, job_id: str, progress: Dict[str, Any]):
+        """تقدم مهمة طويلة أثناء تنفيذها (يظهر في حالتها)"""
+        self.jobs.update_one({"_id": job_id, "status": RUNNING}, {"$set": {"progress": progress}})
+
+    # ---- الحجز والإتمام ----
+
+    def _lease(self) -> Optional[Dict[str, Any]]:
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {"status": QUEUED, "run_at": {"$lte": now}, "type": {"$in": list(self.handlers)}},
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "lease": str(uuid.uuid4()),
+                    "lease_expires_at": now + timedelta(seconds=self.visibility_timeout),
+                    "started_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", DESCENDING), ("run_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _extend_lease(self, job: Dict[str, Any]) -> bool:
+        """تمديد حجز مهمة جارية لمهلة رؤية جديدة؛ False إذا فقد العامل حجزها"""
+        return self.jobs.update_one(
+            {"_id": job["_id"], "lease": job["lease"], "status": RUNNING},
+            {"$set": {"lease_expires_at": datetime.now() + timedelta(seconds=self.visibility_timeout)}}
+        ).modified_count == 1
+
+    async def _heartbeat(self, job: Dict[str, Any]):
+        """تمديد الحجز كل ثلث مهلة الرؤية ما دام المعالج يعمل (المهام الأطول من المهلة لا يستعيدها الحاصد)"""
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                if not await asyncio.to_thread(self._extend_lease, job):
+                    logger.warning(f"Job {job['_id']} lost its lease while running")
+                    return
+            except Exception as e:
+                logger.error(f"خطأ في تمديد حجز المهمة {job['_id']}: {e}")
+
+    def _complete(self, job: Dict[str, Any], result: Optional[Dict[str, Any]]):
+        self.jobs.update_one(
+            {"_id": job["_id"], "lease": job["lease"]},
+            {"$set": {"status": DONE, "result": result, "finished_at": datetime.now()},
+             "$unset": {"lease": "", "lease_expires_at": ""}}
+        )
+
+    def _backoff(self, attempts: int) -> float:
+        return min(self.backoff_base * (2 ** max(0, attempts - 1)), self.backoff_max)
+
+    def _fail(self, job: Dict[str, Any], error: str) -> bool:
+        """إعادة المهمة للطابور بتأخير متزايد أو إفشالها نهائياً؛ تعيد True إذا أعيدت"""
+        retry = job["attempts"] < job.get("max_attempts", self.max_attempts)
+        now = datetime.now()
+        update = (
+            {"status": QUEUED, "run_at": now + timedelta(seconds=self._backoff(job["attempts"])), "error": error}
+            if retry else {"status": FAILED, "error": error, "finished_at": now}
+        )
+        self.jobs.update_one(
+            {"_id": job["_id"], "lease": job["lease"]},
+            {"$set": update, "$unset": {"lease": "", "lease_expires_at": ""}}
+        )
+        return retry
+
+    def recover_expired(self) -> int:
+        """
+        المهام التي تجاوزت مهلة الرؤية (عامل توقف أثناء تنفيذها): تعود للطابور إن بقيت لها
+        محاولات، وإلا تفشل. يقرأ المهام الجارية فقط (فهرس status, lease_expires_at).
+        """
+        now = datetime.now()
+        expired = {"status": RUNNING, "lease_expires_at": {"$lt": now}}
+        requeued = self.jobs.update_many(
+            {**expired, "$expr": {"$lt": ["$attempts", "$max_attempts"]}},
+            {"$set": {"status": QUEUED, "run_at": now, "error": "lease expired"},
+             "$unset": {"lease": "", "lease_expires_at": ""}}
+        ).modified_count
+        failed = self.jobs.update_many(
+            expired,
+            {"$set": {"status": FAILED, "error": "lease expired", "finished_at": now},
+             "$unset": {"lease": "", "lease_expires_at": ""}}
+        ).modified_count
+        if requeued or failed:
+            logger.warning(f"Jobs with expired leases: {requeued} requeued, {failed} failed")
+        return requeued + failed
+
+    # ---- العمال ----
+
+    async def run_one(self) -> bool:
+        """حجز مهمة واحدة وتنفيذها؛ تعيد False إذا لم توجد مهمة مستحقة"""
+        job = await asyncio.to_thread(self._lease)
+        if job is None:
+            return False
+        job_type = job["type"]
+        spec = self.handlers[job_type]
+        counters = self.counters[job_type]
+        self.wait_latency[job_type].record(max(0.0, (job["started_at"] - job["run_at"]).total_seconds()))
+        started = datetime.now()
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            result = await asyncio.wait_for(spec["handler"](job["payload"]), timeout=spec["timeout"])
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            self.run_latency[job_type].record((datetime.now() - started).total_seconds(), error=True)
+            if await asyncio.to_thread(self._fail, job, error):
+                counters["retried"] += 1
+                logger.warning(f"Job {job['_id']} ({job_type}) failed, retrying: {error}")
+            else:
+                counters["failed"] += 1
+                logger.error(f"Job {job['_id']} ({job_type}) failed permanently: {error}")
+            return True
+        finally:
+            heartbeat.cancel()
+        self.run_latency[job_type].record((datetime.now() - started).total_seconds())
+        await asyncio.to_thread(self._complete, job, result)
+        counters["completed"] += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            try:
+                while await self.run_one():
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في عامل طابور المهام: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _reaper(self):
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 2)
+            try:
+                await asyncio.to_thread(self.recover_expired)
+            except Exception as e:
+                logger.error(f"خطأ في استعادة المهام المنتهية: {e}")
+
+    async def start(self):
+        if not self._tasks:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            self._tasks.append(asyncio.create_task(self._reaper()))
+
+    async def stop(self):
+        """إيقاف العمال؛ المهام الجارية تعود للطابور بعد انتهاء مهلة الرؤية"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._loop = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """عمق الطابور لكل حالة (عدّ على الفهرس) وزمن الانتظار والتنفيذ لكل نوع"""
+        depth = {status: self.jobs.count_documents({"status": status}) for status in (QUEUED, RUNNING, FAILED)}
+        return {
+            "workers": self.workers,
+            "depth": depth,
+            "jobs": {
+                job_type: {
+                    **self.counters[job_type],
+                    "wait": self.wait_latency[job_type].snapshot(),
+                    "run": self.run_latency[job_type].snapshot(),
+                }
+                for job_type in self.handlers
+            },
+        }
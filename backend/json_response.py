@@ -0,0 +1,115 @@
+"""
+تسلسل JSON السريع - Fast JSON Serialization
+فئة استجابة مبنية على orjson ومحولات مُجمّعة مسبقاً للأشكال الأكثر استخداماً
+"""
+
+from decimal import Decimal
+from enum import Enum
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+_MISSING = object()
+
+
+def _default(obj: Any) -> Any:
+    """تحويل الأنواع التي لا يعرفها orjson"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(content: Any, sort_keys: bool = False) -> bytes:
+    option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+    return orjson.dumps(content, default=_default, option=option)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    استجابة JSON عبر orjson (يدعم datetime مباشرة).
+    إرجاعها مباشرة من نقطة النهاية يتجاوز jsonable_encoder في FastAPI.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def compile_serializer(name: str, fields: Sequence[str],
+                       nested: Optional[Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]]] = None
+                       ) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+    """
+    توليد دالة تحويل مخصصة لقائمة حقول ثابتة (مرة واحدة عند الاستيراد).
+    بيانات قاعدة البيانات موثوقة، فلا تحقق من الأنواع: نسخ الحقول الموجودة فقط بترتيب ثابت،
+    والحقول الغائبة تبقى غائبة كما في المستند الأصلي.
+    """
+    nested = nested or {}
+    lines = [f"def {name}(doc):", "    out = {}", "    get = doc.get"]
+    for field in fields:
+        lines.append(f"    value = get({field!r}, _MISSING)")
+        lines.append("    if value is not _MISSING:")
+        if field in nested:
+            lines.append(f"        out[{field!r}] = [_nested_{field}(item) for item in value] if value else value")
+        else:
+            lines.append(f"        out[{field!r}] = value")
+    lines.append("    return out")
+
+    namespace: Dict[str, Any] = {"_MISSING": _MISSING}
+    for field, serializer in nested.items():
+        namespace[f"_nested_{field}"] = serializer
+    exec(compile("\n".join(lines), f"<serializer {name}>", "exec"), namespace)
+    return namespace[name]
+
+
+def serialize_many(serializer: Callable[[Dict[str, Any]], Dict[str, Any]],
+                   documents: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [serializer(document) for document in documents]
+
+
+# الأشكال الأكثر استخداماً في الاستجابات
+LAWYER_CARD_FIELDS = (
+    "id", "name", "specialization", "description", "bio", "rating", "reviews_count",
+    "price", "hourly_rate", "image", "avatar", "available", "is_verified",
+    "experience_years", "languages", "certificates", "education", "license_number",
+    "email", "phone", "status", "working_hours", "timezone", "created_at", "updated_at",
+)
+
+APPOINTMENT_FIELDS = (
+    "id", "lawyer_id", "lawyer_name", "specialization", "client_id", "date", "time",
+    "consultation_type", "status", "notes", "created_at", "payment_status",
+    "invoice_id", "payment_amount", "slot_start", "slot_end", "timezone",
+)
+
+REVIEW_FIELDS = (
+    "id", "appointment_id", "lawyer_id", "client_id", "rating", "comment", "created_at",
+    "client_name", "client_avatar",
+)
+
+MESSAGE_FIELDS = ("id", "sender", "content", "timestamp", "message_type")
+
+USER_FIELDS = (
+    "id", "name", "email", "phone", "role", "status", "avatar", "created_at", "updated_at",
+    "last_login", "email_verified", "phone_verified",
+)
+
+serialize_lawyer_card = compile_serializer("serialize_lawyer_card", LAWYER_CARD_FIELDS)
+serialize_appointment = compile_serializer("serialize_appointment", APPOINTMENT_FIELDS)
+serialize_review = compile_serializer("serialize_review", REVIEW_FIELDS)
+serialize_message = compile_serializer("serialize_message", MESSAGE_FIELDS)
+serialize_user = compile_serializer("serialize_user", USER_FIELDS)
+serialize_consultation = compile_serializer(
+    "serialize_consultation",
+    ("id", "lawyer_id", "lawyer_name", "specialization", "client_id", "consultation_type",
+     "status", "started_at", "ended_at", "messages"),
+    nested={"messages": serialize_message},
+)
@@ -0,0 +1,124 @@
+"""
+محمّلات الدفعات - Batch Loaders
+تجميع كل المعرفات المطلوبة من مجموعة خلال نفس دورة حلقة الأحداث في استعلام $in واحد،
+مع حفظ النتائج لبقية الطلب (نمط DataLoader).
+"""
+
+import asyncio
+import contextvars
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+
+class BatchLoader:
+    """
+    load(key) يعيد Future؛ المفاتيح المطلوبة في نفس الدورة تُجمع وتُحل باستعلام واحد
+    في خيط منفصل. المفتاح المطلوب مرتين في نفس النطاق لا يُستعلم عنه مرة ثانية.
+    """
+
+    def __init__(self, collection, key_field: str = "id", projection: Optional[Dict[str, int]] = None):
+        self.collection = collection
+        self.key_field = key_field
+        self.projection = projection or {"_id": 0}
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[Hashable] = []
+
+    def load(self, key: Hashable) -> "asyncio.Future[Optional[Dict[str, Any]]]":
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._futures[key] = future
+            self._queue.append(key)
+            if len(self._queue) == 1:
+                # الإرسال في الدورة التالية بعد أن تطلب بقية المهام مفاتيحها
+                loop.call_soon(lambda: asyncio.ensure_future(self._dispatch()))
+        return future
+
+    async def load_many(self, keys: Iterable[Hashable]) -> List[Optional[Dict[str, Any]]]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def _fetch(self, keys: List[Hashable]) -> Dict[Hashable, Dict[str, Any]]:
+        # حقل المفتاح مطلوب دائماً لربط المستندات بمفاتيحها
+        projection = dict(self.projection)
+        if any(value == 1 for value in projection.values()):
+            projection[self.key_field] = 1
+        else:
+            projection.pop(self.key_field, None)
+        return {
+            document[self.key_field]: document
+            for document in self.collection.find({self.key_field: {"$in": keys}}, projection)
+        }
+
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        try:
+            documents = await asyncio.to_thread(self._fetch, keys)
+        except Exception as e:
+            for key in keys:
+                future = self._futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+        for key in keys:
+            future = self._futures.get(key)
+            if future is not None and not future.done():
+                future.set_result(documents.get(key))
+
+
+class LoaderRegistry:
+    """تعريف المحمّلات المتاحة (الاسم ← المجموعة وحقل المفتاح والإسقاط)"""
+
+    def __init__(self):
+        self._specs: Dict[str, tuple] = {}
+
+    def register(self, name: str, collection, key_field: str = "id",
+                 projection: Optional[Dict[str, int]] = None) -> None:
+        self._specs[name] = (collection, key_field, projection)
+
+    def create(self, name: str) -> BatchLoader:
+        collection, key_field, projection = self._specs[name]
+        return BatchLoader(collection, key_field, projection)
+
+
+class RequestLoaders:
+    """محمّلات نطاق واحد (طلب HTTP أو دفعة أحداث)؛ كل محمّل يُنشأ عند أول استخدام"""
+
+    def __init__(self, registry: LoaderRegistry):
+        self._registry = registry
+        self._loaders: Dict[str, BatchLoader] = {}
+
+    def __getattr__(self, name: str) -> BatchLoader:
+        if name.startswith("_"):
+            raise AttributeError(name)
+        loader = self._loaders.get(name)
+        if loader is None:
+            loader = self._loaders[name] = self._registry.create(name)
+        return loader
+
+
+loader_registry = LoaderRegistry()
+_current: contextvars.ContextVar[Optional[RequestLoaders]] = contextvars.ContextVar("request_loaders", default=None)
+
+
+def current_loaders() -> RequestLoaders:
+    """محمّلات الطلب الحالي، أو نطاق جديد مؤقت خارج الطلبات (دون حفظ بين الاستدعاءات)"""
+    loaders = _current.get()
+    return loaders if loaders is not None else RequestLoaders(loader_registry)
+
+
+class LoaderScopeMiddleware:
+    """إنشاء نطاق محمّلات جديد لكل طلب HTTP"""
+
+    def __init__(self, app, registry: LoaderRegistry = loader_registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = _current.set(RequestLoaders(self.registry))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,59 @@
+"""
+المقاييس - Metrics
+أدوات خفيفة لقياس زمن الاستجابة داخل العملية
+"""
+
+import threading
+from collections import deque
+from typing import Deque, Dict, Any, Optional
+
+
+class LatencyTracker:
+    """متتبع زمن الاستجابة بنافذة منزلقة من آخر العينات"""
+
+    def __init__(self, window: int = 512):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        """تسجيل عينة زمن (بالثواني)"""
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            if error:
+                self.errors += 1
+
+    def percentile(self, p: float) -> Optional[float]:
+        """حساب النسبة المئوية p (0-100) من العينات الحالية"""
+        with self._lock:
+            if not self._samples:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+        return ordered[index]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """ملخص العينات بالمللي ثانية"""
+        with self._lock:
+            ordered = sorted(self._samples)
+            count, errors = self.count, self.errors
+
+        def pick(p: float) -> Optional[float]:
+            if not ordered:
+                return None
+            index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+            return round(ordered[index] * 1000, 2)
+
+        return {
+            "count": count,
+            "errors": errors,
+            "p50_ms": pick(50),
+            "p95_ms": pick(95),
+            "p99_ms": pick(99),
+            "max_ms": round(ordered[-1] * 1000, 2) if ordered else None,
+        }
@@ -0,0 +1,310 @@
+"""
+خدمة الإشعارات - Notification Service
+طابور داخل العملية، إدراج الإشعارات على دفعات، عدادات غير المقروء، وقنوات توصيل محدودة التزامن
+"""
+
+import asyncio
+import os
+import uuid
+import hashlib
+import logging
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from json_response import dumps
+from payment_transitions import DUPLICATE_KEY_ERROR
+
+logger = logging.getLogger(__name__)
+
+# قوالب الإشعارات والقنوات الافتراضية لكل نوع
+NOTIFICATION_TEMPLATES: Dict[str, Dict[str, Any]] = {
+    "booking_created": {
+        "title": "تم استلام طلب الحجز",
+        "body": "تم استلام طلب حجز موعدك وسيتم تأكيده بعد إتمام الدفع",
+        "channels": ["in_app", "email"],
+    },
+    "booking_received": {
+        "title": "طلب حجز جديد",
+        "body": "لديك طلب حجز موعد جديد",
+        "channels": ["in_app", "email"],
+    },
+    "payment_paid": {
+        "title": "تم تأكيد الدفع",
+        "body": "تم استلام دفعتك وتأكيد موعدك",
+        "channels": ["in_app", "email", "sms"],
+    },
+    "payment_failed": {
+        "title": "فشل الدفع",
+        "body": "لم تكتمل عملية الدفع، يرجى المحاولة مرة أخرى",
+        "channels": ["in_app", "email"],
+    },
+    "payment_expired": {
+        "title": "انتهت صلاحية رابط الدفع",
+        "body": "انتهت صلاحية رابط الدفع الخاص بموعدك",
+        "channels": ["in_app"],
+    },
+    "payment_refunded": {
+        "title": "تم استرداد المبلغ",
+        "body": "تم استرداد مبلغ الموعد الملغى",
+        "channels": ["in_app", "email", "sms"],
+    },
+    "review_prompt": {
+        "title": "قيّم استشارتك",
+        "body": "شاركنا رأيك في الاستشارة التي أتممتها",
+        "channels": ["in_app", "email"],
+    },
+}
+
+
+class DeliveryAdapter(ABC):
+    """قناة توصيل خارجية (بريد، رسائل نصية...)"""
+
+    channel = ""
+
+    def __init__(self, concurrency: int = 10):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.sent = 0
+        self.failed = 0
+
+    @abstractmethod
+    async def send(self, notification: Dict[str, Any]) -> None:
+        """إرسال إشعار واحد عبر القناة (الاستثناء يُحتسب فشلاً)"""
+
+    async def deliver(self, notification: Dict[str, Any]) -> None:
+        """التوصيل ضمن حد التزامن الخاص بالقناة"""
+        async with self.semaphore:
+            try:
+                await self.send(notification)
+                self.sent += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"خطأ في توصيل الإشعار {notification['id']} عبر {self.channel}: {e}")
+
+
+class StubEmailAdapter(DeliveryAdapter):
+    """بديل محلي للبريد الإلكتروني يسجل الرسائل فقط"""
+
+    channel = "email"
+
+    async def send(self, notification: Dict[str, Any]) -> None:
+        await asyncio.sleep(float(os.getenv("NOTIFICATION_STUB_LATENCY", "0")))
+        logger.info(f"[email stub] to user {notification['user_id']}: {notification['title']}")
+
+
+class StubSMSAdapter(DeliveryAdapter):
+    """بديل محلي للرسائل النصية يسجل الرسائل فقط"""
+
+    channel = "sms"
+
+    async def send(self, notification: Dict[str, Any]) -> None:
+        await asyncio.sleep(float(os.getenv("NOTIFICATION_STUB_LATENCY", "0")))
+        logger.info(f"[sms stub] to user {notification['user_id']}: {notification['title']}")
+
+
+class NotificationService:
+    """
+    نقاط النهاية تضيف الإشعارات للطابور فقط (دون انتظار).
+    عامل الكتابة يدرجها على دفعات ويحدّث عدادات غير المقروء بـ $inc،
+    ثم تُمرر لعمال التوصيل عبر طابور محدود (ضغط عكسي عند امتلائه).
+    """
+
+    def __init__(self, notifications_collection, users_collection, adapters: Optional[Iterable[DeliveryAdapter]] = None):
+        self.notifications = notifications_collection
+        self.users = users_collection
+        concurrency = int(os.getenv("NOTIFICATION_DELIVERY_CONCURRENCY", "10"))
+        if adapters is None:
+            adapters = [StubEmailAdapter(concurrency), StubSMSAdapter(concurrency)]
+        self.adapters: Dict[str, DeliveryAdapter] = {adapter.channel: adapter for adapter in adapters}
+
+        self.batch_size = int(os.getenv("NOTIFICATION_BATCH_SIZE", "200"))
+        self.flush_interval = float(os.getenv("NOTIFICATION_FLUSH_INTERVAL", "0.5"))
+        self.delivery_workers = int(os.getenv("NOTIFICATION_DELIVERY_WORKERS", "4"))
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=int(os.getenv("NOTIFICATION_QUEUE_SIZE", "10000")))
+        self.delivery_queue: asyncio.Queue = asyncio.Queue(
+            maxsize=int(os.getenv("NOTIFICATION_DELIVERY_QUEUE_SIZE", "1000"))
+        )
+        self.dropped = 0
+        # دفعة فشلت كتابتها تُعاد قبل أي إشعار جديد (حجمها لا يتجاوز حجم الدفعة)
+        self._retry: List[Dict[str, Any]] = []
+        self._tasks: List[asyncio.Task] = []
+
+    def ensure_indexes(self):
+        self.notifications.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
+        self.notifications.create_index([("user_id", ASCENDING), ("read", ASCENDING)])
+
+    @staticmethod
+    def build(
+        user_id: str,
+        kind: str,
+        data: Optional[Dict[str, Any]] = None,
+        title: Optional[str] = None,
+        body: Optional[str] = None,
+        channels: Optional[List[str]] = None,
+        notification_id: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """مستند الإشعار من قالب نوعه"""
+        template = NOTIFICATION_TEMPLATES.get(kind, {})
+        return {
+            "id": notification_id or str(uuid.uuid4()),
+            "user_id": user_id,
+            "kind": kind,
+            "title": title or template.get("title", kind),
+            "body": body or template.get("body", ""),
+            "channels": channels or template.get("channels", ["in_app"]),
+            "data": data or {},
+            "read": False,
+            "created_at": datetime.now(),
+        }
+
+    @staticmethod
+    def event_id(user_id: str, kind: str, data: Dict[str, Any]) -> str:
+        """معرف ثابت لإشعار ناتج عن حدث دائم: إعادة معالجة الحدث تنتج نفس المعرف"""
+        return hashlib.sha256(dumps({"user_id": user_id, "kind": kind, "data": data}, sort_keys=True)).hexdigest()
+
+    def enqueue(
+        self,
+        user_id: str,
+        kind: str,
+        data: Optional[Dict[str, Any]] = None,
+        title: Optional[str] = None,
+        body: Optional[str] = None,
+        channels: Optional[List[str]] = None,
+    ) -> bool:
+        """إضافة إشعار للطابور دون انتظار. يُعاد False إذا كان الطابور ممتلئاً"""
+        notification = self.build(user_id, kind, data, title, body, channels)
+        try:
+            self.queue.put_nowait(notification)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(f"Notification queue full, dropping {kind} for user {user_id}")
+            return False
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks.append(asyncio.create_task(self._writer()))
+            for _ in range(self.delivery_workers):
+                self._tasks.append(asyncio.create_task(self._deliverer()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # حفظ الدفعة المعلقة وما تبقى في الطابور قبل الإيقاف (دون توصيل خارجي)
+        remaining, self._retry = self._retry, []
+        while not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        if remaining:
+            try:
+                await asyncio.to_thread(self.store, remaining)
+            except Exception as e:
+                logger.error(f"خطأ في حفظ الإشعارات عند الإيقاف: {e}")
+
+    async def _collect_batch(self) -> List[Dict[str, Any]]:
+        """انتظار أول إشعار ثم تجميع ما يصل خلال فترة التفريغ حتى حجم الدفعة"""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def store(self, notifications: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        كتابة إشعارات يعيد المستدعي المحاولة عند الاستثناء (عامل الكتابة والصندوق الصادر).
+        المعرف هو _id، فالإشعارات المكتوبة في محاولة سابقة تُتجاهل ولا تُحتسب مرتين في غير المقروء.
+        يُعاد ما كُتب الآن فقط.
+        """
+        if not notifications:
+            return []
+        documents = [{"_id": notification["id"], **notification} for notification in notifications]
+        try:
+            self.notifications.insert_many(documents, ordered=False)
+            stored = notifications
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                raise
+            duplicates = {error["index"] for error in errors}
+            stored = [notification for index, notification in enumerate(notifications) if index not in duplicates]
+        counts: Dict[str, int] = {}
+        for notification in stored:
+            counts[notification["user_id"]] = counts.get(notification["user_id"], 0) + 1
+        if counts:
+            self.users.bulk_write(
+                [UpdateOne({"id": user_id}, {"$inc": {"unread_notifications": count}}) for user_id, count in counts.items()],
+                ordered=False
+            )
+        return stored
+
+    async def dispatch(self, notifications: List[Dict[str, Any]]):
+        """تمرير إشعارات محفوظة لعمال التوصيل (ينتظر عند امتلاء طابور التوصيل)"""
+        for notification in notifications:
+            for channel in notification["channels"]:
+                if channel in self.adapters:
+                    await self.delivery_queue.put((channel, notification))
+
+    async def _writer(self):
+        while True:
+            if not self._retry:
+                self._retry = await self._collect_batch()
+            batch = self._retry
+            try:
+                # store يكتب بـ _id ثابت: ما كُتب في محاولة سابقة يُتجاهل ولا يُحتسب مرتين في غير المقروء
+                await asyncio.to_thread(self.store, batch)
+            except Exception as e:
+                logger.error(f"خطأ في إدراج دفعة الإشعارات: {e}")
+                # الدفعة تبقى معلقة وتُعاد بعد فترة التفريغ؛ الإشعارات الجديدة تنتظر في الطابور المحدود
+                await asyncio.sleep(self.flush_interval)
+                continue
+            self._retry = []
+            # ينتظر الكاتب عند امتلاء طابور التوصيل (ضغط عكسي) ولا تنتظر نقاط النهاية أبداً
+            await self.dispatch(batch)
+
+    async def _deliverer(self):
+        while True:
+            channel, notification = await self.delivery_queue.get()
+            await self.adapters[channel].deliver(notification)
+
+    def list_for_user(self, user_id: str, unread_only: bool = False, page: int = 1, limit: int = 20) -> List[Dict[str, Any]]:
+        criteria: Dict[str, Any] = {"user_id": user_id}
+        if unread_only:
+            criteria["read"] = False
+        return list(self.notifications.find(criteria, {"_id": 0})
+                    .sort("created_at", DESCENDING).skip((page - 1) * limit).limit(limit))
+
+    def unread_count(self, user_id: str) -> int:
+        user = self.users.find_one({"id": user_id}, {"_id": 0, "unread_notifications": 1})
+        return max(0, (user or {}).get("unread_notifications", 0))
+
+    def mark_read(self, user_id: str, notification_ids: Optional[List[str]] = None) -> int:
+        """تعليم الإشعارات كمقروءة (أو جميعها) وإنقاص العداد بعدد ما تغير فعلاً"""
+        criteria: Dict[str, Any] = {"user_id": user_id, "read": False}
+        if notification_ids:
+            criteria["id"] = {"$in": notification_ids}
+        result = self.notifications.update_many(criteria, {"$set": {"read": True, "read_at": datetime.now()}})
+        if result.modified_count:
+            self.users.update_one({"id": user_id}, {"$inc": {"unread_notifications": -result.modified_count}})
+        return result.modified_count
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "queued": self.queue.qsize(),
+            "delivery_queued": self.delivery_queue.qsize(),
+            "dropped": self.dropped,
+            "adapters": {
+                channel: {"sent": adapter.sent, "failed": adapter.failed}
+                for channel, adapter in self.adapters.items()
+            },
+        }
@@ -4,9 +4,7 @@
 """
 
 from pydantic import BaseModel, Field, EmailStr
-from typing import Optional, Literal, Dict, Any
-from datetime import datetime
-from decimal import Decimal
+from typing import Optional
 
 class PaymentRequest(BaseModel):
     """طلب إنشاء دفع جديد"""
@@ -57,30 +55,7 @@ class RefundResponse(BaseModel):
     amount: Optional[float] = None
     status: Optional[str] = None
     error: Optional[str] = None
-
-class PaymentRecord(BaseModel):
-    """سجل الدفع في قاعدة البيانات"""
-    id: str
-    appointment_id: str
-    invoice_id: Optional[str] = None
-    payment_id: Optional[str] = None
-    amount: float
-    currency: str = "SAR"
-    status: Literal["pending", "paid", "failed", "refunded", "expired"] = "pending"
-    payment_method: Optional[str] = None
-    gateway: str = "myfatoorah"
-    customer_name: str
-    customer_email: str
-    customer_mobile: str
-    lawyer_name: str
-    consultation_type: str
-    payment_url: Optional[str] = None
-    transaction_date: Optional[datetime] = None
-    refund_amount: Optional[float] = None
-    refund_reason: Optional[str] = None
-    created_at: datetime = Field(default_factory=datetime.now)
-    updated_at: datetime = Field(default_factory=datetime.now)
-    metadata: Optional[Dict[str, Any]] = None
+    job_id: Optional[str] = None
 
 class WebhookPayload(BaseModel):
     """بيانات Webhook من ماي فاتورة"""
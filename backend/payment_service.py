@@ -7,12 +7,19 @@ import os
 import httpx
 import uuid
 from typing import Dict, Optional, Any
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 from decimal import Decimal
 
+from gateway_resilience import GatewayResilience, CircuitOpenError
+
 logger = logging.getLogger(__name__)
 
+GATEWAY_UNAVAILABLE_MESSAGE = "نظام الدفع غير متاح مؤقتاً، يرجى المحاولة لاحقاً"
+# استرداد انتهى دون نتيجة مؤكدة: حجزه (refund_job_id) يبقى حتى المطابقة مع حالة الاسترداد في البوابة
+REFUND_UNKNOWN = "unknown"
+REFUND_UNKNOWN_MESSAGE = "نتيجة الاسترداد غير معروفة، تجب مطابقتها مع بوابة الدفع قبل إعادة الطلب"
+
 class MyFatoorahService:
     """خدمة ماي فاتورة للدفع الإلكتروني"""
     
@@ -28,7 +35,53 @@ class MyFatoorahService:
         if not self.api_key:
             logger.warning("MyFatoorah API key not found in environment variables. Running in test mode.")
             self.api_key = "test_api_key"
+        
+        # طبقة المرونة وعميل HTTP مشترك (إعادة استخدام الاتصالات بين الطلبات)
+        self.resilience = GatewayResilience()
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """عميل HTTP مشترك يُنشأ عند أول استخدام"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+            )
+        return self._client
+    
+    async def close(self):
+        """إغلاق عميل HTTP عند إيقاف الخادم"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
     
+    async def _post(self, path: str, payload: Dict[str, Any], idempotent: bool = False, hedge: bool = False) -> Dict[str, Any]:
+        """إرسال طلب للبوابة عبر طبقة المرونة"""
+        async def send(timeout: float) -> Dict[str, Any]:
+            response = await self._get_client().post(
+                path,
+                json=payload,
+                headers=self._get_headers(),
+                timeout=timeout
+            )
+            response.raise_for_status()
+            return response.json()
+        
+        operation = path.rsplit("/", 1)[-1]
+        return await self.resilience.call(operation, send, idempotent=idempotent, hedge=hedge)
+    
+    def get_metrics(self) -> Dict[str, Any]:
+        """مقاييس قاطع الدائرة وزمن استجابة البوابة"""
+        return self.resilience.get_metrics()
+
+    async def probe(self, timeout: float = 3.0) -> int:
+        """
+        فحص الوصول للبوابة عبر العميل المشترك (دون المرور بقاطع الدائرة).
+        أي استجابة HTTP تعني أن البوابة قابلة للوصول؛ يُعاد رمز الحالة.
+        """
+        response = await self._get_client().head("/", timeout=timeout)
+        return response.status_code
+
     def _get_headers(self) -> Dict[str, str]:
         """إعداد headers للطلبات"""
         return {
@@ -50,9 +103,10 @@ class MyFatoorahService:
         customer_mobile: str,
         appointment_id: str,
         lawyer_name: str,
-        consultation_type: str
+        consultation_type: str,
+        expires_at: Optional[datetime] = None
     ) -> Dict[str, Any]:
-        """إنشاء جلسة دفع جديدة"""
+        """إنشاء جلسة دفع جديدة (expires_at بالتوقيت المحلي: لا تقبل البوابة الدفع بعده)"""
         
         try:
             # التحقق من صحة المبلغ
@@ -85,7 +139,9 @@ class MyFatoorahService:
                 "CustomerReference": appointment_id,
                 "CustomerCivilId": "",
                 "UserDefinedField": f"استشارة قانونية مع {lawyer_name} - {consultation_type}",
-                "ExpiryDate": "",
+                "ExpiryDate": (
+                    expires_at.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z") if expires_at else ""
+                ),
                 "SourceInfo": "منصة دبرة للاستشارات القانونية",
                 "CustomerAddress": {
                     "Block": "",
@@ -108,39 +164,37 @@ class MyFatoorahService:
             }
             
             # إرسال الطلب لماي فاتورة
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/SendPayment",
-                    json=payment_data,
-                    headers=self._get_headers(),
-                    timeout=30.0
-                )
+            # إنشاء الفاتورة غير آمن للتكرار، لذا لا نعيد المحاولة
+            result = await self._post("/v2/SendPayment", payment_data)
+            
+            if result.get("IsSuccess"):
+                payment_url = result["Data"]["InvoiceURL"]
+                invoice_id = result["Data"]["InvoiceId"]
                 
-                response.raise_for_status()
-                result = response.json()
+                logger.info(f"Payment session created successfully for appointment {appointment_id}")
                 
-                if result.get("IsSuccess"):
-                    payment_url = result["Data"]["InvoiceURL"]
-                    invoice_id = result["Data"]["InvoiceId"]
-                    
-                    logger.info(f"Payment session created successfully for appointment {appointment_id}")
-                    
-                    return {
-                        "success": True,
-                        "payment_url": payment_url,
-                        "invoice_id": invoice_id,
-                        "appointment_id": appointment_id,
-                        "amount": amount,
-                        "currency": "SAR"
-                    }
-                else:
-                    error_message = result.get("Message", "خطأ غير معروف في إنشاء جلسة الدفع")
-                    logger.error(f"MyFatoorah API error: {error_message}")
-                    return {
-                        "success": False,
-                        "error": error_message
-                    }
+                return {
+                    "success": True,
+                    "payment_url": payment_url,
+                    "invoice_id": invoice_id,
+                    "appointment_id": appointment_id,
+                    "amount": amount,
+                    "currency": "SAR"
+                }
+            else:
+                error_message = result.get("Message", "خطأ غير معروف في إنشاء جلسة الدفع")
+                logger.error(f"MyFatoorah API error: {error_message}")
+                return {
+                    "success": False,
+                    "error": error_message
+                }
                     
+        except CircuitOpenError:
+            logger.warning("MyFatoorah circuit open: rejecting payment creation")
+            return {
+                "success": False,
+                "error": GATEWAY_UNAVAILABLE_MESSAGE
+            }
         except httpx.HTTPStatusError as e:
             logger.error(f"HTTP error in payment creation: {e}")
             return {
@@ -178,41 +232,39 @@ class MyFatoorahService:
                 "KeyType": "PaymentId"
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/GetPaymentStatus",
-                    json=verification_data,
-                    headers=self._get_headers(),
-                    timeout=30.0
-                )
+            # الاستعلام عن الحالة آمن للتكرار: إعادة محاولة وطلبات متحوطة
+            result = await self._post("/v2/GetPaymentStatus", verification_data, idempotent=True, hedge=True)
+            
+            if result.get("IsSuccess"):
+                payment_data = result["Data"]
                 
-                response.raise_for_status()
-                result = response.json()
+                # تحديد حالة الدفع
+                invoice_status = payment_data.get("InvoiceStatus")
+                is_paid = invoice_status == "Paid"
                 
-                if result.get("IsSuccess"):
-                    payment_data = result["Data"]
-                    
-                    # تحديد حالة الدفع
-                    invoice_status = payment_data.get("InvoiceStatus")
-                    is_paid = invoice_status == "Paid"
-                    
-                    return {
-                        "success": True,
-                        "is_paid": is_paid,
-                        "payment_status": invoice_status,
-                        "invoice_id": payment_data.get("InvoiceId"),
-                        "invoice_value": payment_data.get("InvoiceValue"),
-                        "customer_reference": payment_data.get("CustomerReference"),
-                        "payment_method": payment_data.get("InvoiceTransactions", [{}])[0].get("PaymentGateway") if payment_data.get("InvoiceTransactions") else None,
-                        "transaction_date": payment_data.get("CreatedDate")
-                    }
-                else:
-                    error_message = result.get("Message", "خطأ في التحقق من حالة الدفع")
-                    return {
-                        "success": False,
-                        "error": error_message
-                    }
+                return {
+                    "success": True,
+                    "is_paid": is_paid,
+                    "payment_status": invoice_status,
+                    "invoice_id": payment_data.get("InvoiceId"),
+                    "invoice_value": payment_data.get("InvoiceValue"),
+                    "customer_reference": payment_data.get("CustomerReference"),
+                    "payment_method": payment_data.get("InvoiceTransactions", [{}])[0].get("PaymentGateway") if payment_data.get("InvoiceTransactions") else None,
+                    "transaction_date": payment_data.get("CreatedDate")
+                }
+            else:
+                error_message = result.get("Message", "خطأ في التحقق من حالة الدفع")
+                return {
+                    "success": False,
+                    "error": error_message
+                }
                     
+        except CircuitOpenError:
+            logger.warning("MyFatoorah circuit open: rejecting payment verification")
+            return {
+                "success": False,
+                "error": GATEWAY_UNAVAILABLE_MESSAGE
+            }
         except Exception as e:
             logger.error(f"Error verifying payment: {e}")
             return {
@@ -221,7 +273,10 @@ class MyFatoorahService:
             }
     
     async def refund_payment(self, payment_id: str, amount: float, reason: str = "إلغاء الموعد") -> Dict[str, Any]:
-        """استرداد المبلغ"""
+        """
+        استرداد المبلغ. ambiguous=True عند فشل لا يثبت أن البوابة لم تنفذ الاسترداد (انتهاء المهلة،
+        خطأ اتصال أو 5xx)؛ الرفض الصريح (IsSuccess=false أو 4xx) والقاطع المفتوح ليسا كذلك.
+        """
         
         try:
             # في وضع الاختبار، نعيد استجابة وهمية
@@ -243,37 +298,82 @@ class MyFatoorahService:
                 "Comment": reason
             }
             
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{self.base_url}/v2/MakeRefund",
-                    json=refund_data,
-                    headers=self._get_headers(),
-                    timeout=30.0
-                )
-                
-                response.raise_for_status()
-                result = response.json()
-                
-                if result.get("IsSuccess"):
-                    return {
-                        "success": True,
-                        "refund_id": result["Data"]["RefundId"],
-                        "amount": amount,
-                        "status": "تم الاسترداد بنجاح"
-                    }
-                else:
-                    error_message = result.get("Message", "خطأ في عملية الاسترداد")
-                    return {
-                        "success": False,
-                        "error": error_message
-                    }
+            # الاسترداد غير آمن للتكرار، لذا لا نعيد المحاولة
+            result = await self._post("/v2/MakeRefund", refund_data)
+            
+            if result.get("IsSuccess"):
+                return {
+                    "success": True,
+                    "refund_id": result["Data"]["RefundId"],
+                    "amount": amount,
+                    "status": "تم الاسترداد بنجاح"
+                }
+            else:
+                error_message = result.get("Message", "خطأ في عملية الاسترداد")
+                return {
+                    "success": False,
+                    "error": error_message
+                }
                     
+        except CircuitOpenError:
+            logger.warning("MyFatoorah circuit open: rejecting refund")
+            return {
+                "success": False,
+                "error": GATEWAY_UNAVAILABLE_MESSAGE
+            }
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code < 500:
+                logger.error(f"Refund rejected by MyFatoorah: {e}")
+                return {
+                    "success": False,
+                    "error": "خطأ في عملية الاسترداد"
+                }
+            logger.error(f"Refund outcome unknown for {payment_id}: {e}")
+            return {
+                "success": False,
+                "ambiguous": True,
+                "error": REFUND_UNKNOWN_MESSAGE
+            }
         except Exception as e:
-            logger.error(f"Error processing refund: {e}")
+            logger.error(f"Refund outcome unknown for {payment_id}: {e}")
             return {
                 "success": False,
-                "error": "خطأ في عملية الاسترداد"
+                "ambiguous": True,
+                "error": REFUND_UNKNOWN_MESSAGE
             }
 
+    async def get_refund_status(self, invoice_id: str) -> Dict[str, Any]:
+        """
+        حالة الاستردادات المطلوبة على الفاتورة (للمطابقة بعد استرداد نتيجته غير معروفة).
+        refunded: استرداد منفذ، pending: استرداد قيد المعالجة في البوابة.
+        """
+        try:
+            if self.api_key == "test_api_key":
+                return {"success": True, "refunded": False, "pending": False}
+
+            # الاستعلام عن الحالة آمن للتكرار
+            result = await self._post(
+                "/v2/GetRefundStatus", {"Key": invoice_id, "KeyType": "InvoiceId"}, idempotent=True
+            )
+            if not result.get("IsSuccess"):
+                return {"success": False, "error": result.get("Message", "خطأ في الاستعلام عن حالة الاسترداد")}
+
+            refunds = (result.get("Data") or {}).get("RefundStatusResult") or []
+            by_status = {str(refund.get("RefundStatus", "")).upper(): refund for refund in refunds}
+            refunded = by_status.get("REFUNDED")
+            return {
+                "success": True,
+                "refunded": refunded is not None,
+                "pending": "PENDING" in by_status,
+                "refund_id": refunded.get("RefundId") if refunded else None,
+                "amount": refunded.get("Amount") if refunded else None,
+            }
+
+        except CircuitOpenError:
+            return {"success": False, "error": GATEWAY_UNAVAILABLE_MESSAGE}
+        except Exception as e:
+            logger.error(f"Error checking refund status: {e}")
+            return {"success": False, "error": "خطأ في الاستعلام عن حالة الاسترداد"}
+
 # إنشاء instance من الخدمة
 myfatoorah_service = MyFatoorahService()
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+انتقالات حالة الدفع - Payment State Transitions
+تطبيق تغييرات الدفع والموعد معاً (معاملة واحدة أو تحديث مستند موحد) مع صندوق صادر للآثار الجانبية
+"""
+
+import asyncio
+import os
+import uuid
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+
+from http_caching import collection_versions
+
+logger = logging.getLogger(__name__)
+
+# رمز خطأ المفتاح المكرر في MongoDB
+DUPLICATE_KEY_ERROR = 11000
+
+
+class PaymentTransitions:
+    """
+    تطبيق انتقالات حالة الدفع والموعد وأحداث الصندوق الصادر كوحدة واحدة.
+
+    إذا كان الخادم يدعم المعاملات (replica set / sharded) تُنفذ الكتابات في معاملة واحدة.
+    وإلا يُكتب الانتقال كاملاً (تحديث الموعد + الأحداث) داخل مستند الدفع في تحديث ذري واحد
+    ثم يُستكمل، ويمكن استئناف أي انتقال غير مكتمل بعد انهيار دون إعادة التحقق من البوابة.
+    """
+
+    def __init__(self, client, payments_collection, appointments_collection, outbox_collection):
+        self.client = client
+        self.payments = payments_collection
+        self.appointments = appointments_collection
+        self.outbox = outbox_collection
+        self._transactions_supported: Optional[bool] = None
+
+    def ensure_indexes(self):
+        """فهارس الصندوق الصادر والانتقالات المعلقة"""
+        self.outbox.create_index([("status", ASCENDING), ("created_at", ASCENDING)])
+        self.outbox.create_index("claim", sparse=True)
+        self.outbox.create_index(
+            "processed_at",
+            expireAfterSeconds=int(os.getenv("OUTBOX_RETENTION_SECONDS", str(7 * 24 * 3600)))
+        )
+        self.payments.create_index("pending_transition.created_at", sparse=True)
+
+    def supports_transactions(self) -> bool:
+        """هل يدعم الخادم المعاملات متعددة المستندات؟"""
+        if self._transactions_supported is None:
+            try:
+                hello = self.client.admin.command("hello")
+                self._transactions_supported = "setName" in hello or hello.get("msg") == "isdbgrid"
+            except Exception as e:
+                logger.warning(f"تعذر تحديد دعم المعاملات: {e}")
+                return False
+        return self._transactions_supported
+
+    @staticmethod
+    def _outbox_documents(transition_id: str, events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        now = datetime.now()
+        return [
+            {
+                # معرف حتمي يمنع تكرار الحدث عند استئناف الانتقال
+                "_id": f"{transition_id}:{index}",
+                "type": event["type"],
+                "payload": event.get("payload", {}),
+                "status": "pending",
+                "attempts": 0,
+                "created_at": now,
+            }
+            for index, event in enumerate(events)
+        ]
+
+    @staticmethod
+    def _appointment_filter(appointment_id: str, statuses: Optional[List[str]]) -> Dict[str, Any]:
+        # الحالات تُحفظ كقائمة في الانتقال المعلق (لا مفاتيح $ داخل المستند المخزن)
+        if statuses is None:
+            return {"id": appointment_id}
+        return {"id": appointment_id, "status": {"$in": statuses}}
+
+    def _insert_outbox(self, documents: List[Dict[str, Any]], session=None):
+        if not documents:
+            return
+        try:
+            self.outbox.insert_many(documents, ordered=False, session=session)
+        except BulkWriteError as e:
+            # الأحداث المكتوبة مسبقاً (استئناف بعد انهيار) ليست خطأ
+            if any(err.get("code") != DUPLICATE_KEY_ERROR for err in e.details.get("writeErrors", [])):
+                raise
+
+    def publish(self, transition_id: str, events: List[Dict[str, Any]]):
+        """كتابة أحداث في الصندوق الصادر بمعرفات مشتقة من transition_id (إعادة النشر لا تكررها)"""
+        self._insert_outbox(self._outbox_documents(transition_id, events))
+
+    def apply(
+        self,
+        payment_filter: Dict[str, Any],
+        payment_update: Dict[str, Any],
+        appointment_id: Optional[str] = None,
+        appointment_update: Optional[Dict[str, Any]] = None,
+        events: Optional[List[Dict[str, Any]]] = None,
+        appointment_statuses: Optional[List[str]] = None,
+    ) -> bool:
+        """
+        تطبيق انتقال على دفعة موجودة.
+        payment_filter يتضمن شرط الحالة السابقة، فإذا لم يطابق أي مستند (انتقال مطبق مسبقاً)
+        لا يُكتب شيء ويُعاد False. appointment_statuses تقيد تحديث الموعد بحالاته السابقة المسموحة.
+        """
+        transition_id = str(uuid.uuid4())
+        events = events or []
+
+        if self.supports_transactions():
+            def callback(session):
+                result = self.payments.update_one(payment_filter, {"$set": payment_update}, session=session)
+                if result.matched_count == 0:
+                    return False
+                if appointment_id and appointment_update:
+                    self.appointments.update_one(
+                        self._appointment_filter(appointment_id, appointment_statuses),
+                        {"$set": appointment_update}, session=session
+                    )
+                self._insert_outbox(self._outbox_documents(transition_id, events), session=session)
+                return True
+
+            # عدادات الإصدار تُرفع بعد الالتزام لا عند كل كتابة داخل المعاملة
+            with collection_versions.deferred(), self.client.start_session() as session:
+                return session.with_transaction(callback)
+
+        # تحديث موحد: حالة الدفع + الانتقال المعلق في مستند واحد (ذري)
+        pending = {
+            "id": transition_id,
+            "appointment_id": appointment_id,
+            "appointment_update": appointment_update or {},
+            "appointment_statuses": appointment_statuses,
+            "events": events,
+            "created_at": datetime.now(),
+        }
+        # لا يُكتب فوق انتقال معلق لم يكتمل بعد (وإلا ضاع تحديث موعده وأحداثه)
+        fallback_filter = {**payment_filter, "pending_transition": {"$exists": False}}
+        update = {"$set": {**payment_update, "pending_transition": pending}}
+        result = self.payments.update_one(fallback_filter, update)
+        if result.matched_count == 0:
+            blocked = self.payments.find_one(
+                {**payment_filter, "pending_transition": {"$exists": True}}, {"pending_transition": 1}
+            )
+            if blocked is None:
+                return False
+            # استكمال الانتقال السابق أولاً ثم إعادة المحاولة مرة واحدة
+            self._complete(blocked["pending_transition"])
+            result = self.payments.update_one(fallback_filter, update)
+            if result.matched_count == 0:
+                return False
+        self._complete(pending)
+        return True
+
+    def insert_payment(
+        self,
+        payment_document: Dict[str, Any],
+        appointment_id: str,
+        appointment_update: Dict[str, Any],
+        events: Optional[List[Dict[str, Any]]] = None,
+    ):
+        """إدراج سجل دفع جديد مع تحديث الموعد المرتبط"""
+        transition_id = str(uuid.uuid4())
+        events = events or []
+
+        if self.supports_transactions():
+            def callback(session):
+                self.payments.insert_one(payment_document, session=session)
+                self.appointments.update_one({"id": appointment_id}, {"$set": appointment_update}, session=session)
+                self._insert_outbox(self._outbox_documents(transition_id, events), session=session)
+
+            with collection_versions.deferred(), self.client.start_session() as session:
+                session.with_transaction(callback)
+            return
+
+        pending = {
+            "id": transition_id,
+            "appointment_id": appointment_id,
+            "appointment_update": appointment_update,
+            "events": events,
+            "created_at": datetime.now(),
+        }
+        self.payments.insert_one({**payment_document, "pending_transition": pending})
+        self._complete(pending)
+
+    def _complete(self, pending: Dict[str, Any]):
+        """استكمال انتقال معلق: تحديث الموعد ثم كتابة الأحداث ثم إزالة العلامة"""
+        if pending.get("appointment_id") and pending.get("appointment_update"):
+            self.appointments.update_one(
+                self._appointment_filter(pending["appointment_id"], pending.get("appointment_statuses")),
+                {"$set": pending["appointment_update"]}
+            )
+        self._insert_outbox(self._outbox_documents(pending["id"], pending.get("events", [])))
+        self.payments.update_one(
+            {"pending_transition.id": pending["id"]},
+            {"$unset": {"pending_transition": ""}}
+        )
+
+    def recover_pending(self, older_than_seconds: float = 30, limit: int = 100) -> int:
+        """استئناف الانتقالات غير المكتملة (بعد انهيار العملية) دون إعادة التحقق من البوابة"""
+        cutoff = datetime.now() - timedelta(seconds=older_than_seconds)
+        recovered = 0
+        for payment in self.payments.find(
+            {"pending_transition.created_at": {"$lt": cutoff}},
+            {"pending_transition": 1}
+        ).limit(limit):
+            try:
+                self._complete(payment["pending_transition"])
+                recovered += 1
+            except Exception as e:
+                logger.error(f"خطأ في استئناف انتقال الدفع {payment['pending_transition'].get('id')}: {e}")
+        if recovered:
+            logger.info(f"Recovered {recovered} pending payment transitions")
+        return recovered
+
+
+OutboxHandler = Callable[[List[Dict[str, Any]]], Awaitable[None]]
+
+
+class OutboxWorker:
+    """عامل خلفي يفرّغ الصندوق الصادر على دفعات ويوزع الأحداث على معالجاتها"""
+
+    def __init__(self, outbox_collection, transitions: Optional[PaymentTransitions] = None):
+        self.outbox = outbox_collection
+        self.transitions = transitions
+        self.handlers: Dict[str, OutboxHandler] = {}
+        self.batch_size = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+        self.interval = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+        self.lease_seconds = float(os.getenv("OUTBOX_LEASE_SECONDS", "60"))
+        self.max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def register(self, event_type: str, handler: OutboxHandler):
+        """تسجيل معالج لنوع حدث (يستقبل قائمة payloads لنفس النوع)"""
+        self.handlers[event_type] = handler
+
+    def notify(self):
+        """إيقاظ العامل فوراً بعد كتابة أحداث جديدة"""
+        self._wakeup.set()
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # تفريغ ما تبقى قبل الإيقاف
+        try:
+            await self.drain_once()
+        except Exception as e:
+            logger.error(f"خطأ في تفريغ الصندوق الصادر عند الإيقاف: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                if self.transitions is not None:
+                    await asyncio.to_thread(self.transitions.recover_pending)
+                while await self.drain_once() >= self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في عامل الصندوق الصادر: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def _claim_batch(self) -> List[Dict[str, Any]]:
+        """حجز دفعة من الأحداث المعلقة (أو المحجوزة منذ مدة طويلة)"""
+        now = datetime.now()
+        stale = now - timedelta(seconds=self.lease_seconds)
+        ids = [
+            doc["_id"] for doc in self.outbox.find(
+                {"$or": [
+                    {"status": "pending"},
+                    {"status": "processing", "claimed_at": {"$lt": stale}},
+                ]},
+                {"_id": 1}
+            ).sort("created_at", ASCENDING).limit(self.batch_size)
+        ]
+        if not ids:
+            return []
+        claim = str(uuid.uuid4())
+        self.outbox.update_many(
+            {"_id": {"$in": ids}, "$or": [
+                {"status": "pending"},
+                {"status": "processing", "claimed_at": {"$lt": stale}},
+            ]},
+            {"$set": {"status": "processing", "claim": claim, "claimed_at": now}, "$inc": {"attempts": 1}}
+        )
+        return list(self.outbox.find({"claim": claim}))
+
+    def _finish(self, ids: List[Any], error: Optional[str] = None, attempts: int = 0):
+        if error is None:
+            self.outbox.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "done", "processed_at": datetime.now()}, "$unset": {"claim": ""}}
+            )
+        elif attempts >= self.max_attempts:
+            self.outbox.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "failed", "error": error}, "$unset": {"claim": ""}}
+            )
+        else:
+            self.outbox.update_many(
+                {"_id": {"$in": ids}},
+                {"$set": {"status": "pending", "error": error}, "$unset": {"claim": ""}}
+            )
+
+    async def drain_once(self) -> int:
+        """معالجة دفعة واحدة وإرجاع عدد الأحداث المعالجة"""
+        batch = await asyncio.to_thread(self._claim_batch)
+        if not batch:
+            return 0
+
+        by_type: Dict[str, List[Dict[str, Any]]] = {}
+        for event in batch:
+            by_type.setdefault(event["type"], []).append(event)
+
+        for event_type, events in by_type.items():
+            ids = [event["_id"] for event in events]
+            attempts = max(event.get("attempts", 0) for event in events)
+            handler = self.handlers.get(event_type)
+            if handler is None:
+                await asyncio.to_thread(self._finish, ids, f"no handler for {event_type}", self.max_attempts)
+                continue
+            try:
+                await handler([event["payload"] for event in events])
+                await asyncio.to_thread(self._finish, ids)
+            except Exception as e:
+                logger.error(f"خطأ في معالجة أحداث {event_type}: {e}")
+                await asyncio.to_thread(self._finish, ids, str(e), attempts)
+
+        return len(batch)
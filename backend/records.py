@@ -0,0 +1,185 @@
+"""
+السجلات الداخلية - Internal Records
+أنواع سجلات مدمجة (dataclasses بـ __slots__) للبيانات الداخلية مع محولات BSON مُجمّعة مسبقاً.
+نماذج Pydantic تُستخدم عند حدود الـ API فقط.
+"""
+
+import copy
+from dataclasses import MISSING, dataclass, field, fields
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Type, TypeVar
+
+T = TypeVar("T")
+
+# ساعات العمل الافتراضية للمحامين (ثابت واحد مشترك، يُنسخ عند الحاجة)
+DEFAULT_WORKING_HOURS: Dict[str, Dict[str, Any]] = {
+    "sunday": {"start": "09:00", "end": "17:00", "available": True},
+    "monday": {"start": "09:00", "end": "17:00", "available": True},
+    "tuesday": {"start": "09:00", "end": "17:00", "available": True},
+    "wednesday": {"start": "09:00", "end": "17:00", "available": True},
+    "thursday": {"start": "09:00", "end": "17:00", "available": True},
+    "friday": {"start": "14:00", "end": "17:00", "available": True},
+    "saturday": {"start": "09:00", "end": "17:00", "available": False},
+}
+
+
+def default_working_hours() -> Dict[str, Dict[str, Any]]:
+    return copy.deepcopy(DEFAULT_WORKING_HOURS)
+
+
+def _compile_codec(cls: Type[T]) -> None:
+    """
+    توليد from_bson و to_bson للفئة مرة واحدة.
+    from_bson يتجاهل الحقول غير المعروفة (مثل _id) ويملأ القيم الافتراضية،
+    و to_bson يحذف الحقول الاختيارية الفارغة (الافتراضي None) لتبقى المستندات مدمجة.
+    """
+    namespace: Dict[str, Any] = {"cls": cls}
+    decode = ["def from_bson(doc):", "    get = doc.get", "    return cls("]
+    encode = ["def to_bson(record):", "    out = {"]
+    optional: List[str] = []
+
+    for index, f in enumerate(fields(cls)):
+        if f.default is not MISSING:
+            namespace[f"_default_{index}"] = f.default
+            decode.append(f"        get({f.name!r}, _default_{index}),")
+        elif f.default_factory is not MISSING:
+            namespace[f"_factory_{index}"] = f.default_factory
+            decode.append(f"        doc[{f.name!r}] if {f.name!r} in doc else _factory_{index}(),")
+        else:
+            decode.append(f"        doc[{f.name!r}],")
+
+        if f.default is None:
+            optional.append(f.name)
+        else:
+            encode.append(f"        {f.name!r}: record.{f.name},")
+
+    decode.append("    )")
+    encode.append("    }")
+    for name in optional:
+        encode.append(f"    if record.{name} is not None:")
+        encode.append(f"        out[{name!r}] = record.{name}")
+    encode.append("    return out")
+
+    exec(compile("\n".join(decode), f"<codec {cls.__name__}.from_bson>", "exec"), namespace)
+    exec(compile("\n".join(encode), f"<codec {cls.__name__}.to_bson>", "exec"), namespace)
+    cls.from_bson = staticmethod(namespace["from_bson"])
+    cls.to_bson = namespace["to_bson"]
+
+
+def record(cls: Type[T]) -> Type[T]:
+    """مُزخرف: dataclass بـ __slots__ مع محولات BSON مُجمّعة"""
+    cls = dataclass(slots=True)(cls)
+    _compile_codec(cls)
+    return cls
+
+
+@record
+class UserRecord:
+    """المستخدم كما يُخزن في users_collection"""
+    id: str
+    name: str
+    email: str
+    phone: str
+    role: str
+    status: str = "active"
+    avatar: Optional[str] = None
+    password_hash: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.now)
+    updated_at: datetime = field(default_factory=datetime.now)
+    last_login: Optional[datetime] = None
+    email_verified: bool = False
+    phone_verified: bool = False
+
+
+@record
+class LawyerRecord:
+    """المحامي كما يُخزن في lawyers_collection (بطاقة المحامي)"""
+    id: str
+    name: str
+    specialization: str = ""
+    description: str = ""
+    bio: str = ""
+    rating: float = 0.0
+    reviews_count: int = 0
+    price: float = 0
+    hourly_rate: Optional[float] = None
+    image: Optional[str] = None
+    available: bool = True
+    is_verified: bool = False
+    experience_years: int = 0
+    languages: List[str] = field(default_factory=lambda: ["العربية"])
+    certificates: List[str] = field(default_factory=list)
+    education: List[str] = field(default_factory=list)
+    license_number: Optional[str] = None
+    email: Optional[str] = None
+    phone: Optional[str] = None
+    status: str = "active"
+    working_hours: Dict[str, Dict[str, Any]] = field(default_factory=default_working_hours)
+    timezone: Optional[str] = None
+
+    @staticmethod
+    def from_user(user: Dict[str, Any]) -> "LawyerRecord":
+        """بناء بطاقة المحامي من مستند المستخدم (دون بيانات الدخول)"""
+        lawyer = LawyerRecord.from_bson(user)
+        lawyer.image = user.get("avatar")
+        if not lawyer.price and lawyer.hourly_rate:
+            lawyer.price = lawyer.hourly_rate
+        return lawyer
+
+
+@record
+class AppointmentRecord:
+    """الموعد كما يُخزن في appointments_collection"""
+    id: str
+    lawyer_id: str
+    client_id: str
+    date: str
+    time: str
+    consultation_type: str
+    lawyer_name: str = ""
+    specialization: str = ""
+    status: str = "pending"
+    notes: str = ""
+    created_at: datetime = field(default_factory=datetime.now)
+    payment_status: Optional[str] = None
+    invoice_id: Optional[str] = None
+    payment_amount: Optional[float] = None
+    # date و time كما أدخلهما العميل بتوقيت المحامي، و slot_start/slot_end بتوقيت UTC
+    slot_start: Optional[datetime] = None
+    slot_end: Optional[datetime] = None
+    timezone: Optional[str] = None
+
+
+@record
+class PaymentRecord:
+    """سجل الدفع كما يُخزن في payments_collection"""
+    id: str
+    appointment_id: str
+    amount: float
+    customer_name: str
+    customer_email: str
+    customer_mobile: str
+    lawyer_name: str
+    consultation_type: str
+    invoice_id: Optional[str] = None
+    payment_id: Optional[str] = None
+    currency: str = "SAR"
+    status: str = "pending"
+    payment_method: Optional[str] = None
+    gateway: str = "myfatoorah"
+    payment_url: Optional[str] = None
+    transaction_date: Optional[datetime] = None
+    refund_amount: Optional[float] = None
+    refund_reason: Optional[str] = None
+    # مهمة الاسترداد الجارية (تمنع إرسال استردادين لنفس الدفعة)
+    refund_job_id: Optional[str] = None
+    # "unknown": استرداد انتهى دون نتيجة مؤكدة، يُطابق مع البوابة قبل أي طلب جديد
+    refund_status: Optional[str] = None
+    refund_id: Optional[str] = None
+    # دفعة مؤكدة لموعد ملغى أو انتهت مهلته (يجب استردادها)
+    refund_required: bool = False
+    # نهاية صلاحية الفاتورة المعلقة (حتى تُعاد لطلبات الدفع المتكررة لنفس الموعد)
+    expires_at: Optional[datetime] = None
+    created_at: datetime = field(default_factory=datetime.now)
+    updated_at: datetime = field(default_factory=datetime.now)
+    metadata: Optional[Dict[str, Any]] = None
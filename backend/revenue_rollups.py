@@ -0,0 +1,235 @@
+"""
+تجميعات الإيرادات - Revenue Rollups
+حاويات يومية وشهرية مُجمّعة مسبقاً (لكل محامٍ، لكل تخصص، وللمنصة) تُحدّث تدريجياً
+مع انتقالات حالة الدفع، وتُعاد بناؤها من سجلات الدفع عند الحاجة.
+"""
+
+import os
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from payment_transitions import DUPLICATE_KEY_ERROR
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("day", "month")
+SCOPES = ("platform", "lawyer", "specialization")
+
+
+def period_of(moment: datetime, granularity: str) -> Tuple[str, datetime]:
+    """مفتاح الفترة وبدايتها لتاريخ معين"""
+    if granularity == "day":
+        start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+        return start.strftime("%Y-%m-%d"), start
+    start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    return start.strftime("%Y-%m"), start
+
+
+def revenue_event(kind: str, payment_record: Dict[str, Any], amount: float,
+                  occurred_at: Optional[datetime] = None) -> Dict[str, Any]:
+    """حدث إيراد للصندوق الصادر (kind: paid أو refunded). معرف الحدث يمنع احتسابه مرتين"""
+    return {"type": "revenue", "payload": {
+        "event_id": f"{payment_record['id']}:{kind}",
+        "kind": kind,
+        "appointment_id": payment_record["appointment_id"],
+        "amount": amount,
+        "occurred_at": occurred_at or datetime.now(),
+    }}
+
+
+class RevenueRollups:
+    """
+    كل حاوية مستند واحد: {scope, key, granularity, period, period_start, amount, count,
+    refund_amount, refund_count}. استعلام أي نطاق زمني يقرأ عدد الحاويات فقط لا عدد الدفعات.
+    """
+
+    def __init__(self, rollups_collection, events_collection, payments_collection, appointments_collection):
+        self.rollups = rollups_collection
+        self.events = events_collection
+        self.payments = payments_collection
+        self.appointments = appointments_collection
+        self.batch_size = int(os.getenv("REVENUE_BACKFILL_BATCH_SIZE", "1000"))
+        # سجل الأحداث المطبقة يكفي أن يغطي نافذة إعادة المحاولة في الصندوق الصادر
+        self.event_retention = int(os.getenv("REVENUE_EVENT_RETENTION_SECONDS", str(30 * 24 * 3600)))
+
+    def ensure_indexes(self):
+        self.rollups.create_index([
+            ("scope", ASCENDING), ("key", ASCENDING), ("granularity", ASCENDING), ("period_start", ASCENDING)
+        ])
+        self.events.create_index("created_at", expireAfterSeconds=self.event_retention)
+
+    @staticmethod
+    def _targets(lawyer_id: Optional[str], specialization: Optional[str]) -> List[Tuple[str, str]]:
+        targets = [("platform", "all")]
+        if lawyer_id:
+            targets.append(("lawyer", lawyer_id))
+        if specialization:
+            targets.append(("specialization", specialization))
+        return targets
+
+    @staticmethod
+    def _increments(kind: str, amount: float) -> Dict[str, Any]:
+        if kind == "refunded":
+            return {"refund_amount": amount, "refund_count": 1}
+        return {"amount": amount, "count": 1}
+
+    def _accumulate(self, buckets: Dict[str, Dict[str, Any]], event: Dict[str, Any]) -> None:
+        """دمج حدث في حاويات الذاكرة (مفتاح الحاوية ← المعرف والزيادات)"""
+        increments = self._increments(event["kind"], event["amount"])
+        for scope, key in self._targets(event.get("lawyer_id"), event.get("specialization")):
+            for granularity in GRANULARITIES:
+                period, period_start = period_of(event["occurred_at"], granularity)
+                bucket_id = f"{scope}:{key}:{granularity}:{period}"
+                bucket = buckets.setdefault(bucket_id, {
+                    "identity": {"scope": scope, "key": key, "granularity": granularity,
+                                 "period": period, "period_start": period_start},
+                    "inc": {"amount": 0, "count": 0, "refund_amount": 0, "refund_count": 0},
+                })
+                for field, value in increments.items():
+                    bucket["inc"][field] += value
+
+    def _resolve(self, payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """إضافة المحامي والتخصص لكل حدث باستعلام واحد للمواعيد"""
+        appointment_ids = list({payload["appointment_id"] for payload in payloads})
+        appointments = {
+            appointment["id"]: appointment
+            for appointment in self.appointments.find(
+                {"id": {"$in": appointment_ids}}, {"_id": 0, "id": 1, "lawyer_id": 1, "specialization": 1}
+            )
+        }
+        resolved = []
+        for payload in payloads:
+            appointment = appointments.get(payload["appointment_id"], {})
+            resolved.append({
+                **payload,
+                "lawyer_id": appointment.get("lawyer_id"),
+                "specialization": appointment.get("specialization") or None,
+            })
+        return resolved
+
+    def record(self, payloads: List[Dict[str, Any]]) -> int:
+        """
+        تطبيق أحداث الإيراد تدريجياً. الأحداث المطبقة سابقاً (إعادة محاولة الصندوق الصادر)
+        تُتجاهل بفضل سجل الأحداث ذي المعرف الفريد. يُعاد عدد الأحداث المطبقة.
+        يُكتب الحدث في السجل بعد نجاح الزيادات فقط: فشل الكتابة أو توقف العملية بينهما يعيد تطبيقه
+        في المحاولة التالية بدلاً من فقدان الإيراد.
+        """
+        if not payloads:
+            return 0
+        applied = {
+            event["_id"] for event in
+            self.events.find({"_id": {"$in": [payload["event_id"] for payload in payloads]}}, {"_id": 1})
+        }
+        fresh = list({
+            payload["event_id"]: payload for payload in payloads if payload["event_id"] not in applied
+        }.values())
+        if not fresh:
+            return 0
+
+        buckets: Dict[str, Dict[str, Any]] = {}
+        for event in self._resolve(fresh):
+            self._accumulate(buckets, event)
+        self.rollups.bulk_write([
+            UpdateOne(
+                {"_id": bucket_id},
+                {"$setOnInsert": bucket["identity"], "$inc": bucket["inc"]},
+                upsert=True,
+            )
+            for bucket_id, bucket in buckets.items()
+        ], ordered=False)
+
+        now = datetime.now()
+        try:
+            self.events.insert_many(
+                [{"_id": payload["event_id"], "created_at": now} for payload in fresh], ordered=False
+            )
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+        return len(fresh)
+
+    def _payment_events(self) -> Iterable[Dict[str, Any]]:
+        """أحداث الإيراد المستنتجة من سجلات الدفع الحالية"""
+        cursor = self.payments.find(
+            {"status": {"$in": ["paid", "refunded"]}},
+            {"_id": 0, "id": 1, "appointment_id": 1, "amount": 1, "status": 1,
+             "refund_amount": 1, "transaction_date": 1, "created_at": 1, "updated_at": 1},
+            batch_size=self.batch_size,
+        )
+        for payment in cursor:
+            paid_at = payment.get("transaction_date") or payment.get("created_at") or datetime.now()
+            yield {"kind": "paid", "appointment_id": payment["appointment_id"],
+                   "amount": payment["amount"], "occurred_at": paid_at}
+            if payment["status"] == "refunded":
+                yield {"kind": "refunded", "appointment_id": payment["appointment_id"],
+                       "amount": payment.get("refund_amount") or payment["amount"],
+                       "occurred_at": payment.get("updated_at") or paid_at}
+
+    def backfill(self) -> Dict[str, int]:
+        """
+        إعادة بناء جميع الحاويات من سجلات الدفع في مجموعة مؤقتة ثم استبدال المجموعة الحالية بها.
+        الأحداث التي تصل أثناء إعادة البناء قد تُفقد؛ تشغيل البناء مرة أخرى يصححها.
+        """
+        buckets: Dict[str, Dict[str, Any]] = {}
+        events = 0
+        batch: List[Dict[str, Any]] = []
+        for event in self._payment_events():
+            batch.append(event)
+            if len(batch) >= self.batch_size:
+                for resolved in self._resolve(batch):
+                    self._accumulate(buckets, resolved)
+                events += len(batch)
+                batch = []
+        if batch:
+            for resolved in self._resolve(batch):
+                self._accumulate(buckets, resolved)
+            events += len(batch)
+
+        staging = self.rollups.database[f"{self.rollups.name}_rebuild"]
+        staging.drop()
+        documents = [{"_id": bucket_id, **bucket["identity"], **bucket["inc"]} for bucket_id, bucket in buckets.items()]
+        for start in range(0, len(documents), self.batch_size):
+            staging.insert_many(documents[start:start + self.batch_size], ordered=False)
+        if documents:
+            staging.rename(self.rollups.name, dropTarget=True)
+        else:
+            self.rollups.delete_many({})
+        self.ensure_indexes()
+        logger.info(f"Revenue rollups rebuilt: {events} events into {len(documents)} buckets")
+        return {"events": events, "buckets": len(documents)}
+
+    def query(self, scope: str, key: str = "all", granularity: str = "month",
+              since: Optional[datetime] = None, until: Optional[datetime] = None) -> Dict[str, Any]:
+        """الحاويات ضمن النطاق بالترتيب الزمني مع مجموعها"""
+        criteria: Dict[str, Any] = {"scope": scope, "key": key, "granularity": granularity}
+        if since or until:
+            criteria["period_start"] = {}
+            if since:
+                criteria["period_start"]["$gte"] = period_of(since, granularity)[1]
+            if until:
+                criteria["period_start"]["$lt"] = until
+        buckets = list(self.rollups.find(criteria, {"_id": 0, "scope": 0, "key": 0}).sort("period_start", ASCENDING))
+        totals = {"amount": 0, "count": 0, "refund_amount": 0, "refund_count": 0}
+        for bucket in buckets:
+            for field in totals:
+                totals[field] += bucket.get(field, 0)
+        totals["net_amount"] = totals["amount"] - totals["refund_amount"]
+        return {"scope": scope, "key": key, "granularity": granularity, "buckets": buckets, "totals": totals}
+
+    def earnings(self, lawyer_id: str, since: Optional[datetime] = None) -> float:
+        """صافي أرباح المحامي (المدفوع ناقص المسترد) من الحاويات الشهرية"""
+        return self.query("lawyer", lawyer_id, "month", since=since)["totals"]["net_amount"]
+
+    def earnings_breakdown(self, lawyer_id: str, since: datetime) -> Tuple[float, float]:
+        """صافي الأرباح الكلي وصافيها منذ since من نفس الحاويات الشهرية (استعلام واحد بدل اثنين)"""
+        monthly = self.query("lawyer", lawyer_id, "month")
+        since_start = period_of(since, "month")[1]
+        recent = sum(
+            bucket.get("amount", 0) - bucket.get("refund_amount", 0)
+            for bucket in monthly["buckets"] if bucket["period_start"] >= since_start
+        )
+        return monthly["totals"]["net_amount"], recent
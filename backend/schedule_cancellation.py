@@ -0,0 +1,228 @@
+"""
+إلغاء جدول محامٍ واسترداد دفعاته - Bulk Schedule Cancellation
+عملية إدارية في طابور المهام: تحديد المواعيد القادمة بمسح نطاق على فهرس (lawyer_id, slot_start)،
+إلغاؤها بتحديث واحد، ثم استرداد دفعاتها من ماي فاتورة بتزامن محدود وحد معدل، وتطبيق النتائج
+على دفعات بـ bulk_write مع تحديث تقدم المهمة بعد كل دفعة.
+"""
+
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from pymongo import UpdateOne
+
+from admission_control import InMemoryBucketBackend
+from appointment_slots import UPCOMING_STATUSES, utc_now
+from payment_service import REFUND_UNKNOWN, REFUND_UNKNOWN_MESSAGE
+from revenue_rollups import revenue_event
+
+logger = logging.getLogger(__name__)
+
+MAX_REPORTED_FAILURES = 50
+
+RefundCall = Callable[..., Awaitable[Dict[str, Any]]]
+
+
+class ScheduleCancellation:
+    """
+    كل خطوة آمنة للتكرار ضمن نفس المهمة: المواعيد تُعلَّم بمعرف المهمة، والدفعات تُحجز بـ refund_job_id
+    قبل طلب الاسترداد (لا ترسل مهمتان استرداداً للدفعة نفسها)، وأحداث الصندوق الصادر بمعرفات ثابتة.
+    الدفعة التي رفضت البوابة استردادها يُحرر حجزها لإعادة طلبها لاحقاً؛ أما التي انتهى استردادها
+    دون نتيجة مؤكدة فتبقى محجوزة بـ refund_status="unknown" حتى المطابقة مع البوابة.
+    """
+
+    def __init__(self, appointments_collection, payments_collection, transitions, refund: RefundCall,
+                 on_refunded: Optional[Callable[[List[str]], None]] = None):
+        self.appointments = appointments_collection
+        self.payments = payments_collection
+        self.transitions = transitions
+        self.refund = refund
+        self.on_refunded = on_refunded
+        self.chunk_size = int(os.getenv("BULK_REFUND_CHUNK_SIZE", "20"))
+        self.concurrency = int(os.getenv("BULK_REFUND_CONCURRENCY", "5"))
+        # حد معدل طلبات الاسترداد لبوابة الدفع (مشترك بين مهام العملية)
+        self.rate = float(os.getenv("BULK_REFUND_RATE", "5"))
+        self.burst = float(os.getenv("BULK_REFUND_BURST", str(self.rate)))
+        self.buckets = InMemoryBucketBackend(max_keys=1)
+        self.counters = {"jobs": 0, "cancelled": 0, "refunded": 0, "failed": 0, "unknown": 0}
+
+    # ---- الإلغاء ----
+
+    def _window(self, lawyer_id: str, since: datetime, until: datetime) -> Dict[str, Any]:
+        return {"lawyer_id": lawyer_id, "slot_start": {"$gte": since, "$lt": until}}
+
+    def cancel_appointments(self, job_id: str, lawyer_id: str, since: datetime, until: datetime,
+                            reason: str) -> List[Dict[str, Any]]:
+        """إلغاء المواعيد القادمة في النافذة (تحديث واحد) وإرجاع ما ألغته هذه المهمة"""
+        window = self._window(lawyer_id, since, until)
+        self.appointments.update_many(
+            {**window, "status": {"$in": UPCOMING_STATUSES}},
+            {"$set": {
+                "status": "cancelled",
+                "cancellation_reason": reason,
+                "cancelled_by_job": job_id,
+                "cancelled_at": utc_now(),
+            }}
+        )
+        return list(self.appointments.find(
+            {**window, "cancelled_by_job": job_id},
+            {"_id": 0, "id": 1, "date": 1, "time": 1, "lawyer_name": 1}
+        ).sort("slot_start", 1))
+
+    def reserve_payments(self, job_id: str, appointment_ids: List[str]) -> List[Dict[str, Any]]:
+        """حجز الدفعات المؤكدة للمواعيد الملغاة لهذه المهمة (الدفعات المحجوزة لاسترداد آخر تُستثنى)"""
+        if not appointment_ids:
+            return []
+        self.payments.update_many(
+            {"appointment_id": {"$in": appointment_ids}, "status": "paid", "refund_job_id": None},
+            {"$set": {"refund_job_id": job_id}}
+        )
+        return list(self.payments.find(
+            {"appointment_id": {"$in": appointment_ids}, "status": "paid", "refund_job_id": job_id},
+            {"_id": 0, "id": 1, "payment_id": 1, "appointment_id": 1, "amount": 1}
+        ))
+
+    # ---- الاسترداد ----
+
+    async def _throttle(self):
+        while True:
+            allowed, wait = self.buckets.consume("refunds", 1.0, self.rate, self.burst)
+            if allowed:
+                return
+            await asyncio.sleep(wait)
+
+    async def _refund_one(self, semaphore: asyncio.Semaphore, payment: Dict[str, Any],
+                          reason: str) -> Dict[str, Any]:
+        async with semaphore:
+            await self._throttle()
+            try:
+                return await self.refund(payment_id=payment["payment_id"], amount=payment["amount"], reason=reason)
+            except Exception as e:
+                # الاستثناء لا يثبت أن البوابة لم تنفذ الاسترداد
+                logger.error(f"خطأ في استرداد الدفعة {payment['payment_id']}: {e}")
+                return {"success": False, "ambiguous": True, "error": REFUND_UNKNOWN_MESSAGE}
+
+    def apply_results(self, job_id: str, reason: str, payments: List[Dict[str, Any]],
+                      results: List[Dict[str, Any]]) -> List[str]:
+        """
+        تطبيق نتائج دفعة من الاستردادات بكتابتين مجمعتين. الأحداث تُكتب أولاً: إذا توقفت العملية بعدها
+        تبقى الدفعات محجوزة للمراجعة بدلاً من استرداد مُنفذ دون إشعار أو قيد إيراد.
+        """
+        now = datetime.now()
+        refunded = [(payment, result) for payment, result in zip(payments, results) if result.get("success")]
+        events = []
+        for payment, result in refunded:
+            events.append({"type": "notification", "payload": {
+                "kind": "payment_refunded",
+                "appointment_id": payment["appointment_id"],
+                "payment_record_id": payment["id"],
+                "amount": payment["amount"],
+            }})
+            events.append(revenue_event("refunded", payment, payment["amount"]))
+        if events:
+            self.transitions.publish(f"{job_id}:refunds:{payments[0]['payment_id']}", events)
+
+        payment_operations = []
+        for payment, result in zip(payments, results):
+            reserved = {"payment_id": payment["payment_id"], "status": "paid", "refund_job_id": job_id}
+            if result.get("success"):
+                payment_operations.append(UpdateOne(reserved, {"$set": {
+                    "status": "refunded",
+                    "refund_amount": payment["amount"],
+                    "refund_reason": reason,
+                    "refund_id": result.get("refund_id"),
+                    "updated_at": now,
+                }}))
+            elif result.get("ambiguous"):
+                payment_operations.append(UpdateOne(reserved, {"$set": {
+                    "refund_status": REFUND_UNKNOWN,
+                    "refund_reason": reason,
+                }}))
+            else:
+                payment_operations.append(UpdateOne(reserved, {"$set": {"refund_job_id": None}}))
+        self.payments.bulk_write(payment_operations, ordered=False)
+        if refunded:
+            self.appointments.bulk_write([
+                UpdateOne({"id": payment["appointment_id"]}, {"$set": {"payment_status": "refunded"}})
+                for payment, _ in refunded
+            ], ordered=False)
+        return [payment["payment_id"] for payment, _ in refunded]
+
+    def _notify_cancelled(self, job_id: str, appointments: List[Dict[str, Any]], reason: str):
+        if appointments:
+            self.transitions.publish(f"{job_id}:cancelled", [
+                {"type": "notification", "payload": {
+                    "kind": "appointment_cancelled",
+                    "appointment_id": appointment["id"],
+                    "date": appointment.get("date"),
+                    "time": appointment.get("time"),
+                    "lawyer_name": appointment.get("lawyer_name"),
+                    "reason": reason,
+                }}
+                for appointment in appointments
+            ])
+
+    async def run(self, job_id: str, lawyer_id: str, since: datetime, until: datetime, reason: str,
+                  progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+        """تنفيذ الإلغاء والاسترداد؛ progress يُستدعى (في خيط) بعد كل دفعة بملخص التقدم"""
+        self.counters["jobs"] += 1
+        appointments = await asyncio.to_thread(self.cancel_appointments, job_id, lawyer_id, since, until, reason)
+        await asyncio.to_thread(self._notify_cancelled, job_id, appointments, reason)
+        payments = await asyncio.to_thread(self.reserve_payments, job_id, [a["id"] for a in appointments])
+        self.counters["cancelled"] += len(appointments)
+
+        summary: Dict[str, Any] = {
+            "lawyer_id": lawyer_id,
+            "cancelled": len(appointments),
+            "payments": len(payments),
+            "refunded": 0,
+            "failed": 0,
+            # استردادات نتيجتها غير معروفة (تبقى محجوزة حتى المطابقة)
+            "unknown": 0,
+            "refunded_amount": 0.0,
+        }
+        failures: List[Dict[str, Any]] = []
+        if progress is not None:
+            await asyncio.to_thread(progress, dict(summary))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        for i in range(0, len(payments), self.chunk_size):
+            chunk = payments[i:i + self.chunk_size]
+            results = await asyncio.gather(*(self._refund_one(semaphore, payment, reason) for payment in chunk))
+            refunded_ids = await asyncio.to_thread(self.apply_results, job_id, reason, chunk, results)
+            if refunded_ids and self.on_refunded is not None:
+                self.on_refunded(refunded_ids)
+            for payment, result in zip(chunk, results):
+                if result.get("success"):
+                    summary["refunded"] += 1
+                    summary["refunded_amount"] += payment["amount"]
+                else:
+                    ambiguous = bool(result.get("ambiguous"))
+                    summary["unknown" if ambiguous else "failed"] += 1
+                    if len(failures) < MAX_REPORTED_FAILURES:
+                        failures.append({
+                            "payment_id": payment["payment_id"],
+                            "error": result.get("error"),
+                            "ambiguous": ambiguous,
+                        })
+            if progress is not None:
+                await asyncio.to_thread(progress, dict(summary))
+
+        self.counters["refunded"] += summary["refunded"]
+        self.counters["failed"] += summary["failed"]
+        self.counters["unknown"] += summary["unknown"]
+        logger.info(
+            f"Schedule of lawyer {lawyer_id} cancelled by job {job_id}: {summary['cancelled']} appointments, "
+            f"{summary['refunded']}/{summary['payments']} payments refunded"
+        )
+        return {**summary, "failures": failures}
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "chunk_size": self.chunk_size,
+            "concurrency": self.concurrency,
+            "rate": self.rate,
+        }
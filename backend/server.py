@@ -1,11 +1,13 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Header, status
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+import asyncio
 import uuid
 import os
-from pymongo import MongoClient
 from bson import ObjectId
 import logging
 
@@ -13,18 +15,44 @@ import logging
 import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from payment_service import myfatoorah_service
+from payment_service import myfatoorah_service, REFUND_UNKNOWN, REFUND_UNKNOWN_MESSAGE
+from caching import TTLCache, SingleFlight
+from payment_transitions import PaymentTransitions, OutboxWorker, DUPLICATE_KEY_ERROR
+from notification_service import NotificationService
+from audit_log import AuditLogWriter
+from session_service import SessionService, SessionError
+from revenue_rollups import RevenueRollups, revenue_event
+from analytics import PlatformAnalytics, default_window
+from dashboard import DashboardComposer, DashboardSection
+from appointment_slots import (
+    AppointmentSlots, DEFAULT_TIMEZONE, UPCOMING_STATUSES, RELEASED_STATUSES, is_valid_timezone, utc_now, to_utc
+)
+from appointment_scheduler import AppointmentScheduler
+from job_queue import JobQueue, JobError
+from schedule_cancellation import ScheduleCancellation
+from idempotency import IdempotencyStore, IDEMPOTENCY_HEADER
+from loaders import RequestLoaders, LoaderScopeMiddleware, current_loaders, loader_registry
+from json_response import (
+    FastJSONResponse, serialize_many, serialize_lawyer_card, serialize_appointment,
+    serialize_review, serialize_user, serialize_consultation
+)
 from payment_models import (
     PaymentRequest, PaymentResponse, PaymentVerification, 
     PaymentStatus, RefundRequest, RefundResponse, 
-    PaymentRecord, WebhookPayload
+    WebhookPayload
 )
+from records import PaymentRecord, AppointmentRecord, LawyerRecord, UserRecord
+from http_caching import ConditionalGetMiddleware, CompressionMiddleware, CACHE_RULES, collection_versions
+from admission_control import AdmissionController, AdmissionControlMiddleware
+from startup_manager import StartupManager, PhaseSteps
+from shared_state import create_shared_state, InvalidationBus
+from health_checks import HealthMonitor, mongo_primary_probe, replication_lag_probe, gateway_probe
 
 # استيراد نظام المصادقة
 from auth_service import auth_service, get_current_user, require_role, UserRoles
 from user_models import (
-    UserRegister, UserLogin, PasswordReset, PasswordUpdate,
-    User, Client, Lawyer, Admin, TokenResponse, UserResponse,
+    UserRegister, UserLogin, TokenRefresh, PasswordReset, PasswordUpdate,
+    User, Client, Lawyer, Admin, TokenResponse, RefreshResponse, UserResponse,
     ProfileUpdate, UserStats, LawyerStats, ClientStats,
     UserRole, UserStatus
 )
@@ -33,9 +61,20 @@ from user_models import (
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Debra Legal Consultations API")
+app = FastAPI(title="Debra Legal Consultations API", default_response_class=FastJSONResponse)
+
+# نطاق محمّلات الدفعات لكل طلب (الطبقة الأعمق)
+app.add_middleware(LoaderScopeMiddleware)
+
+# ETag والرد بـ 304 (داخلي) ثم الضغط
+app.add_middleware(ConditionalGetMiddleware)
+app.add_middleware(CompressionMiddleware)
 
-# إعداد CORS
+# التحكم في القبول: حدود المعدل والتزامن قبل أي عمل على قاعدة البيانات أو البوابة
+admission_controller = AdmissionController()
+app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
+
+# إعداد CORS (الطبقة الخارجية لتحمل ردود 304/429 ترويسات CORS)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -44,41 +83,88 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# الاتصال بقاعدة البيانات
-try:
-    mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017/')
-    client = MongoClient(mongo_url)
-    db = client['debra_legal']
-    
-    # مجموعات قاعدة البيانات
-    lawyers_collection = db['lawyers']
-    appointments_collection = db['appointments']
-    consultations_collection = db['consultations']
-    users_collection = db['users']
-    payments_collection = db['payments']
-    sessions_collection = db['sessions']  # جلسات المستخدمين
-    notifications_collection = db['notifications']  # الإشعارات
-    reviews_collection = db['reviews']  # التقييمات
-    admin_logs_collection = db['admin_logs']  # سجلات الإدارة
-    
-    logger.info("تم الاتصال بقاعدة البيانات بنجاح")
-except Exception as e:
-    logger.error(f"خطأ في الاتصال بقاعدة البيانات: {e}")
+# الاتصال بقاعدة البيانات (العميل لا يتصل فعلياً إلا في مراحل بدء التشغيل)
+from database import (
+    client, db, ping as ping_database, warm_pool,
+    lawyers_collection, appointments_collection, consultations_collection,
+    users_collection, payments_collection, sessions_collection,
+    notifications_collection, reviews_collection, admin_logs_collection,
+    outbox_collection, revenue_rollups_collection, revenue_events_collection,
+    scheduled_tasks_collection, jobs_collection, idempotency_collection,
+    # قراءات متسامحة مع التقادم (الثانويون): للإحصائيات وقوائم التقييمات فقط
+    lawyers_reads, appointments_reads, consultations_reads, users_reads,
+    payments_reads, reviews_reads,
+)
 
-# النماذج
-class Lawyer(BaseModel):
-    id: str
-    name: str
-    specialization: str
-    description: str
-    rating: float
-    price: int
-    image: Optional[str] = None
-    available: bool = True
-    experience_years: int
-    languages: List[str]
-    certificates: List[str]
+# الحالة المشتركة بين العمليات ونشر أحداث إبطال الذاكرة المؤقتة
+shared_state = create_shared_state()
+invalidation_bus = InvalidationBus(shared_state)
+
+# كل كتابة في مجموعة (تحديث ملف محامٍ، تقييم جديد...) تُنشر لباقي العمليات لتحديث وسوم ETag
+collection_versions.add_listener(lambda name, version: invalidation_bus.publish("collection", [name, version]))
+invalidation_bus.register("collection", lambda key: collection_versions.apply(*key))
+
+def share_collection_versions():
+    """مزامنة عدادات إصدار المجموعات مع الحالة المشتركة"""
+    names = {name for rule in CACHE_RULES for name in rule.collections}
+    collection_versions.share(shared_state, names)
+
+# انتقالات حالة الدفع والصندوق الصادر
+payment_transitions = PaymentTransitions(
+    client, payments_collection, appointments_collection, outbox_collection
+)
+outbox_worker = OutboxWorker(outbox_collection, payment_transitions)
+
+# طابور المهام الخلفية (الأعمال البطيئة تخرج من مسار الطلب: تقييمات المحامين، التحقق، الاسترداد)
+job_queue = JobQueue(jobs_collection)
+JOB_PRIORITY_PAYMENTS = 10
+JOB_PRIORITY_ACCOUNTS = 5
+
+# مفاتيح عدم التكرار: إعادة محاولة الحجز أو الدفع أو الاسترداد تعيد الاستجابة الأولى دون تكرار العمل
+idempotency_store = IdempotencyStore(idempotency_collection)
+
+# خدمة الإشعارات (طابور داخل العملية مع إدراج على دفعات)
+notification_service = NotificationService(notifications_collection, users_collection)
+
+# سجل تدقيق الإدارة (كتابة على دفعات)
+audit_log = AuditLogWriter(admin_logs_collection)
+
+# محمّلات الدفعات: طلبات المعرفات في نفس الدورة تُحل باستعلام $in واحد لكل مجموعة
+loader_registry.register("lawyers", lawyers_collection)
+loader_registry.register("appointments", appointments_collection)
+loader_registry.register("users", users_collection, projection={"_id": 0, "password_hash": 0})
+loader_registry.register("review_authors", users_reads, projection={"id": 1, "name": 1, "avatar": 1, "_id": 0})
+
+# جلسات المستخدمين (تسجيل الدخول وتدوير رموز التجديد)
+session_service = SessionService(users_collection, sessions_collection)
+
+# تجميعات الإيرادات (تُحدّث من أحداث الصندوق الصادر)
+revenue_rollups = RevenueRollups(
+    revenue_rollups_collection, revenue_events_collection, payments_collection, appointments_collection
+)
+
+# أوقات المواعيد بتوقيت UTC (استعلامات القادم والتداخل والتقويم على فهارس slot_start)
+appointment_slots = AppointmentSlots(appointments_collection, lawyers_collection)
+AVAILABILITY_WINDOW_DAYS = int(os.getenv("AVAILABILITY_WINDOW_DAYS", "30"))
+
+# تذكيرات المواعيد وانتهاء مهلة الدفع (مهام بوقت استحقاق مفهرس، إشعاراتها عبر الصندوق الصادر)
+appointment_scheduler = AppointmentScheduler(
+    scheduled_tasks_collection, appointments_collection, outbox_collection, on_events=outbox_worker.notify,
+    payments_collection=payments_collection
+)
 
+# لوحات التحكم: مهلة لكل قسم ومدة تخزين حسب تحمل القسم للتقادم
+dashboard_composer = DashboardComposer()
+DASHBOARD_SECTION_TIMEOUT = float(os.getenv("DASHBOARD_SECTION_TIMEOUT", "2"))
+DASHBOARD_STATS_TTL = float(os.getenv("DASHBOARD_STATS_TTL", "60"))
+DASHBOARD_REVIEWS_TTL = float(os.getenv("DASHBOARD_REVIEWS_TTL", "30"))
+DASHBOARD_FAVORITES_TTL = float(os.getenv("DASHBOARD_FAVORITES_TTL", "300"))
+
+# تحليلات الإدارة (قراءات متسامحة مع التقادم، مع ذاكرة مؤقتة لكل نافذة زمنية)
+platform_analytics = PlatformAnalytics(appointments_reads, payments_reads, reviews_reads, lawyers_reads)
+analytics_flight = SingleFlight()
+
+# النماذج
 class Appointment(BaseModel):
     id: str
     lawyer_id: str
@@ -90,6 +176,14 @@ class Appointment(BaseModel):
     notes: Optional[str] = None
     created_at: datetime
 
+class ScheduleCancellationRequest(BaseModel):
+    reason: str
+    # النافذة: since/until صريحة، أو الأيام القادمة من الآن
+    days: int = 30
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    mark_unavailable: bool = False
+
 class Consultation(BaseModel):
     id: str
     lawyer_id: str
@@ -100,18 +194,14 @@ class Consultation(BaseModel):
     ended_at: Optional[datetime] = None
     messages: List[dict] = []
 
-class User(BaseModel):
-    id: str
-    name: str
-    email: str
-    phone: str
-    user_type: str  # client or lawyer
-    created_at: datetime
-
 # بيانات تجريبية للمحامين
+def sample_lawyer_id(number: int) -> str:
+    """معرف ثابت للمحامي التجريبي: نفس المعرف في كل عملية، فلا تتكرر البيانات عند بدء عدة عمليات معاً"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"debra-legal/sample-lawyer/{number}"))
+
 sample_lawyers = [
     {
-        "id": str(uuid.uuid4()),
+        "id": sample_lawyer_id(1),
         "name": "المحامي أحمد محمد",
         "specialization": "القانون التجاري",
         "description": "محامٍ متخصص في القانون التجاري والشركات مع خبرة 15 عام",
@@ -124,7 +214,7 @@ sample_lawyers = [
         "certificates": ["بكالوريوس الحقوق", "ماجستير القانون التجاري"]
     },
     {
-        "id": str(uuid.uuid4()),
+        "id": sample_lawyer_id(2),
         "name": "المحامية فاطمة علي",
         "specialization": "قانون الأسرة",
         "description": "محامية متخصصة في قضايا الأسرة والأحوال الشخصية",
@@ -137,7 +227,7 @@ sample_lawyers = [
         "certificates": ["بكالوريوس الحقوق", "دبلوم قانون الأسرة"]
     },
     {
-        "id": str(uuid.uuid4()),
+        "id": sample_lawyer_id(3),
         "name": "المحامي عبدالرحمن سعد",
         "specialization": "القانون الجنائي",
         "description": "محامٍ متخصص في القضايا الجنائية والدفاع الجنائي",
@@ -150,7 +240,7 @@ sample_lawyers = [
         "certificates": ["بكالوريوس الحقوق", "ماجستير القانون الجنائي"]
     },
     {
-        "id": str(uuid.uuid4()),
+        "id": sample_lawyer_id(4),
         "name": "المحامية نور الهدى",
         "specialization": "قانون العمل",
         "description": "محامية متخصصة في قضايا العمل والتأمينات الاجتماعية",
@@ -163,7 +253,7 @@ sample_lawyers = [
         "certificates": ["بكالوريوس الحقوق", "دبلوم قانون العمل"]
     },
     {
-        "id": str(uuid.uuid4()),
+        "id": sample_lawyer_id(5),
         "name": "المحامي خالد الأحمد",
         "specialization": "القانون العقاري",
         "description": "محامٍ متخصص في القضايا العقارية والتطوير العقاري",
@@ -176,7 +266,7 @@ sample_lawyers = [
         "certificates": ["بكالوريوس الحقوق", "ماجستير القانون العقاري"]
     },
     {
-        "id": str(uuid.uuid4()),
+        "id": sample_lawyer_id(6),
         "name": "المحامية سارة محمود",
         "specialization": "قانون الملكية الفكرية",
         "description": "محامية متخصصة في براءات الاختراع والملكية الفكرية",
@@ -190,45 +280,209 @@ sample_lawyers = [
     }
 ]
 
-# إدراج البيانات التجريبية
-@app.on_event("startup")
-async def startup_event():
-    """إدراج البيانات التجريبية عند بدء التشغيل"""
-    try:
-        # التحقق من وجود بيانات محامين
-        if lawyers_collection.count_documents({}) == 0:
-            lawyers_collection.insert_many(sample_lawyers)
+# إدراج البيانات التجريبية (تُنفذ في الخلفية كمرحلة من مراحل بدء التشغيل)
+def seed_sample_data():
+    """
+    إدراج البيانات التجريبية وإنشاء مستخدم المدير الافتراضي. كل عملية تنفذها عند بدء التشغيل،
+    فالإدراج بمعرفات ثابتة (_id للمحامين والبريد الفريد للمدير) والعملية التي تسبقها غيرها تتجاهل التكرار.
+    """
+    # التحقق من وجود بيانات محامين
+    if lawyers_collection.count_documents({}) == 0:
+        try:
+            lawyers_collection.insert_many(
+                [{**lawyer, "_id": lawyer["id"]} for lawyer in sample_lawyers], ordered=False
+            )
             logger.info("تم إدراج البيانات التجريبية للمحامين")
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+                raise
+    
+    # إنشاء مستخدم مدير افتراضي
+    admin_exists = users_collection.find_one({"role": "admin"})
+    if not admin_exists:
+        admin_id = str(uuid.uuid4())
+        admin_password = auth_service.hash_password("admin123456")
+        
+        admin_user = {
+            "id": admin_id,
+            "name": "مدير النظام",
+            "email": "admin@debra-legal.com",
+            "phone": "501234567",
+            "role": "admin",
+            "status": "active",
+            "avatar": None,
+            "created_at": datetime.now(),
+            "updated_at": datetime.now(),
+            "last_login": None,
+            "email_verified": True,
+            "phone_verified": True,
+            "password_hash": admin_password,
+            "permissions": ["all"],
+            "department": "إدارة النظام"
+        }
         
-        # إنشاء مستخدم مدير افتراضي
-        admin_exists = users_collection.find_one({"role": "admin"})
-        if not admin_exists:
-            admin_id = str(uuid.uuid4())
-            admin_password = auth_service.hash_password("admin123456")
-            
-            admin_user = {
-                "id": admin_id,
-                "name": "مدير النظام",
-                "email": "admin@debra-legal.com",
-                "phone": "501234567",
-                "role": "admin",
-                "status": "active",
-                "avatar": None,
-                "created_at": datetime.now(),
-                "updated_at": datetime.now(),
-                "last_login": None,
-                "email_verified": True,
-                "phone_verified": True,
-                "password_hash": admin_password,
-                "permissions": ["all"],
-                "department": "إدارة النظام"
-            }
-            
-            users_collection.insert_one(admin_user)
+        try:
+            result = users_collection.update_one(
+                {"email": admin_user["email"]}, {"$setOnInsert": admin_user}, upsert=True
+            )
+        except DuplicateKeyError:
+            return
+        if result.upserted_id is not None:
             logger.info("تم إنشاء مستخدم مدير افتراضي - admin@debra-legal.com / admin123456")
-            
+
+# فهارس الصندوق الصادر والإشعارات وسجل التدقيق ومجموعات التطبيق: كل خطوة مستقلة، فلا يمنع فشل
+# فهرس واحد إنشاء البقية ويظهر باسمه في تقرير بدء التشغيل
+index_steps = PhaseSteps({
+    "payment_transitions": payment_transitions.ensure_indexes,
+    "notifications": notification_service.ensure_indexes,
+    "audit_log": audit_log.ensure_indexes,
+    "revenue_rollups": revenue_rollups.ensure_indexes,
+    "sessions": session_service.ensure_indexes,
+    "appointment_slots": appointment_slots.ensure_indexes,
+    "appointment_scheduler": appointment_scheduler.ensure_indexes,
+    "jobs": job_queue.ensure_indexes,
+    "idempotency": idempotency_store.ensure_indexes,
+    # فهارس القراءات حسب المحامي والعميل والموعد (حتى لا تتناسب تكلفتها مع حجم المنصة)
+    "lawyers.id": lambda: lawyers_collection.create_index("id"),
+    "appointments.id": lambda: appointments_collection.create_index("id"),
+    "appointments.client_created": lambda: appointments_collection.create_index(
+        [("client_id", ASCENDING), ("created_at", DESCENDING)]
+    ),
+    "appointments.lawyer_created": lambda: appointments_collection.create_index(
+        [("lawyer_id", ASCENDING), ("created_at", DESCENDING)]
+    ),
+    "consultations.id": lambda: consultations_collection.create_index("id"),
+    "consultations.lawyer_started": lambda: consultations_collection.create_index(
+        [("lawyer_id", ASCENDING), ("started_at", DESCENDING)]
+    ),
+    "payments.appointment_id": lambda: payments_collection.create_index("appointment_id"),
+    "reviews.lawyer_created": lambda: reviews_collection.create_index(
+        [("lawyer_id", ASCENDING), ("created_at", DESCENDING)]
+    ),
+})
+
+# الفهارس الفريدة شرط للجاهزية: بدونها تُقبل تسجيلات بنفس البريد وحجوزات لنفس الوقت
+unique_index_steps = PhaseSteps({
+    "users": session_service.ensure_unique_indexes,
+    "appointment_slots": appointment_slots.ensure_unique_slots,
+})
+
+# مراحل بدء التشغيل: الاتصال (مع إعادة المحاولة) ثم تهيئة الاتصالات والفهارس معاً ثم البيانات التجريبية
+# (الفهارس والبيانات آمنة للتكرار، فتُعاد محاولتها بعد خطأ مؤقت بدل بقاء العملية بدونها؛
+# البيانات بعد الفهارس الفريدة حتى يمنع البريد الفريد تكرار المدير بين العمليات)
+startup_manager = StartupManager()
+startup_manager.register("connect", lambda: ping_database(int(os.getenv("MONGO_PING_TIMEOUT_MS", "2000"))),
+                         stage=0, required=True, retry=True)
+startup_manager.register("shared_state", share_collection_versions, stage=0, retry=True)
+startup_manager.register("warm_pool", lambda: warm_pool(int(os.getenv("MONGO_WARM_CONNECTIONS", "4"))), stage=1)
+startup_manager.register("unique_indexes", unique_index_steps, stage=1, required=True, retry=True)
+startup_manager.register("indexes", index_steps, stage=1, retry=True)
+startup_manager.register("seed", seed_sample_data, stage=2, retry=True)
+
+# فحوصات الاعتماديات الدورية (نتائجها مخزنة لنقاط /live و /ready و /health/details)
+health_monitor = HealthMonitor()
+health_monitor.register("mongodb_primary", mongo_primary_probe(client))
+# تأخر ثانوي واحد (أو نقص صلاحية replSetGetStatus) يظهر كتدهور ولا يخرج جميع العمليات من موازن الحمل معاً
+health_monitor.register(
+    "mongodb_replication",
+    replication_lag_probe(client, float(os.getenv("HEALTH_MAX_REPLICATION_LAG", "10"))),
+    critical=False
+)
+health_monitor.register("myfatoorah", gateway_probe(myfatoorah_service), critical=False)
+
+@app.on_event("startup")
+async def startup_event():
+    """بدء مراحل التشغيل والفحوصات الدورية في الخلفية؛ الخادم يستقبل الطلبات فوراً"""
+    await startup_manager.start()
+    await health_monitor.start()
+    await invalidation_bus.start()
+    await session_service.start()
+
+@app.get("/api/health/startup")
+async def startup_status():
+    """حالة مراحل بدء التشغيل وزمن كل منها"""
+    return startup_manager.report()
+
+# ========================
+# نقاط النهاية للمصادقة
+# ========================
+
+@app.post("/api/auth/register")
+async def register(user_data: UserRegister):
+    """تسجيل مستخدم جديد (حسابات المحامين تنتظر تحقق الإدارة)"""
+    if user_data.role == UserRole.ADMIN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="لا يمكن التسجيل كمدير")
+    
+    is_lawyer = user_data.role == UserRole.LAWYER
+    now = datetime.now()
+    user_document = UserRecord(
+        id=str(uuid.uuid4()),
+        name=user_data.name,
+        email=user_data.email,
+        phone=user_data.phone,
+        role=user_data.role.value,
+        status=UserStatus.PENDING.value if is_lawyer else UserStatus.ACTIVE.value,
+        created_at=now,
+        updated_at=now
+    ).to_bson()
+    if is_lawyer:
+        user_document.update({
+            "specialization": user_data.specialization or "",
+            "experience_years": user_data.experience_years or 0,
+            "license_number": user_data.license_number,
+            "bio": user_data.bio or "",
+            "is_verified": False
+        })
+    
+    try:
+        user = await session_service.register(user_document, user_data.password)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="البريد الإلكتروني مسجل مسبقاً")
     except Exception as e:
-        logger.error(f"خطأ في إدراج البيانات التجريبية: {e}")
+        logger.error(f"خطأ في تسجيل المستخدم: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في التسجيل")
+    
+    if is_lawyer:
+        return UserResponse(user=user, message="تم تسجيل طلبك وسيتم مراجعته من الإدارة")
+    
+    tokens = await session_service.issue_tokens(user)
+    return TokenResponse(**tokens, user=user)
+
+@app.post("/api/auth/login", response_model=TokenResponse)
+async def login(credentials: UserLogin):
+    """تسجيل الدخول بالبريد الإلكتروني وكلمة المرور"""
+    try:
+        return TokenResponse(**await session_service.login(credentials.email, credentials.password))
+    except SessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except Exception as e:
+        logger.error(f"خطأ في تسجيل الدخول: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في تسجيل الدخول")
+
+@app.post("/api/auth/refresh", response_model=RefreshResponse)
+async def refresh_token(request: TokenRefresh):
+    """تجديد رمز الوصول وتدوير رمز التجديد"""
+    try:
+        return RefreshResponse(**await session_service.refresh(request.refresh_token))
+    except SessionError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except Exception as e:
+        logger.error(f"خطأ في تجديد الرمز: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في تجديد الرمز")
+
+@app.post("/api/auth/logout")
+async def logout(current_user: dict = Depends(get_current_user)):
+    """تسجيل الخروج وإلغاء الجلسة"""
+    try:
+        await session_service.logout(current_user.get("sid"))
+    except Exception as e:
+        logger.error(f"خطأ في تسجيل الخروج: {e}")
+    return {"message": "تم تسجيل الخروج بنجاح"}
+
+@app.get("/api/admin/auth/metrics")
+async def get_auth_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """زمن كل خطوة من خطوات المصادقة (للمدراء)"""
+    return session_service.get_metrics()
 
 # ========================
 # نقاط النهاية لإدارة المستخدمين (للمدراء)
@@ -258,7 +512,8 @@ async def get_all_users(
             {"_id": 0, "password_hash": 0}
         ).skip(skip).limit(limit).sort("created_at", -1))
         
-        return [User(**user) for user in users]
+        # بيانات قاعدة البيانات موثوقة: تحويل مباشر دون بناء نموذج لكل صف
+        return FastJSONResponse(serialize_many(serialize_user, users))
         
     except Exception as e:
         logger.error(f"خطأ في جلب المستخدمين: {e}")
@@ -271,32 +526,31 @@ async def get_all_users(
 async def get_user_stats(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
     """إحصائيات المستخدمين للمدراء"""
     try:
-        total_users = users_collection.count_documents({})
-        total_clients = users_collection.count_documents({"role": UserRole.CLIENT})
-        total_lawyers = users_collection.count_documents({"role": UserRole.LAWYER})
-        total_admins = users_collection.count_documents({"role": UserRole.ADMIN})
-        active_users = users_collection.count_documents({"status": UserStatus.ACTIVE})
-        
-        # المستخدمين الجدد اليوم
+        # جميع العدادات باستعلام تجميع واحد بدل count_documents لكل عداد
         today_start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
-        new_users_today = users_collection.count_documents({
-            "created_at": {"$gte": today_start}
-        })
-        
-        # المستخدمين الجدد هذا الشهر
         month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        new_users_this_month = users_collection.count_documents({
-            "created_at": {"$gte": month_start}
-        })
+        counts = next(users_reads.aggregate([
+            {"$facet": {
+                "roles": [{"$group": {"_id": "$role", "count": {"$sum": 1}}}],
+                "active": [{"$match": {"status": UserStatus.ACTIVE.value}}, {"$count": "count"}],
+                # المستخدمين الجدد اليوم وهذا الشهر
+                "today": [{"$match": {"created_at": {"$gte": today_start}}}, {"$count": "count"}],
+                "month": [{"$match": {"created_at": {"$gte": month_start}}}, {"$count": "count"}],
+            }}
+        ]), {})
+        roles = {entry["_id"]: entry["count"] for entry in counts.get("roles", [])}
+        
+        def facet_count(name: str) -> int:
+            return counts[name][0]["count"] if counts.get(name) else 0
         
         return UserStats(
-            total_users=total_users,
-            total_clients=total_clients,
-            total_lawyers=total_lawyers,
-            total_admins=total_admins,
-            active_users=active_users,
-            new_users_today=new_users_today,
-            new_users_this_month=new_users_this_month
+            total_users=sum(roles.values()),
+            total_clients=roles.get(UserRole.CLIENT.value, 0),
+            total_lawyers=roles.get(UserRole.LAWYER.value, 0),
+            total_admins=roles.get(UserRole.ADMIN.value, 0),
+            active_users=facet_count("active"),
+            new_users_today=facet_count("today"),
+            new_users_this_month=facet_count("month")
         )
         
     except Exception as e:
@@ -332,13 +586,12 @@ async def update_user_status(
         )
         
         # تسجيل الإجراء
-        admin_logs_collection.insert_one({
-            "admin_id": current_user["user_id"],
-            "action": "update_user_status",
-            "target_user_id": user_id,
-            "details": {"new_status": new_status.value},
-            "timestamp": datetime.now()
-        })
+        audit_log.log(
+            current_user["user_id"],
+            "update_user_status",
+            target_user_id=user_id,
+            details={"new_status": new_status.value}
+        )
         
         return {"message": f"تم تحديث حالة المستخدم إلى {new_status.value}"}
         
@@ -362,43 +615,23 @@ async def verify_lawyer(
         lawyer_record = users_collection.find_one({
             "id": lawyer_id,
             "role": UserRole.LAWYER
-        })
+        }, {"_id": 1})
         if not lawyer_record:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="المحامي غير موجود"
             )
         
-        # تحديث حالة التحقق
-        users_collection.update_one(
-            {"id": lawyer_id},
-            {"$set": {
-                "is_verified": True,
-                "status": UserStatus.ACTIVE,
-                "updated_at": datetime.now()
-            }}
-        )
-        
-        # إضافة إلى مجموعة المحامين
-        lawyer_data = lawyer_record.copy()
-        lawyer_data.pop("_id", None)
-        lawyer_data.pop("password_hash", None)
-        lawyer_data["image"] = lawyer_data.get("avatar")
-        lawyers_collection.update_one(
-            {"id": lawyer_id},
-            {"$set": lawyer_data},
-            upsert=True
+        # تحديث الحساب وملف المحامي في طابور المهام
+        job_id = job_queue.enqueue(
+            "verify_lawyer", {"lawyer_id": lawyer_id},
+            priority=JOB_PRIORITY_ACCOUNTS, dedupe_key=f"verify_lawyer:{lawyer_id}"
         )
         
         # تسجيل الإجراء
-        admin_logs_collection.insert_one({
-            "admin_id": current_user["user_id"],
-            "action": "verify_lawyer",
-            "target_user_id": lawyer_id,
-            "timestamp": datetime.now()
-        })
+        audit_log.log(current_user["user_id"], "verify_lawyer", target_user_id=lawyer_id)
         
-        return {"message": "تم التحقق من المحامي وتفعيل حسابه"}
+        return {"message": "تم قبول المحامي وسيُفعّل حسابه خلال لحظات", "job_id": job_id}
         
     except HTTPException:
         raise
@@ -409,64 +642,121 @@ async def verify_lawyer(
             detail="خطأ في التحقق من المحامي"
         )
 
+@app.post("/api/admin/lawyers/{lawyer_id}/cancel-schedule", status_code=202)
+async def cancel_lawyer_schedule(
+    lawyer_id: str,
+    cancellation: ScheduleCancellationRequest,
+    current_user: dict = Depends(require_role([UserRoles.ADMIN]))
+):
+    """إلغاء مواعيد المحامي القادمة في نافذة زمنية واسترداد دفعاتها (مهمة خلفية؛ التقدم من /api/admin/jobs/{job_id})"""
+    since = to_utc(cancellation.since) if cancellation.since else utc_now()
+    until = to_utc(cancellation.until) if cancellation.until else since + timedelta(days=cancellation.days)
+    if until <= since:
+        raise HTTPException(status_code=400, detail="نهاية النافذة يجب أن تكون بعد بدايتها")
+    try:
+        lawyer_record = lawyers_collection.find_one({"id": lawyer_id}, {"_id": 1})
+        if not lawyer_record:
+            raise HTTPException(status_code=404, detail="المحامي غير موجود")
+        
+        if cancellation.mark_unavailable:
+            # إيقاف الحجوزات الجديدة قبل إلغاء القائمة
+            lawyers_collection.update_one({"id": lawyer_id}, {"$set": {"available": False}})
+        
+        job_id = str(uuid.uuid4())
+        job_queue.enqueue("cancel_lawyer_schedule", {
+            "job_id": job_id,
+            "lawyer_id": lawyer_id,
+            "since": since,
+            "until": until,
+            "reason": cancellation.reason
+        }, priority=JOB_PRIORITY_PAYMENTS, job_id=job_id)
+        
+        audit_log.log(current_user["user_id"], "cancel_lawyer_schedule", target_user_id=lawyer_id, details={
+            "job_id": job_id,
+            "since": since,
+            "until": until,
+            "reason": cancellation.reason,
+            "mark_unavailable": cancellation.mark_unavailable
+        })
+        
+        return {"message": "تمت جدولة إلغاء المواعيد واسترداد الدفعات", "job_id": job_id,
+                "since": since, "until": until}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"خطأ في إلغاء جدول المحامي: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في إلغاء جدول المحامي")
+
+@app.get("/api/admin/logs")
+async def get_admin_logs(
+    admin_id: Optional[str] = None,
+    target_user_id: Optional[str] = None,
+    action: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    page: int = 1,
+    limit: int = 50,
+    current_user: dict = Depends(require_role([UserRoles.ADMIN]))
+):
+    """جلب سجلات الإدارة (للمدراء فقط)"""
+    try:
+        # كتابة السجلات المعلقة أولاً ليظهر آخر الإجراءات
+        await audit_log.flush()
+        logs = audit_log.query(admin_id, target_user_id, action, since, until, page, limit)
+        return {"logs": logs, "page": page, "limit": limit}
+    except Exception as e:
+        logger.error(f"خطأ في جلب سجلات الإدارة: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="خطأ في جلب سجلات الإدارة"
+        )
+
 # ========================
 # نقاط النهاية للمحامين
 # ========================
 
+def count_by_status(collection, criteria: dict) -> dict:
+    """عدد المستندات لكل حالة باستعلام تجميع واحد بدل count_documents لكل حالة"""
+    return {
+        entry["_id"]: entry["count"]
+        for entry in collection.aggregate([
+            {"$match": criteria},
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ])
+    }
+
+def compute_lawyer_stats(lawyer_id: str) -> LawyerStats:
+    """حساب إحصائيات المحامي (متزامنة، تُنفذ في خيط منفصل)"""
+    # عدد المواعيد لكل حالة باستعلام تجميع واحد
+    statuses = count_by_status(appointments_reads, {"lawyer_id": lawyer_id})
+    
+    # الأرباح من حاويات الإيرادات الشهرية (صافي المدفوع بعد الاسترداد)
+    month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    total_earnings, this_month_earnings = revenue_rollups.earnings_breakdown(lawyer_id, since=month_start)
+    
+    # التقييمات (المتوسط والعدد من قاعدة البيانات بدل تحميل جميع التقييمات)
+    ratings = next(reviews_reads.aggregate([
+        {"$match": {"lawyer_id": lawyer_id}},
+        {"$group": {"_id": None, "average": {"$avg": "$rating"}, "count": {"$sum": 1}}}
+    ]), None) or {"average": 0, "count": 0}
+    
+    return LawyerStats(
+        total_appointments=sum(statuses.values()),
+        completed_appointments=statuses.get("completed", 0),
+        pending_appointments=statuses.get("pending", 0) + statuses.get("confirmed", 0),
+        cancelled_appointments=statuses.get("cancelled", 0),
+        total_earnings=total_earnings,
+        this_month_earnings=this_month_earnings,
+        average_rating=round(ratings["average"] or 0, 1),
+        total_reviews=ratings["count"]
+    )
+
 @app.get("/api/lawyer/stats", response_model=LawyerStats)
 async def get_lawyer_stats(current_user: dict = Depends(require_role([UserRoles.LAWYER]))):
     """إحصائيات المحامي"""
     try:
-        lawyer_id = current_user["user_id"]
-        
-        # إحصائيات المواعيد
-        total_appointments = appointments_collection.count_documents({"lawyer_id": lawyer_id})
-        completed_appointments = appointments_collection.count_documents({
-            "lawyer_id": lawyer_id,
-            "status": "completed"
-        })
-        pending_appointments = appointments_collection.count_documents({
-            "lawyer_id": lawyer_id,
-            "status": {"$in": ["pending", "confirmed"]}
-        })
-        cancelled_appointments = appointments_collection.count_documents({
-            "lawyer_id": lawyer_id,
-            "status": "cancelled"
-        })
-        
-        # الأرباح
-        total_earnings = 0
-        this_month_earnings = 0
-        
-        # حساب الأرباح من الدفعات المكتملة
-        payments = list(payments_collection.find({
-            "status": "paid"
-        }))
-        
-        month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        for payment in payments:
-            appointment = appointments_collection.find_one({"id": payment["appointment_id"]})
-            if appointment and appointment.get("lawyer_id") == lawyer_id:
-                total_earnings += payment["amount"]
-                if payment.get("transaction_date", datetime.min) >= month_start:
-                    this_month_earnings += payment["amount"]
-        
-        # التقييمات
-        reviews = list(reviews_collection.find({"lawyer_id": lawyer_id}))
-        total_reviews = len(reviews)
-        average_rating = sum(review["rating"] for review in reviews) / total_reviews if reviews else 0
-        
-        return LawyerStats(
-            total_appointments=total_appointments,
-            completed_appointments=completed_appointments,
-            pending_appointments=pending_appointments,
-            cancelled_appointments=cancelled_appointments,
-            total_earnings=total_earnings,
-            this_month_earnings=this_month_earnings,
-            average_rating=round(average_rating, 1),
-            total_reviews=total_reviews
-        )
+        return await asyncio.to_thread(compute_lawyer_stats, current_user["user_id"])
         
     except Exception as e:
         logger.error(f"خطأ في جلب إحصائيات المحامي: {e}")
@@ -477,99 +767,82 @@ async def get_lawyer_stats(current_user: dict = Depends(require_role([UserRoles.
 
 @app.get("/api/lawyer/dashboard")
 async def get_lawyer_dashboard(current_user: dict = Depends(require_role([UserRoles.LAWYER]))):
-    """لوحة تحكم المحامي"""
-    try:
-        lawyer_id = current_user["user_id"]
-        
-        # الحصول على الإحصائيات
-        stats_response = await get_lawyer_stats(current_user)
-        
+    """لوحة تحكم المحامي (الأقسام تُجلب معاً، والقسم المتأخر يُعاد فارغاً ويُذكر في partial)"""
+    lawyer_id = current_user["user_id"]
+    
+    sections = [
+        # الإحصائيات تتحمل تقادماً لدقيقة
+        DashboardSection("stats", lambda: compute_lawyer_stats(lawyer_id),
+                         DASHBOARD_SECTION_TIMEOUT, ttl=DASHBOARD_STATS_TTL),
         # المواعيد الأخيرة
-        recent_appointments = list(appointments_collection.find(
+        DashboardSection("recent_appointments", lambda: serialize_many(serialize_appointment, appointments_collection.find(
             {"lawyer_id": lawyer_id},
             {"_id": 0}
-        ).sort("created_at", -1).limit(5))
-        
+        ).sort("created_at", -1).limit(5)), DASHBOARD_SECTION_TIMEOUT, default=[]),
         # الاستشارات النشطة
-        active_consultations = list(consultations_collection.find(
+        DashboardSection("active_consultations", lambda: serialize_many(serialize_consultation, consultations_collection.find(
             {"lawyer_id": lawyer_id, "status": "active"},
             {"_id": 0}
-        ).sort("started_at", -1))
-        
+        ).sort("started_at", -1)), DASHBOARD_SECTION_TIMEOUT, default=[]),
         # التقييمات الأخيرة
-        recent_reviews = list(reviews_collection.find(
+        DashboardSection("recent_reviews", lambda: serialize_many(serialize_review, reviews_reads.find(
             {"lawyer_id": lawyer_id},
             {"_id": 0}
-        ).sort("created_at", -1).limit(5))
-        
-        return {
-            "stats": stats_response,
-            "recent_appointments": recent_appointments,
-            "active_consultations": active_consultations,
-            "recent_reviews": recent_reviews
-        }
-        
-    except Exception as e:
-        logger.error(f"خطأ في جلب لوحة تحكم المحامي: {e}")
+        ).sort("created_at", -1).limit(5)), DASHBOARD_SECTION_TIMEOUT, ttl=DASHBOARD_REVIEWS_TTL, default=[]),
+    ]
+    
+    dashboard = await dashboard_composer.compose(("lawyer", lawyer_id), sections)
+    if dashboard["stats"] is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="خطأ في جلب لوحة التحكم"
         )
+    return FastJSONResponse(dashboard)
 
 # ========================
 # نقاط النهاية للعملاء
 # ========================
 
+def compute_client_stats(client_id: str) -> ClientStats:
+    """حساب إحصائيات العميل باستعلام تجميع واحد (متزامنة، تُنفذ في خيط منفصل)"""
+    summary = next(appointments_reads.aggregate([
+        {"$match": {"client_id": client_id}},
+        {"$facet": {
+            # عدد المواعيد لكل حالة
+            "statuses": [{"$group": {"_id": "$status", "count": {"$sum": 1}}}],
+            # المحامين المفضلين (الأكثر حجزاً)
+            "favorites": [
+                {"$group": {"_id": "$lawyer_id", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}},
+                {"$limit": 5}
+            ],
+            # المبلغ المدفوع: دفعات مواعيد العميل فقط بدل مسح جميع الدفعات المدفوعة
+            "spent": [
+                {"$lookup": {"from": "payments", "localField": "id", "foreignField": "appointment_id", "as": "payment"}},
+                {"$unwind": "$payment"},
+                {"$match": {"payment.status": "paid"}},
+                {"$group": {"_id": None, "total": {"$sum": "$payment.amount"}}}
+            ],
+        }}
+    ]), None) or {}
+    
+    statuses = {entry["_id"]: entry["count"] for entry in summary.get("statuses", [])}
+    spent = summary.get("spent") or [{"total": 0}]
+    
+    return ClientStats(
+        total_appointments=sum(statuses.values()),
+        completed_appointments=statuses.get("completed", 0),
+        pending_appointments=statuses.get("pending", 0) + statuses.get("confirmed", 0),
+        cancelled_appointments=statuses.get("cancelled", 0),
+        total_spent=spent[0]["total"],
+        favorite_lawyers=[favorite["_id"] for favorite in summary.get("favorites", [])]
+    )
+
 @app.get("/api/client/stats", response_model=ClientStats)
 async def get_client_stats(current_user: dict = Depends(require_role([UserRoles.CLIENT]))):
     """إحصائيات العميل"""
     try:
-        client_id = current_user["user_id"]
-        
-        # إحصائيات المواعيد
-        total_appointments = appointments_collection.count_documents({"client_id": client_id})
-        completed_appointments = appointments_collection.count_documents({
-            "client_id": client_id,
-            "status": "completed"
-        })
-        pending_appointments = appointments_collection.count_documents({
-            "client_id": client_id,
-            "status": {"$in": ["pending", "confirmed"]}
-        })
-        cancelled_appointments = appointments_collection.count_documents({
-            "client_id": client_id,
-            "status": "cancelled"
-        })
-        
-        # المبلغ المدفوع
-        total_spent = 0
-        client_payments = list(payments_collection.find({
-            "status": "paid"
-        }))
-        
-        for payment in client_payments:
-            appointment = appointments_collection.find_one({"id": payment["appointment_id"]})
-            if appointment and appointment.get("client_id") == client_id:
-                total_spent += payment["amount"]
-        
-        # المحامين المفضلين (الأكثر حجزاً)
-        pipeline = [
-            {"$match": {"client_id": client_id}},
-            {"$group": {"_id": "$lawyer_id", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
-        favorite_lawyers = list(appointments_collection.aggregate(pipeline))
-        favorite_lawyer_ids = [lawyer["_id"] for lawyer in favorite_lawyers]
-        
-        return ClientStats(
-            total_appointments=total_appointments,
-            completed_appointments=completed_appointments,
-            pending_appointments=pending_appointments,
-            cancelled_appointments=cancelled_appointments,
-            total_spent=total_spent,
-            favorite_lawyers=favorite_lawyer_ids
-        )
+        return await asyncio.to_thread(compute_client_stats, current_user["user_id"])
         
     except Exception as e:
         logger.error(f"خطأ في جلب إحصائيات العميل: {e}")
@@ -578,51 +851,46 @@ async def get_client_stats(current_user: dict = Depends(require_role([UserRoles.
             detail="خطأ في جلب الإحصائيات"
         )
 
+def load_favorite_lawyers(client_id: str) -> List[dict]:
+    """المحامون الأكثر حجزاً من العميل، باستعلام واحد لبطاقاتهم"""
+    favorite_ids = [favorite["_id"] for favorite in appointments_reads.aggregate([
+        {"$match": {"client_id": client_id}},
+        {"$group": {"_id": "$lawyer_id", "count": {"$sum": 1}}},
+        {"$sort": {"count": -1}},
+        {"$limit": 5}
+    ])]
+    lawyers = {lawyer["id"]: lawyer for lawyer in lawyers_reads.find({"id": {"$in": favorite_ids}}, {"_id": 0})}
+    return [serialize_lawyer_card(lawyers[lawyer_id]) for lawyer_id in favorite_ids if lawyer_id in lawyers]
+
 @app.get("/api/client/dashboard")
 async def get_client_dashboard(current_user: dict = Depends(require_role([UserRoles.CLIENT]))):
-    """لوحة تحكم العميل"""
-    try:
-        client_id = current_user["user_id"]
-        
-        # الحصول على الإحصائيات
-        stats_response = await get_client_stats(current_user)
-        
-        # المواعيد القادمة
-        upcoming_appointments = list(appointments_collection.find(
-            {
-                "client_id": client_id,
-                "status": {"$in": ["confirmed", "pending"]},
-                "date": {"$gte": datetime.now().strftime("%Y-%m-%d")}
-            },
-            {"_id": 0}
-        ).sort("date", 1).limit(5))
-        
+    """لوحة تحكم العميل (الأقسام تُجلب معاً، والقسم المتأخر يُعاد فارغاً ويُذكر في partial)"""
+    client_id = current_user["user_id"]
+    
+    sections = [
+        DashboardSection("stats", lambda: compute_client_stats(client_id),
+                         DASHBOARD_SECTION_TIMEOUT, ttl=DASHBOARD_STATS_TTL),
+        # المواعيد القادمة بترتيب وقتها الفعلي (دون تخزين: يجب أن تكون حديثة دائماً)
+        DashboardSection("upcoming_appointments", lambda: serialize_many(
+            serialize_appointment, appointment_slots.upcoming(client_id)
+        ), DASHBOARD_SECTION_TIMEOUT, default=[]),
         # المواعيد الأخيرة
-        recent_appointments = list(appointments_collection.find(
+        DashboardSection("recent_appointments", lambda: serialize_many(serialize_appointment, appointments_collection.find(
             {"client_id": client_id},
             {"_id": 0}
-        ).sort("created_at", -1).limit(5))
-        
+        ).sort("created_at", -1).limit(5)), DASHBOARD_SECTION_TIMEOUT, default=[]),
         # المحامين المفضلين بالتفاصيل
-        favorite_lawyer_details = []
-        for lawyer_id in stats_response.favorite_lawyers:
-            lawyer = lawyers_collection.find_one({"id": lawyer_id}, {"_id": 0})
-            if lawyer:
-                favorite_lawyer_details.append(lawyer)
-        
-        return {
-            "stats": stats_response,
-            "upcoming_appointments": upcoming_appointments,
-            "recent_appointments": recent_appointments,
-            "favorite_lawyers": favorite_lawyer_details
-        }
-        
-    except Exception as e:
-        logger.error(f"خطأ في جلب لوحة تحكم العميل: {e}")
+        DashboardSection("favorite_lawyers", lambda: load_favorite_lawyers(client_id),
+                         DASHBOARD_SECTION_TIMEOUT, ttl=DASHBOARD_FAVORITES_TTL, default=[]),
+    ]
+    
+    dashboard = await dashboard_composer.compose(("client", client_id), sections)
+    if dashboard["stats"] is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="خطأ في جلب لوحة التحكم"
         )
+    return FastJSONResponse(dashboard)
 
 # ========================
 # نقاط النهاية للتقييمات
@@ -680,18 +948,11 @@ async def create_review(
         
         reviews_collection.insert_one(review)
         
-        # تحديث تقييم المحامي
-        lawyer_reviews = list(reviews_collection.find({"lawyer_id": appointment["lawyer_id"]}))
-        new_rating = sum(r["rating"] for r in lawyer_reviews) / len(lawyer_reviews)
-        
-        # تحديث في مجموعتي المحامين والمستخدمين
-        update_data = {
-            "rating": round(new_rating, 1),
-            "reviews_count": len(lawyer_reviews)
-        }
-        
-        lawyers_collection.update_one({"id": appointment["lawyer_id"]}, {"$set": update_data})
-        users_collection.update_one({"id": appointment["lawyer_id"]}, {"$set": update_data})
+        # إعادة حساب تقييم المحامي في الخلفية (التقييمات المتتالية لنفس المحامي تُدمج في مهمة واحدة)
+        job_queue.enqueue(
+            "lawyer_rating", {"lawyer_id": appointment["lawyer_id"]},
+            dedupe_key=f"lawyer_rating:{appointment['lawyer_id']}"
+        )
         
         return {"message": "تم إضافة التقييم بنجاح"}
         
@@ -709,28 +970,25 @@ async def get_lawyer_reviews(lawyer_id: str, page: int = 1, limit: int = 10):
     """جلب تقييمات المحامي"""
     try:
         skip = (page - 1) * limit
-        reviews = list(reviews_collection.find(
+        reviews = list(reviews_reads.find(
             {"lawyer_id": lawyer_id},
             {"_id": 0}
         ).skip(skip).limit(limit).sort("created_at", -1))
         
-        # إضافة تفاصيل العميل لكل تقييم
-        for review in reviews:
-            client = users_collection.find_one(
-                {"id": review["client_id"]},
-                {"name": 1, "avatar": 1, "_id": 0}
-            )
+        # إضافة تفاصيل العميل لكل تقييم (استعلام واحد لجميع العملاء)
+        clients = await current_loaders().review_authors.load_many(review["client_id"] for review in reviews)
+        for review, client in zip(reviews, clients):
             review["client_name"] = client.get("name", "عميل") if client else "عميل"
             review["client_avatar"] = client.get("avatar") if client else None
         
-        total_reviews = reviews_collection.count_documents({"lawyer_id": lawyer_id})
+        total_reviews = reviews_reads.count_documents({"lawyer_id": lawyer_id})
         
-        return {
-            "reviews": reviews,
+        return FastJSONResponse({
+            "reviews": serialize_many(serialize_review, reviews),
             "total": total_reviews,
             "page": page,
             "limit": limit
-        }
+        })
         
     except Exception as e:
         logger.error(f"خطأ في جلب التقييمات: {e}")
@@ -739,6 +997,43 @@ async def get_lawyer_reviews(lawyer_id: str, page: int = 1, limit: int = 10):
             detail="خطأ في جلب التقييمات"
         )
 
+# ========================
+# نقاط النهاية للإشعارات
+# ========================
+
+@app.get("/api/notifications")
+async def get_notifications(
+    unread_only: bool = False,
+    page: int = 1,
+    limit: int = 20,
+    current_user: dict = Depends(get_current_user)
+):
+    """جلب إشعارات المستخدم الحالي"""
+    try:
+        user_id = current_user["user_id"]
+        return {
+            "notifications": notification_service.list_for_user(user_id, unread_only, page, limit),
+            "unread_count": notification_service.unread_count(user_id),
+            "page": page,
+            "limit": limit
+        }
+    except Exception as e:
+        logger.error(f"خطأ في جلب الإشعارات: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في جلب الإشعارات")
+
+@app.post("/api/notifications/read")
+async def mark_notifications_read(
+    notification_ids: Optional[List[str]] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    """تعليم الإشعارات كمقروءة (جميعها إذا لم تُحدد)"""
+    try:
+        updated = notification_service.mark_read(current_user["user_id"], notification_ids)
+        return {"message": "تم تحديث الإشعارات", "updated": updated}
+    except Exception as e:
+        logger.error(f"خطأ في تحديث الإشعارات: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في تحديث الإشعارات")
+
 # نقاط النهاية الرئيسية
 @app.get("/")
 async def read_root():
@@ -748,8 +1043,8 @@ async def read_root():
 async def get_lawyers():
     """جلب قائمة جميع المحامين"""
     try:
-        lawyers = list(lawyers_collection.find({}, {"_id": 0}))
-        return lawyers
+        lawyers = lawyers_collection.find({}, {"_id": 0})
+        return FastJSONResponse(serialize_many(serialize_lawyer_card, lawyers))
     except Exception as e:
         logger.error(f"خطأ في جلب المحامين: {e}")
         raise HTTPException(status_code=500, detail="خطأ في جلب المحامين")
@@ -761,7 +1056,7 @@ async def get_lawyer(lawyer_id: str):
         lawyer = lawyers_collection.find_one({"id": lawyer_id}, {"_id": 0})
         if not lawyer:
             raise HTTPException(status_code=404, detail="المحامي غير موجود")
-        return lawyer
+        return FastJSONResponse(serialize_lawyer_card(lawyer))
     except Exception as e:
         logger.error(f"خطأ في جلب المحامي: {e}")
         raise HTTPException(status_code=500, detail="خطأ في جلب المحامي")
@@ -789,11 +1084,11 @@ async def lawyer_login(lawyer_id: str):
 async def get_lawyer_appointments(lawyer_id: str):
     """جلب مواعيد المحامي"""
     try:
-        appointments = list(appointments_collection.find(
+        appointments = appointments_collection.find(
             {"lawyer_id": lawyer_id}, 
             {"_id": 0}
-        ).sort("created_at", -1))
-        return appointments
+        ).sort("created_at", -1)
+        return FastJSONResponse(serialize_many(serialize_appointment, appointments))
     except Exception as e:
         logger.error(f"خطأ في جلب مواعيد المحامي: {e}")
         raise HTTPException(status_code=500, detail="خطأ في جلب مواعيد المحامي")
@@ -802,11 +1097,11 @@ async def get_lawyer_appointments(lawyer_id: str):
 async def get_lawyer_consultations(lawyer_id: str):
     """جلب استشارات المحامي"""
     try:
-        consultations = list(consultations_collection.find(
+        consultations = consultations_collection.find(
             {"lawyer_id": lawyer_id}, 
             {"_id": 0}
-        ).sort("started_at", -1))
-        return consultations
+        ).sort("started_at", -1)
+        return FastJSONResponse(serialize_many(serialize_consultation, consultations))
     except Exception as e:
         logger.error(f"خطأ في جلب استشارات المحامي: {e}")
         raise HTTPException(status_code=500, detail="خطأ في جلب استشارات المحامي")
@@ -816,18 +1111,13 @@ async def get_lawyer_stats(lawyer_id: str):
     """جلب إحصائيات المحامي"""
     try:
         # حساب الإحصائيات
-        total_appointments = appointments_collection.count_documents({"lawyer_id": lawyer_id})
-        active_consultations = consultations_collection.count_documents({
-            "lawyer_id": lawyer_id, 
-            "status": "active"
-        })
-        completed_consultations = consultations_collection.count_documents({
-            "lawyer_id": lawyer_id, 
-            "status": "completed"
-        })
+        total_appointments = appointments_reads.count_documents({"lawyer_id": lawyer_id})
+        consultations = count_by_status(consultations_reads, {"lawyer_id": lawyer_id})
+        active_consultations = consultations.get("active", 0)
+        completed_consultations = consultations.get("completed", 0)
         
         # حساب الأرباح (تقديري)
-        lawyer = lawyers_collection.find_one({"id": lawyer_id}, {"_id": 0})
+        lawyer = lawyers_reads.find_one({"id": lawyer_id}, {"_id": 0})
         estimated_earnings = completed_consultations * (lawyer.get("price", 0) if lawyer else 0)
         
         return {
@@ -857,8 +1147,11 @@ async def update_lawyer_profile(lawyer_id: str, profile_data: dict):
             "price": profile_data.get("price"),
             "experience_years": profile_data.get("experience_years"),
             "languages": profile_data.get("languages", []),
-            "certificates": profile_data.get("certificates", [])
+            "certificates": profile_data.get("certificates", []),
+            "timezone": profile_data.get("timezone")
         }
+        if update_data["timezone"] is not None and not is_valid_timezone(update_data["timezone"]):
+            raise HTTPException(status_code=400, detail="المنطقة الزمنية غير معروفة")
         
         # إزالة القيم الفارغة
         update_data = {k: v for k, v in update_data.items() if v is not None}
@@ -873,6 +1166,8 @@ async def update_lawyer_profile(lawyer_id: str, profile_data: dict):
         updated_lawyer = lawyers_collection.find_one({"id": lawyer_id}, {"_id": 0})
         return updated_lawyer
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"خطأ في تحديث ملف المحامي: {e}")
         raise HTTPException(status_code=500, detail="خطأ في تحديث ملف المحامي")
@@ -888,51 +1183,91 @@ async def update_appointment_status(appointment_id: str, status_data: dict):
         
         # تحديث الحالة
         new_status = status_data.get("status")
-        appointments_collection.update_one(
-            {"id": appointment_id},
-            {"$set": {"status": new_status}}
-        )
+        try:
+            appointments_collection.update_one(
+                {"id": appointment_id},
+                {"$set": {"status": new_status}}
+            )
+        except DuplicateKeyError:
+            # إعادة موعد ملغى إلى حالة قائمة بعد حجز وقته لموعد آخر
+            raise HTTPException(status_code=409, detail="هذا الوقت محجوز مسبقاً")
+        
+        # دعوة العميل لتقييم الاستشارة بعد اكتمالها
+        if new_status == "completed" and appointment.get("status") != "completed":
+            notification_service.enqueue(appointment["client_id"], "review_prompt", data={"appointment_id": appointment_id})
         
         return {"message": "تم تحديث حالة الموعد بنجاح"}
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"خطأ في تحديث حالة الموعد: {e}")
         raise HTTPException(status_code=500, detail="خطأ في تحديث حالة الموعد")
 
 @app.post("/api/appointments")
-async def create_appointment(appointment_data: dict):
-    """إنشاء موعد جديد"""
+async def create_appointment(
+    appointment_data: dict,
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    """إنشاء موعد جديد (المحاولة المكررة بنفس Idempotency-Key تعيد نفس الموعد)"""
+    return await idempotency_store.run(
+        idempotency_key, "create_appointment", appointment_data, lambda: book_appointment(appointment_data)
+    )
+
+async def book_appointment(appointment_data: dict):
+    """التحقق من الوقت وإدراج الموعد وجدولة مهامه"""
     try:
         # إنشاء معرف فريد للموعد
         appointment_id = str(uuid.uuid4())
         
         # البحث عن المحامي
-        lawyer = lawyers_collection.find_one({"id": appointment_data["lawyer_id"]}, {"_id": 0})
+        lawyer = await current_loaders().lawyers.load(appointment_data["lawyer_id"])
         if not lawyer:
             raise HTTPException(status_code=404, detail="المحامي غير موجود")
         
+        # وقت الموعد بتوقيت UTC حسب المنطقة الزمنية للمحامي
+        try:
+            slot = appointment_slots.slot_fields(lawyer, appointment_data["date"], appointment_data["time"])
+        except ValueError:
+            raise HTTPException(status_code=400, detail="صيغة التاريخ أو الوقت غير صحيحة (YYYY-MM-DD و HH:MM)")
+        
+        # التحقق من عدم تداخل الموعد مع موعد قائم للمحامي (الحجز المتزامن لنفس الوقت يمنعه فهرس فريد)
+        if appointment_slots.overlapping(lawyer["id"], slot["slot_start"], slot["slot_end"]):
+            raise HTTPException(status_code=409, detail="هذا الوقت محجوز مسبقاً")
+        
         # إنشاء بيانات الموعد
-        appointment = {
-            "id": appointment_id,
-            "lawyer_id": appointment_data["lawyer_id"],
-            "lawyer_name": lawyer["name"],
-            "specialization": lawyer["specialization"],
-            "client_id": appointment_data.get("client_id", "client_temp"),
-            "date": appointment_data["date"],
-            "time": appointment_data["time"],
-            "consultation_type": appointment_data["consultation_type"],
-            "status": "pending",
-            "notes": appointment_data.get("notes", ""),
-            "created_at": datetime.now()
-        }
+        appointment = AppointmentRecord(
+            id=appointment_id,
+            lawyer_id=appointment_data["lawyer_id"],
+            lawyer_name=lawyer["name"],
+            specialization=lawyer["specialization"],
+            client_id=appointment_data.get("client_id", "client_temp"),
+            date=appointment_data["date"],
+            time=appointment_data["time"],
+            consultation_type=appointment_data["consultation_type"],
+            notes=appointment_data.get("notes", ""),
+            **slot
+        ).to_bson()
         
         # إدراج الموعد في قاعدة البيانات
-        appointments_collection.insert_one(appointment)
+        try:
+            appointments_collection.insert_one(appointment)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail="هذا الوقت محجوز مسبقاً")
+        
+        # جدولة انتهاء مهلة الدفع والتذكيرات قبل الموعد
+        appointment_scheduler.schedule(appointment)
+        
+        # إشعارات الحجز (إضافة للطابور فقط)
+        notification_service.enqueue(appointment["client_id"], "booking_created", data={"appointment_id": appointment_id})
+        notification_service.enqueue(appointment["lawyer_id"], "booking_received", data={"appointment_id": appointment_id})
         
         # إرجاع الموعد بدون _id
         appointment.pop("_id", None)
         return appointment
     
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"خطأ في إنشاء الموعد: {e}")
         raise HTTPException(status_code=500, detail="خطأ في إنشاء الموعد")
@@ -945,8 +1280,8 @@ async def get_appointments(client_id: str = None):
         if client_id:
             filter_criteria["client_id"] = client_id
         
-        appointments = list(appointments_collection.find(filter_criteria, {"_id": 0}))
-        return appointments
+        appointments = appointments_collection.find(filter_criteria, {"_id": 0})
+        return FastJSONResponse(serialize_many(serialize_appointment, appointments))
     except Exception as e:
         logger.error(f"خطأ في جلب المواعيد: {e}")
         raise HTTPException(status_code=500, detail="خطأ في جلب المواعيد")
@@ -959,7 +1294,7 @@ async def create_consultation(consultation_data: dict):
         consultation_id = str(uuid.uuid4())
         
         # البحث عن المحامي
-        lawyer = lawyers_collection.find_one({"id": consultation_data["lawyer_id"]}, {"_id": 0})
+        lawyer = await current_loaders().lawyers.load(consultation_data["lawyer_id"])
         if not lawyer:
             raise HTTPException(status_code=404, detail="المحامي غير موجود")
         
@@ -994,7 +1329,7 @@ async def get_consultation(consultation_id: str):
         consultation = consultations_collection.find_one({"id": consultation_id}, {"_id": 0})
         if not consultation:
             raise HTTPException(status_code=404, detail="الجلسة غير موجودة")
-        return consultation
+        return FastJSONResponse(serialize_consultation(consultation))
     except Exception as e:
         logger.error(f"خطأ في جلب الجلسة: {e}")
         raise HTTPException(status_code=500, detail="خطأ في جلب الجلسة")
@@ -1063,11 +1398,11 @@ async def get_lawyer_availability(lawyer_id: str):
         if not lawyer:
             raise HTTPException(status_code=404, detail="المحامي غير موجود")
         
-        # جلب المواعيد المحجوزة
-        booked_appointments = list(appointments_collection.find(
-            {"lawyer_id": lawyer_id, "status": {"$ne": "cancelled"}},
-            {"date": 1, "time": 1, "_id": 0}
-        ))
+        # المواعيد المحجوزة في الأيام القادمة (مسح نطاق على فهرس lawyer_id + slot_start)
+        now = utc_now()
+        booked_appointments = appointment_slots.calendar(
+            lawyer_id, now, now + timedelta(days=AVAILABILITY_WINDOW_DAYS)
+        )
         
         # إرجاع الأوقات المتاحة (منطق بسيط)
         available_times = []
@@ -1075,11 +1410,12 @@ async def get_lawyer_availability(lawyer_id: str):
             time_slot = f"{hour:02d}:00"
             available_times.append(time_slot)
         
-        return {
+        return FastJSONResponse({
             "lawyer_id": lawyer_id,
+            "timezone": lawyer.get("timezone") or DEFAULT_TIMEZONE,
             "available_times": available_times,
             "booked_appointments": booked_appointments
-        }
+        })
     
     except Exception as e:
         logger.error(f"خطأ في جلب الأوقات المتاحة: {e}")
@@ -1112,11 +1448,11 @@ async def search_lawyers(
         # تطبيق البحث
         lawyers = list(lawyers_collection.find(search_criteria, {"_id": 0}))
         
-        return {
+        return FastJSONResponse({
             "count": len(lawyers),
-            "lawyers": lawyers,
+            "lawyers": serialize_many(serialize_lawyer_card, lawyers),
             "search_criteria": search_criteria
-        }
+        })
     
     except Exception as e:
         logger.error(f"خطأ في البحث: {e}")
@@ -1126,16 +1462,16 @@ async def search_lawyers(
 async def get_platform_stats():
     """جلب إحصائيات المنصة"""
     try:
-        total_lawyers = lawyers_collection.count_documents({})
-        total_appointments = appointments_collection.count_documents({})
-        active_consultations = consultations_collection.count_documents({"status": "active"})
-        completed_consultations = consultations_collection.count_documents({"status": "completed"})
+        # الإجماليات من بيانات المجموعة الوصفية (دون مسح المستندات)
+        total_lawyers = lawyers_reads.estimated_document_count()
+        total_appointments = appointments_reads.estimated_document_count()
+        consultations = count_by_status(consultations_reads, {"status": {"$in": ["active", "completed"]}})
         
         return {
             "total_lawyers": total_lawyers,
             "total_appointments": total_appointments,
-            "active_consultations": active_consultations,
-            "completed_consultations": completed_consultations
+            "active_consultations": consultations.get("active", 0),
+            "completed_consultations": consultations.get("completed", 0)
         }
     
     except Exception as e:
@@ -1144,130 +1480,478 @@ async def get_platform_stats():
 
 @app.get("/api/health")
 async def health_check():
-    """فحص صحة الخدمة"""
-    try:
-        # فحص قاعدة البيانات
-        db.command("ping")
-        return {
-            "status": "healthy",
-            "database": "connected",
-            "timestamp": datetime.now()
-        }
-    except Exception as e:
-        logger.error(f"خطأ في فحص الصحة: {e}")
-        return {
-            "status": "unhealthy",
-            "database": "disconnected",
-            "error": str(e),
-            "timestamp": datetime.now()
-        }
+    """فحص صحة الخدمة (من نتائج الفحوصات الدورية المخزنة)"""
+    database_ok = health_monitor.probe_status("mongodb_primary")
+    return {
+        "status": "healthy" if health_monitor.healthy else "unhealthy",
+        "database": "connected" if database_ok else "disconnected",
+        "timestamp": datetime.now()
+    }
+
+@app.get("/api/live")
+async def liveness_check():
+    """فحص الحياة: العملية تستجيب (دون أي استدعاء للاعتماديات)"""
+    return {"status": "alive"}
+
+@app.get("/api/ready")
+async def readiness_check():
+    """فحص الجاهزية: اكتمال مراحل بدء التشغيل المطلوبة ونجاح فحوصات الاعتماديات الحرجة"""
+    ready = startup_manager.ready and health_monitor.healthy
+    return FastJSONResponse(
+        {"status": "ready" if ready else "not_ready", "startup": startup_manager.ready, "dependencies": health_monitor.healthy},
+        status_code=200 if ready else 503
+    )
+
+@app.get("/api/health/details")
+async def health_details(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """تفاصيل صحة كل اعتمادية مع زمن الاستجابة ونتيجة آخر فحص (للمدراء: تكشف بنية الاتصال ورسائل الأخطاء)"""
+    return {
+        **health_monitor.report(),
+        "startup": startup_manager.report(),
+        "timestamp": datetime.now()
+    }
 
 # ========================
 # نقاط النهاية للدفع
 # ========================
 
+# حالات الدفع النهائية التي يمكن إرجاعها من الذاكرة المؤقتة دون الرجوع للبوابة
+TERMINAL_PAYMENT_STATUSES = {"paid", "failed", "refunded"}
+
+# الحالات السابقة المسموحة لكل انتقال: الدفعة المؤكدة أو المستردة لا تتراجع (ماي فاتورة تستمر في إرجاع
+# Paid بعد الاسترداد)، والفاتورة التي فشلت محاولة دفعها تبقى قابلة للدفع
+PAYMENT_PREVIOUS_STATUSES = {"paid": ["pending", "failed"], "failed": ["pending"], "expired": ["pending"]}
+
+verification_cache = TTLCache(
+    ttl=float(os.getenv("PAYMENT_VERIFY_CACHE_TTL", "60")),
+    max_size=int(os.getenv("PAYMENT_VERIFY_CACHE_SIZE", "10000"))
+)
+verification_flight = SingleFlight()
+
+# الفاتورة المعلقة تُعاد لنفس الموعد حتى انتهاء صلاحيتها بدلاً من إنشاء فاتورة جديدة. الصلاحية نفسها
+# تُرسل لماي فاتورة (ExpiryDate)، فلا توجد للموعد فاتورتان قابلتان للدفع في وقت واحد
+INVOICE_TTL = timedelta(minutes=int(os.getenv("PAYMENT_INVOICE_TTL_MINUTES", "30")))
+payment_session_flight = SingleFlight()
+
+def payable_invoice(payments: List[dict]) -> Optional[dict]:
+    """أحدث فاتورة معلقة ما زالت قابلة للدفع (السجلات القديمة بدون expires_at: من وقت إنشائها)"""
+    now = datetime.now()
+    for payment in payments:
+        expires_at = payment.get("expires_at") or payment["created_at"] + INVOICE_TTL
+        if payment["status"] == "pending" and payment.get("payment_url") and expires_at > now:
+            return payment
+    return None
+
+def invalidate_payment_verification(payment_id: str):
+    """حذف نتيجة التحقق المخزنة في هذه العملية وباقي العمليات"""
+    verification_cache.pop(payment_id)
+    invalidation_bus.publish("payment_verification", payment_id)
+
+invalidation_bus.register("payment_verification", verification_cache.pop)
+
+def payment_notification_event(kind: str, payment_record: dict) -> dict:
+    """حدث إشعار للصندوق الصادر مرتبط بدفعة"""
+    return {"type": "notification", "payload": {
+        "kind": kind,
+        "appointment_id": payment_record["appointment_id"],
+        "payment_record_id": payment_record["id"],
+        "amount": payment_record.get("amount")
+    }}
+
+def flag_paid_released_appointment(payment_record: dict, payment_id: Optional[str]) -> bool:
+    """
+    بعد تأكيد الدفع: إذا كان الموعد ملغى أو انتهت مهلته (وقد يكون وقته محجوزاً لعميل آخر) فإنه لا يعود
+    مؤكداً (الانتقال مقيد بـ UPCOMING_STATUSES)، وتُعلَّم الدفعة للاسترداد بدلاً من ذلك.
+    """
+    appointment = appointments_collection.find_one({"id": payment_record["appointment_id"]}, {"_id": 0, "status": 1})
+    if not appointment or appointment.get("status") not in RELEASED_STATUSES:
+        return False
+    payments_collection.update_one({"id": payment_record["id"]}, {"$set": {"refund_required": True}})
+    logger.warning(
+        f"Payment {payment_id} received for {appointment['status']} appointment "
+        f"{payment_record['appointment_id']}; flagged for refund"
+    )
+    audit_log.log(None, "payment_requires_refund", details={
+        "payment_record_id": payment_record["id"],
+        "payment_id": payment_id,
+        "appointment_id": payment_record["appointment_id"],
+        "appointment_status": appointment["status"]
+    })
+    return True
+
+async def handle_notification_events(payloads: List[dict]):
+    """
+    تحويل أحداث المواعيد إلى إشعارات لعملائها أو محاميها حسب recipient (استعلام واحد لجميع المواعيد).
+    تُكتب مباشرة في مجموعة الإشعارات قبل اعتبار الأحداث منجزة؛ فشل الكتابة يعيدها للصندوق الصادر.
+    """
+    loaders = RequestLoaders(loader_registry)
+    appointments = await loaders.appointments.load_many(payload["appointment_id"] for payload in payloads)
+    notifications = []
+    for payload, appointment in zip(payloads, appointments):
+        if appointment:
+            recipient = appointment.get(payload.get("recipient", "client_id"))
+            if recipient:
+                notifications.append(notification_service.build(
+                    recipient, payload["kind"], data=payload,
+                    notification_id=notification_service.event_id(recipient, payload["kind"], payload)
+                ))
+    stored = await asyncio.to_thread(notification_service.store, notifications)
+    await notification_service.dispatch(stored)
+
+async def handle_admin_log_events(payloads: List[dict]):
+    """كتابة سجلات الإدارة الواردة من الصندوق الصادر مباشرة (لا تمر بذاكرة الكاتب المؤقتة)"""
+    await asyncio.to_thread(audit_log.write, payloads)
+
+async def handle_revenue_events(payloads: List[dict]):
+    """تحديث حاويات الإيرادات من أحداث الدفع والاسترداد"""
+    await asyncio.to_thread(revenue_rollups.record, payloads)
+
+outbox_worker.register("notification", handle_notification_events)
+outbox_worker.register("admin_log", handle_admin_log_events)
+outbox_worker.register("revenue", handle_revenue_events)
+
+def recompute_lawyer_rating(lawyer_id: str) -> dict:
+    """متوسط تقييمات المحامي وعددها في مجموعتي المحامين والمستخدمين"""
+    ratings = next(reviews_collection.aggregate([
+        {"$match": {"lawyer_id": lawyer_id}},
+        {"$group": {"_id": None, "average": {"$avg": "$rating"}, "count": {"$sum": 1}}}
+    ]), None) or {"average": 0, "count": 0}
+    update_data = {"rating": round(ratings["average"], 1), "reviews_count": ratings["count"]}
+    lawyers_collection.update_one({"id": lawyer_id}, {"$set": update_data})
+    users_collection.update_one({"id": lawyer_id}, {"$set": update_data})
+    return update_data
+
+async def handle_lawyer_rating_job(payload: dict):
+    return await asyncio.to_thread(recompute_lawyer_rating, payload["lawyer_id"])
+
+def apply_lawyer_verification(lawyer_id: str) -> dict:
+    """تفعيل حساب المحامي ونسخ ملفه إلى مجموعة المحامين (آمن للتكرار)"""
+    lawyer_record = users_collection.find_one_and_update(
+        {"id": lawyer_id, "role": UserRole.LAWYER},
+        {"$set": {
+            "is_verified": True,
+            "status": UserStatus.ACTIVE,
+            "updated_at": datetime.now()
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+    if not lawyer_record:
+        raise JobError("المحامي غير موجود")
+    # بطاقة جديدة من ملف المستخدم عند أول تحقق فقط؛ البطاقة القائمة (الوصف والسعر والتقييم...) لا تُستبدل
+    verification = {"is_verified": True, "status": UserStatus.ACTIVE}
+    card = LawyerRecord.from_user(lawyer_record).to_bson()
+    for key in verification:
+        card.pop(key, None)
+    lawyers_collection.update_one(
+        {"id": lawyer_id},
+        {"$set": verification, "$setOnInsert": card},
+        upsert=True
+    )
+    return {"lawyer_id": lawyer_id, "is_verified": True}
+
+async def handle_verify_lawyer_job(payload: dict):
+    return await asyncio.to_thread(apply_lawyer_verification, payload["lawyer_id"])
+
+async def handle_refund_job(payload: dict):
+    """طلب الاسترداد من ماي فاتورة ثم تحديث الدفعة والموعد معاً"""
+    payment_id = payload["payment_id"]
+    payment_record = await asyncio.to_thread(payments_collection.find_one, {"payment_id": payment_id})
+    if not payment_record or payment_record["status"] != "paid":
+        return {"success": False, "error": "الدفعة غير مؤكدة أو مستردة مسبقاً"}
+    
+    refund_result = await myfatoorah_service.refund_payment(
+        payment_id=payment_id,
+        amount=payload["amount"],
+        reason=payload["reason"]
+    )
+    
+    if not refund_result["success"]:
+        if refund_result.get("ambiguous"):
+            # قد يكون الاسترداد نُفذ: إعادة الطلب قبل المطابقة قد تسترد المبلغ مرتين
+            update = {"$set": {"refund_status": REFUND_UNKNOWN, "refund_reason": payload["reason"]}}
+        else:
+            # رفض صريح من البوابة: تحرير الحجز ليتمكن المدير من إعادة الطلب
+            update = {"$set": {"refund_job_id": None}}
+        await asyncio.to_thread(payments_collection.update_one, {"payment_id": payment_id}, update)
+        raise JobError(refund_result.get("error") or "خطأ في عملية الاسترداد")
+    
+    await complete_refund(payment_record, payload["amount"], payload["reason"], refund_result.get("refund_id"))
+    return refund_result
+
+async def complete_refund(payment_record: dict, amount: float, reason: str, refund_id: Optional[str]):
+    """تسجيل استرداد منفذ في البوابة: تحديث الدفعة والموعد معاً مع أحداث الإشعار والإيراد والتدقيق"""
+    payment_id = payment_record["payment_id"]
+    invalidate_payment_verification(payment_id)
+    
+    # تحديث سجل الدفع والموعد معاً
+    await asyncio.to_thread(
+        payment_transitions.apply,
+        payment_filter={"payment_id": payment_id, "status": "paid"},
+        payment_update={
+            "status": "refunded",
+            "refund_amount": amount,
+            "refund_reason": reason,
+            "refund_id": refund_id,
+            "refund_status": None,
+            "updated_at": datetime.now()
+        },
+        appointment_id=payment_record["appointment_id"],
+        appointment_update={
+            "payment_status": "refunded",
+            "status": "cancelled"
+        },
+        events=[
+            payment_notification_event("payment_refunded", payment_record),
+            revenue_event("refunded", payment_record, amount),
+            {"type": "admin_log", "payload": {
+                "admin_id": None,
+                "action": "refund_payment",
+                "target_payment_id": payment_id,
+                "details": {
+                    "amount": amount,
+                    "reason": reason,
+                    "refund_id": refund_id
+                },
+                "timestamp": datetime.now()
+            }}
+        ]
+    )
+    outbox_worker.notify()
+
+async def reconcile_refund(payment_record: dict) -> bool:
+    """
+    مطابقة استرداد نتيجته غير معروفة مع البوابة قبل أي طلب جديد. True إذا كان قد نُفذ (ويُسجل الآن)،
+    و False إذا تأكد عدم تنفيذه (ويُحرر الحجز). الحالة غير المؤكدة بعد ترفض الطلب بـ 409.
+    """
+    status_result = await myfatoorah_service.get_refund_status(payment_record["invoice_id"])
+    if not status_result["success"] or status_result.get("pending"):
+        raise HTTPException(status_code=409, detail=REFUND_UNKNOWN_MESSAGE)
+    
+    if status_result["refunded"]:
+        await complete_refund(
+            payment_record,
+            status_result.get("amount") or payment_record["amount"],
+            payment_record.get("refund_reason") or "",
+            status_result.get("refund_id"),
+        )
+        return True
+    
+    await asyncio.to_thread(
+        payments_collection.update_one,
+        {"payment_id": payment_record["payment_id"], "refund_status": REFUND_UNKNOWN},
+        {"$set": {"refund_job_id": None, "refund_status": None}}
+    )
+    return False
+
+job_queue.register("lawyer_rating", handle_lawyer_rating_job)
+job_queue.register("verify_lawyer", handle_verify_lawyer_job)
+# الاسترداد غير آمن للتكرار: محاولة واحدة، والحجز المنتهي يفشل المهمة للمراجعة بدلاً من إعادتها
+job_queue.register("refund_payment", handle_refund_job, max_attempts=1)
+
+# إلغاء جدول محامٍ: استردادات متزامنة بحد معدل، والمهمة قد تتجاوز مهلة الرؤية (يمدد الطابور حجزها)
+schedule_cancellation = ScheduleCancellation(
+    appointments_collection, payments_collection, payment_transitions, myfatoorah_service.refund_payment,
+    on_refunded=lambda payment_ids: [invalidate_payment_verification(payment_id) for payment_id in payment_ids]
+)
+SCHEDULE_CANCELLATION_TIMEOUT = float(os.getenv("SCHEDULE_CANCELLATION_TIMEOUT", "3600"))
+
+async def handle_cancel_schedule_job(payload: dict):
+    job_id = payload["job_id"]
+    result = await schedule_cancellation.run(
+        job_id, payload["lawyer_id"], payload["since"], payload["until"], payload["reason"],
+        progress=lambda progress: job_queue.update_progress(job_id, progress)
+    )
+    outbox_worker.notify()
+    return result
+
+job_queue.register(
+    "cancel_lawyer_schedule", handle_cancel_schedule_job, max_attempts=1, timeout=SCHEDULE_CANCELLATION_TIMEOUT
+)
+
+@app.on_event("startup")
+async def start_outbox_worker():
+    """تشغيل عامل الصندوق الصادر (الفهارس تُنشأ في مراحل بدء التشغيل)"""
+    await outbox_worker.start()
+
+@app.on_event("startup")
+async def start_job_queue():
+    """تشغيل عمال طابور المهام (الفهارس تُنشأ في مراحل بدء التشغيل)"""
+    await job_queue.start()
+
+@app.on_event("startup")
+async def start_appointment_scheduler():
+    """تشغيل دورة التذكيرات وانتهاء المهل (الفهارس تُنشأ في مراحل بدء التشغيل)"""
+    await appointment_scheduler.start()
+
+@app.on_event("startup")
+async def start_notification_service():
+    """تشغيل عمال الكتابة والتوصيل للإشعارات"""
+    await notification_service.start()
+
+@app.on_event("startup")
+async def start_audit_log():
+    """تشغيل التفريغ الدوري لسجل التدقيق"""
+    await audit_log.start()
+
 @app.post("/api/payments/create", response_model=PaymentResponse)
-async def create_payment(payment_request: PaymentRequest):
-    """إنشاء جلسة دفع جديدة"""
+async def create_payment(
+    payment_request: PaymentRequest,
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    """إنشاء جلسة دفع جديدة (المحاولة المكررة بنفس Idempotency-Key لا تنشئ فاتورة ثانية)"""
+    return await idempotency_store.run(
+        idempotency_key, "create_payment", payment_request, lambda: open_payment_session(payment_request)
+    )
+
+async def open_payment_session(payment_request: PaymentRequest) -> PaymentResponse:
+    """إعادة الفاتورة المعلقة الصالحة للموعد، أو إنشاء فاتورة ماي فاتورة وحفظ سجل الدفع"""
     try:
         # التحقق من وجود الموعد
-        appointment = appointments_collection.find_one({"id": payment_request.appointment_id})
+        appointment = await current_loaders().appointments.load(payment_request.appointment_id)
         if not appointment:
             raise HTTPException(status_code=404, detail="الموعد غير موجود")
-        
-        # التحقق من عدم وجود دفع مؤكد مسبقاً
-        existing_payment = payments_collection.find_one({
-            "appointment_id": payment_request.appointment_id,
-            "status": "paid"
-        })
-        if existing_payment:
-            raise HTTPException(status_code=400, detail="تم دفع هذا الموعد مسبقاً")
-        
-        # إنشاء جلسة الدفع
-        payment_result = await myfatoorah_service.create_payment_session(
+        if appointment.get("status") not in UPCOMING_STATUSES:
+            # وقت الموعد الملغى أو المنتهية مهلته قد يكون محجوزاً لعميل آخر
+            raise HTTPException(status_code=400, detail="لا يمكن الدفع لموعد ملغى أو منتهٍ")
+        
+        # الطلبات المتزامنة لنفس الموعد والمبلغ تنتظر نفس الفاتورة
+        return await payment_session_flight.do(
+            (payment_request.appointment_id, payment_request.amount),
+            lambda: create_or_reuse_invoice(payment_request)
+        )
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"خطأ في إنشاء الدفع: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في إنشاء جلسة الدفع")
+
+async def create_or_reuse_invoice(payment_request: PaymentRequest) -> PaymentResponse:
+    """فاتورة جديدة فقط إذا لم توجد فاتورة معلقة صالحة (انتهت صلاحيتها أو فشلت)"""
+    # الدفعات المؤكدة والمعلقة للموعد (فهرس appointment_id)
+    payments = list(payments_collection.find(
+        {"appointment_id": payment_request.appointment_id, "status": {"$in": ["paid", "pending"]}},
+        {"_id": 0, "status": 1, "amount": 1, "invoice_id": 1, "payment_url": 1, "expires_at": 1, "created_at": 1}
+    ).sort("created_at", DESCENDING))
+    
+    # التحقق من عدم وجود دفع مؤكد مسبقاً
+    if any(payment["status"] == "paid" for payment in payments):
+        raise HTTPException(status_code=400, detail="تم دفع هذا الموعد مسبقاً")
+    
+    open_invoice = payable_invoice(payments)
+    if open_invoice and open_invoice.get("amount") != payment_request.amount:
+        raise HTTPException(status_code=409, detail="يوجد فاتورة قابلة للدفع بمبلغ مختلف لهذا الموعد حتى انتهاء صلاحيتها")
+    if open_invoice:
+        return PaymentResponse(
+            success=True,
+            payment_url=open_invoice["payment_url"],
+            invoice_id=open_invoice["invoice_id"],
+            appointment_id=payment_request.appointment_id,
+            amount=open_invoice["amount"]
+        )
+    
+    # إنشاء جلسة الدفع
+    expires_at = datetime.now() + INVOICE_TTL
+    payment_result = await myfatoorah_service.create_payment_session(
+        amount=payment_request.amount,
+        customer_name=payment_request.customer_name,
+        customer_email=payment_request.customer_email,
+        customer_mobile=payment_request.customer_mobile,
+        appointment_id=payment_request.appointment_id,
+        lawyer_name=payment_request.lawyer_name,
+        consultation_type=payment_request.consultation_type,
+        expires_at=expires_at
+    )
+    
+    if payment_result["success"]:
+        payment_record = PaymentRecord(
+            id=str(uuid.uuid4()),
+            appointment_id=payment_request.appointment_id,
+            invoice_id=payment_result["invoice_id"],
             amount=payment_request.amount,
             customer_name=payment_request.customer_name,
             customer_email=payment_request.customer_email,
             customer_mobile=payment_request.customer_mobile,
-            appointment_id=payment_request.appointment_id,
             lawyer_name=payment_request.lawyer_name,
-            consultation_type=payment_request.consultation_type
+            consultation_type=payment_request.consultation_type,
+            payment_url=payment_result["payment_url"],
+            status="pending",
+            expires_at=expires_at
         )
         
-        if payment_result["success"]:
-            # حفظ سجل الدفع
-            payment_record = PaymentRecord(
-                id=str(uuid.uuid4()),
-                appointment_id=payment_request.appointment_id,
-                invoice_id=payment_result["invoice_id"],
-                amount=payment_request.amount,
-                customer_name=payment_request.customer_name,
-                customer_email=payment_request.customer_email,
-                customer_mobile=payment_request.customer_mobile,
-                lawyer_name=payment_request.lawyer_name,
-                consultation_type=payment_request.consultation_type,
-                payment_url=payment_result["payment_url"],
-                status="pending"
-            )
-            
-            payments_collection.insert_one(payment_record.dict())
-            
-            # تحديث حالة الموعد
-            appointments_collection.update_one(
-                {"id": payment_request.appointment_id},
-                {"$set": {
-                    "payment_status": "pending",
-                    "invoice_id": payment_result["invoice_id"],
-                    "payment_amount": payment_request.amount
-                }}
+        # حفظ سجل الدفع وتحديث حالة الموعد كوحدة واحدة
+        payment_transitions.insert_payment(
+            payment_record.to_bson(),
+            appointment_id=payment_request.appointment_id,
+            appointment_update={
+                "payment_status": "pending",
+                "invoice_id": payment_result["invoice_id"],
+                "payment_amount": payment_request.amount
+            }
+        )
+        
+        return PaymentResponse(**payment_result)
+    else:
+        raise HTTPException(status_code=400, detail=payment_result["error"])
+
+async def _verify_and_record_payment(payment_id: str) -> dict:
+    """التحقق من الدفع عبر ماي فاتورة وتسجيل النتيجة (مرة واحدة لكل مجموعة طلبات متزامنة)"""
+    verification_result = await myfatoorah_service.verify_payment(payment_id)
+    
+    if verification_result["success"] and verification_result["is_paid"]:
+        # البحث عن سجل الدفع
+        payment_record = payments_collection.find_one({
+            "invoice_id": verification_result["invoice_id"]
+        })
+        
+        if payment_record:
+            # تحديث حالة الدفع والموعد معاً (لا شيء إذا كانت الدفعة مؤكدة مسبقاً)
+            applied = payment_transitions.apply(
+                payment_filter={"id": payment_record["id"], "status": {"$in": PAYMENT_PREVIOUS_STATUSES["paid"]}},
+                payment_update={
+                    "status": "paid",
+                    "payment_id": payment_id,
+                    "payment_method": verification_result["payment_method"],
+                    "transaction_date": datetime.now(),
+                    "updated_at": datetime.now()
+                },
+                appointment_id=payment_record["appointment_id"],
+                appointment_update={
+                    "payment_status": "paid",
+                    "status": "confirmed"
+                },
+                appointment_statuses=UPCOMING_STATUSES,
+                events=[
+                    payment_notification_event("payment_paid", payment_record),
+                    revenue_event("paid", payment_record, payment_record["amount"])
+                ]
             )
             
-            return PaymentResponse(**payment_result)
-        else:
-            raise HTTPException(status_code=400, detail=payment_result["error"])
-            
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"خطأ في إنشاء الدفع: {e}")
-        raise HTTPException(status_code=500, detail="خطأ في إنشاء جلسة الدفع")
+            if applied:
+                outbox_worker.notify()
+                if not flag_paid_released_appointment(payment_record, payment_id):
+                    logger.info(f"Payment confirmed for appointment {payment_record['appointment_id']}")
+    
+    # الحالات النهائية لا تتغير إلا عبر الاسترداد أو Webhook (وكلاهما يبطل الذاكرة المؤقتة)
+    payment_status = (verification_result.get("payment_status") or "").lower()
+    if verification_result["success"] and payment_status in TERMINAL_PAYMENT_STATUSES:
+        verification_cache.set(payment_id, verification_result)
+    
+    return verification_result
 
 @app.post("/api/payments/verify", response_model=PaymentStatus)
 async def verify_payment(verification: PaymentVerification):
     """التحقق من حالة الدفع"""
     try:
-        # التحقق من الدفع عبر ماي فاتورة
-        verification_result = await myfatoorah_service.verify_payment(verification.payment_id)
-        
-        if verification_result["success"] and verification_result["is_paid"]:
-            # البحث عن سجل الدفع
-            payment_record = payments_collection.find_one({
-                "invoice_id": verification_result["invoice_id"]
-            })
-            
-            if payment_record:
-                # تحديث حالة الدفع
-                payments_collection.update_one(
-                    {"id": payment_record["id"]},
-                    {"$set": {
-                        "status": "paid",
-                        "payment_id": verification.payment_id,
-                        "payment_method": verification_result["payment_method"],
-                        "transaction_date": datetime.now(),
-                        "updated_at": datetime.now()
-                    }}
-                )
-                
-                # تحديث حالة الموعد
-                appointments_collection.update_one(
-                    {"id": payment_record["appointment_id"]},
-                    {"$set": {
-                        "payment_status": "paid",
-                        "status": "confirmed"
-                    }}
-                )
-                
-                logger.info(f"Payment confirmed for appointment {payment_record['appointment_id']}")
+        cached_result = verification_cache.get(verification.payment_id)
+        if cached_result is not None:
+            return PaymentStatus(**cached_result)
+        
+        # الطلبات المتزامنة لنفس الدفعة تشترك في استدعاء البوابة والكتابة في قاعدة البيانات
+        verification_result = await verification_flight.do(
+            verification.payment_id,
+            lambda: _verify_and_record_payment(verification.payment_id)
+        )
         
         return PaymentStatus(**verification_result)
         
@@ -1275,9 +1959,18 @@ async def verify_payment(verification: PaymentVerification):
         logger.error(f"خطأ في التحقق من الدفع: {e}")
         raise HTTPException(status_code=500, detail="خطأ في التحقق من حالة الدفع")
 
-@app.post("/api/payments/refund", response_model=RefundResponse)
-async def refund_payment(refund_request: RefundRequest):
-    """استرداد المبلغ"""
+@app.post("/api/payments/refund", response_model=RefundResponse, status_code=202)
+async def refund_payment(
+    refund_request: RefundRequest,
+    idempotency_key: Optional[str] = Header(None, alias=IDEMPOTENCY_HEADER)
+):
+    """طلب استرداد المبلغ (ينفذ في طابور المهام؛ الحالة من /api/admin/jobs/{job_id})"""
+    return await idempotency_store.run(
+        idempotency_key, "refund_payment", refund_request, lambda: request_refund(refund_request), status_code=202
+    )
+
+async def request_refund(refund_request: RefundRequest) -> RefundResponse:
+    """حجز الدفعة لطلب استرداد واحد وإضافته لطابور المهام"""
     try:
         # البحث عن سجل الدفع
         payment_record = payments_collection.find_one({"payment_id": refund_request.payment_id})
@@ -1287,35 +1980,26 @@ async def refund_payment(refund_request: RefundRequest):
         if payment_record["status"] != "paid":
             raise HTTPException(status_code=400, detail="لا يمكن استرداد دفع غير مؤكد")
         
-        # طلب الاسترداد
-        refund_result = await myfatoorah_service.refund_payment(
-            payment_id=refund_request.payment_id,
-            amount=refund_request.amount,
-            reason=refund_request.reason
+        # استرداد سابق نتيجته غير معروفة: المطابقة مع البوابة قبل إرسال استرداد جديد
+        if payment_record.get("refund_status") == REFUND_UNKNOWN and await reconcile_refund(payment_record):
+            return RefundResponse(success=True, amount=payment_record["amount"], status="refunded")
+        
+        # حجز الدفعة لطلب استرداد واحد (الطلب المكرر لا يرسل استرداداً ثانياً)
+        job_id = str(uuid.uuid4())
+        reserved = payments_collection.update_one(
+            {"payment_id": refund_request.payment_id, "status": "paid", "refund_job_id": None},
+            {"$set": {"refund_job_id": job_id}}
         )
+        if not reserved.modified_count:
+            raise HTTPException(status_code=409, detail="يوجد طلب استرداد قيد التنفيذ لهذه الدفعة")
         
-        if refund_result["success"]:
-            # تحديث سجل الدفع
-            payments_collection.update_one(
-                {"payment_id": refund_request.payment_id},
-                {"$set": {
-                    "status": "refunded",
-                    "refund_amount": refund_request.amount,
-                    "refund_reason": refund_request.reason,
-                    "updated_at": datetime.now()
-                }}
-            )
-            
-            # تحديث حالة الموعد
-            appointments_collection.update_one(
-                {"id": payment_record["appointment_id"]},
-                {"$set": {
-                    "payment_status": "refunded",
-                    "status": "cancelled"
-                }}
-            )
+        job_queue.enqueue("refund_payment", {
+            "payment_id": refund_request.payment_id,
+            "amount": refund_request.amount,
+            "reason": refund_request.reason
+        }, priority=JOB_PRIORITY_PAYMENTS, job_id=job_id)
         
-        return RefundResponse(**refund_result)
+        return RefundResponse(success=True, amount=refund_request.amount, status="queued", job_id=job_id)
         
     except HTTPException:
         raise
@@ -1358,9 +2042,6 @@ async def myfatoorah_webhook(webhook_data: WebhookPayload):
             return {"status": "ignored", "reason": "payment record not found"}
         
         # تحديث حالة الدفع حسب الحالة الواردة
-        new_status = "pending"
-        appointment_status = "pending"
-        
         if webhook_data.InvoiceStatus == "Paid":
             new_status = "paid"
             appointment_status = "confirmed"
@@ -1370,27 +2051,38 @@ async def myfatoorah_webhook(webhook_data: WebhookPayload):
         elif webhook_data.InvoiceStatus == "Expired":
             new_status = "expired"
             appointment_status = "payment_expired"
+        else:
+            return {"status": "ignored", "reason": f"unhandled invoice status {webhook_data.InvoiceStatus}"}
         
-        # تحديث سجل الدفع
-        payments_collection.update_one(
-            {"invoice_id": webhook_data.InvoiceId},
-            {"$set": {
+        invalidate_payment_verification(webhook_data.PaymentId)
+        
+        # تحديث سجل الدفع والموعد معاً (Webhook المكرر أو المتأخر عن حالة لاحقة لا يعيد كتابة شيء)
+        applied = payment_transitions.apply(
+            payment_filter={
+                "invoice_id": webhook_data.InvoiceId,
+                "status": {"$in": PAYMENT_PREVIOUS_STATUSES[new_status]}
+            },
+            payment_update={
                 "status": new_status,
                 "payment_id": webhook_data.PaymentId,
                 "payment_method": webhook_data.PaymentGateway,
                 "transaction_date": datetime.now(),
                 "updated_at": datetime.now()
-            }}
-        )
-        
-        # تحديث حالة الموعد
-        appointments_collection.update_one(
-            {"id": payment_record["appointment_id"]},
-            {"$set": {
+            },
+            appointment_id=payment_record["appointment_id"],
+            appointment_update={
                 "payment_status": new_status,
                 "status": appointment_status
-            }}
+            },
+            appointment_statuses=UPCOMING_STATUSES if new_status == "paid" else None,
+            events=[payment_notification_event(f"payment_{new_status}", payment_record)] + (
+                [revenue_event("paid", payment_record, payment_record["amount"])] if new_status == "paid" else []
+            )
         )
+        if applied:
+            outbox_worker.notify()
+            if new_status == "paid":
+                flag_paid_released_appointment(payment_record, webhook_data.PaymentId)
         
         logger.info(f"Webhook processed successfully for appointment {payment_record['appointment_id']}")
         
@@ -1411,6 +2103,144 @@ async def get_payment_settings():
         "test_mode": True  # البيئة التجريبية
     }
 
+@app.get("/api/payments/gateway/metrics")
+async def get_gateway_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """حالة قاطع الدائرة وزمن استجابة بوابة الدفع (للمدراء)"""
+    return myfatoorah_service.get_metrics()
+
+@app.get("/api/admin/revenue")
+async def get_revenue(
+    scope: str = "platform",
+    key: str = "all",
+    granularity: str = "month",
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    current_user: dict = Depends(require_role([UserRoles.ADMIN]))
+):
+    """الإيرادات حسب الفترة للمنصة أو لمحامٍ أو لتخصص (للمدراء)"""
+    if scope not in ("platform", "lawyer", "specialization") or granularity not in ("day", "month"):
+        raise HTTPException(status_code=400, detail="نطاق أو دقة غير صالحة")
+    try:
+        return revenue_rollups.query(scope, key, granularity, since, until)
+    except Exception as e:
+        logger.error(f"خطأ في جلب الإيرادات: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في جلب الإيرادات")
+
+@app.post("/api/admin/revenue/backfill")
+async def backfill_revenue(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """إعادة بناء حاويات الإيرادات من سجلات الدفع (للمدراء)"""
+    try:
+        result = await asyncio.to_thread(revenue_rollups.backfill)
+        # استبدال المجموعة لا يمر بغلاف الإصدار، فيُرفع العداد يدوياً لإبطال وسوم ETag
+        collection_versions.bump("revenue_rollups")
+        audit_log.log(current_user["user_id"], "backfill_revenue", details=result)
+        return {"message": "تم إعادة بناء تجميعات الإيرادات", **result}
+    except Exception as e:
+        logger.error(f"خطأ في إعادة بناء الإيرادات: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في إعادة بناء الإيرادات")
+
+@app.post("/api/admin/appointments/backfill-slots")
+async def backfill_appointment_slots(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """إضافة slot_start و slot_end بتوقيت UTC للمواعيد القديمة (للمدراء، آمن للتكرار)"""
+    try:
+        result = await asyncio.to_thread(appointment_slots.backfill)
+        audit_log.log(current_user["user_id"], "backfill_appointment_slots", details=result)
+        return {"message": "تم تحديث أوقات المواعيد", **result}
+    except Exception as e:
+        logger.error(f"خطأ في تحديث أوقات المواعيد: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في تحديث أوقات المواعيد")
+
+@app.post("/api/admin/appointments/schedule-tasks")
+async def schedule_existing_appointments(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """جدولة التذكيرات وانتهاء مهلة الدفع للمواعيد القائمة قبل تفعيل المجدول (للمدراء، آمن للتكرار)"""
+    try:
+        result = await asyncio.to_thread(appointment_scheduler.backfill)
+        audit_log.log(current_user["user_id"], "schedule_appointment_tasks", details=result)
+        return {"message": "تمت جدولة مهام المواعيد", **result}
+    except Exception as e:
+        logger.error(f"خطأ في جدولة مهام المواعيد: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في جدولة مهام المواعيد")
+
+@app.get("/api/admin/analytics/report")
+async def get_analytics_report(
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    current_user: dict = Depends(require_role([UserRoles.ADMIN]))
+):
+    """تقرير المنصة: التحويل للدفع، الإلغاء والاسترداد حسب التخصص، وإشغال المحامين (للمدراء)"""
+    default_since, default_until = default_window()
+    since, until = since or default_since, until or default_until
+    if since >= until:
+        raise HTTPException(status_code=400, detail="نطاق زمني غير صالح")
+    try:
+        report = await analytics_flight.do(
+            (since, until), lambda: asyncio.to_thread(platform_analytics.report, since, until)
+        )
+        return FastJSONResponse(report)
+    except Exception as e:
+        logger.error(f"خطأ في إعداد تقرير التحليلات: {e}")
+        raise HTTPException(status_code=500, detail="خطأ في إعداد التقرير")
+
+@app.get("/api/admin/dashboards/metrics")
+async def get_dashboard_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """زمن ومهلات أقسام لوحات التحكم (للمدراء)"""
+    return dashboard_composer.get_metrics()
+
+@app.get("/api/admin/scheduler/metrics")
+async def get_scheduler_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """دورات المجدول وتأخره والمهام المنفذة لكل نوع (للمدراء)"""
+    return appointment_scheduler.get_metrics()
+
+@app.get("/api/admin/jobs/metrics")
+async def get_job_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """عمق طابور المهام وزمن الانتظار والتنفيذ لكل نوع (للمدراء)"""
+    return await asyncio.to_thread(job_queue.get_metrics)
+
+@app.get("/api/admin/jobs/{job_id}")
+async def get_job_status(job_id: str, current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """حالة مهمة خلفية ونتيجتها (للمدراء)"""
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة")
+    return job
+
+@app.get("/api/admin/workers/metrics")
+async def get_worker_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """معلومات العملية الحالية وأحداث الإبطال المنشورة والمستقبلة (للمدراء)"""
+    return {
+        "pid": os.getpid(),
+        "cpu_affinity": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+        "invalidation": invalidation_bus.get_metrics(),
+        "idempotency": idempotency_store.get_metrics(),
+    }
+
+@app.get("/api/admin/admission/metrics")
+async def get_admission_metrics(current_user: dict = Depends(require_role([UserRoles.ADMIN]))):
+    """إحصائيات حدود المعدل والتزامن (للمدراء)"""
+    return admission_controller.get_metrics()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """إغلاق الموارد المشتركة عند إيقاف الخادم"""
+    await startup_manager.stop()
+    await health_monitor.stop()
+    await invalidation_bus.stop()
+    await session_service.stop()
+    await appointment_scheduler.stop()
+    await job_queue.stop()
+    await outbox_worker.stop()
+    await notification_service.stop()
+    await audit_log.stop()
+    # بعد توقف العمال: معالجاتهم الجارية تنشر أحداث إبطال يجب كتابتها قبل إغلاق الحالة المشتركة
+    shared_state.close()
+    await myfatoorah_service.close()
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    # عدة عمليات: WEB_CONCURRENCY > 1 (يتطلب SHARED_STATE_BACKEND=sqlite أو redis)،
+    # ولتثبيت العمليات على المعالجات استخدم gunicorn -c gunicorn_conf.py server:app
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    if workers > 1:
+        uvicorn.run("server:app", host="0.0.0.0", port=8001, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+خدمة الجلسات - Session Service
+تسجيل الدخول والتسجيل وتجديد الرموز (مع تدوير رمز التجديد) وتسجيل الخروج،
+مع إبقاء bcrypt خارج حلقة الأحداث وتجميع تحديثات آخر دخول على دفعات.
+"""
+
+import asyncio
+import os
+import time
+import uuid
+import logging
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, Optional
+
+from pymongo import ReturnDocument, UpdateOne
+
+from auth_service import AuthService, ACCESS_TOKEN_EXPIRE_MINUTES, REFRESH_TOKEN_EXPIRE_DAYS
+from metrics import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# الحقول اللازمة لتسجيل الدخول فقط (بدل المستند كاملاً)
+LOGIN_PROJECTION = {
+    "_id": 0, "id": 1, "name": 1, "email": 1, "phone": 1, "role": 1, "status": 1, "avatar": 1,
+    "created_at": 1, "updated_at": 1, "last_login": 1, "email_verified": 1, "phone_verified": 1,
+    "password_hash": 1,
+}
+
+
+class SessionError(Exception):
+    """خطأ مصادقة برمز حالة HTTP ورسالة للعميل"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class SessionService:
+    """
+    الجلسة مستند واحد {_id: sid, user_id, current_jti, expires_at, revoked}.
+    رمز الوصول يحمل {user_id, role, sid} فقط، ورمز التجديد {user_id, sid, jti}.
+    كل تجديد يستبدل jti؛ استخدام رمز تجديد قديم يعني تسريبه فتُلغى الجلسة كاملة.
+    """
+
+    def __init__(self, users_collection, sessions_collection):
+        self.users = users_collection
+        self.sessions = sessions_collection
+        self.flush_interval = float(os.getenv("LAST_LOGIN_FLUSH_INTERVAL", "5"))
+        # bcrypt مكلف للمعالج: حد لعدد عمليات التحقق المتزامنة حتى لا تستهلك مجمع الخيوط
+        self._bcrypt_slots = asyncio.Semaphore(int(os.getenv("BCRYPT_CONCURRENCY", str(os.cpu_count() or 4))))
+        # تجزئة وهمية لتوحيد زمن الرد عند عدم وجود البريد (منع كشف الحسابات المسجلة)، تُنشأ عند أول حاجة
+        self._dummy_hash: Optional[str] = None
+        self._last_logins: Dict[str, datetime] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.latency: Dict[str, LatencyTracker] = {
+            step: LatencyTracker() for step in (
+                "lookup", "password", "tokens", "session", "login", "register", "refresh", "logout",
+            )
+        }
+
+    @contextmanager
+    def _measure(self, step: str) -> Iterator[None]:
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.latency[step].record(time.perf_counter() - started, error=error)
+
+    def ensure_unique_indexes(self):
+        """فهرس فريد للبريد (بحث O(1) عند الدخول ومنع التسجيل المكرر) وللمعرف"""
+        self.users.create_index("email", unique=True)
+        self.users.create_index("id", unique=True)
+
+    def ensure_indexes(self):
+        """فهارس الجلسات وفهرس TTL لانتهائها"""
+        self.sessions.create_index("user_id")
+        self.sessions.create_index("expires_at", expireAfterSeconds=0)
+
+    async def _run_bcrypt(self, func, *args):
+        async with self._bcrypt_slots:
+            return await asyncio.to_thread(func, *args)
+
+    async def hash_password(self, password: str) -> str:
+        with self._measure("password"):
+            return await self._run_bcrypt(AuthService.hash_password, password)
+
+    def _check_password(self, password: str, password_hash: Optional[str]) -> bool:
+        if password_hash:
+            return AuthService.verify_password(password, password_hash)
+        if self._dummy_hash is None:
+            self._dummy_hash = AuthService.hash_password(uuid.uuid4().hex)
+        AuthService.verify_password(password, self._dummy_hash)
+        return False
+
+    async def verify_password(self, password: str, password_hash: Optional[str]) -> bool:
+        with self._measure("password"):
+            return await self._run_bcrypt(self._check_password, password, password_hash)
+
+    def find_user(self, email: str) -> Optional[Dict[str, Any]]:
+        with self._measure("lookup"):
+            return self.users.find_one({"email": email.lower()}, LOGIN_PROJECTION)
+
+    def _tokens(self, user_id: str, role: str, sid: str, jti: str) -> Dict[str, Any]:
+        with self._measure("tokens"):
+            return {
+                "access_token": AuthService.create_access_token({"user_id": user_id, "role": role, "sid": sid}),
+                "refresh_token": AuthService.create_refresh_token({"user_id": user_id, "sid": sid, "jti": jti}),
+                "token_type": "bearer",
+                "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+            }
+
+    async def issue_tokens(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        """إنشاء جلسة جديدة وإصدار رمزي الوصول والتجديد"""
+        sid, jti = uuid.uuid4().hex, uuid.uuid4().hex
+        now = datetime.now()
+        with self._measure("session"):
+            await asyncio.to_thread(self.sessions.insert_one, {
+                "_id": sid,
+                "user_id": user["id"],
+                "role": user["role"],
+                "current_jti": jti,
+                "created_at": now,
+                "expires_at": now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+                "revoked": False,
+            })
+        return self._tokens(user["id"], user["role"], sid, jti)
+
+    async def login(self, email: str, password: str) -> Dict[str, Any]:
+        """التحقق من بيانات الدخول وإصدار الرموز. يُعاد {tokens..., user}"""
+        with self._measure("login"):
+            user = await asyncio.to_thread(self.find_user, email)
+            valid = await self.verify_password(password, user.get("password_hash") if user else None)
+            if not user or not valid:
+                raise SessionError(401, "البريد الإلكتروني أو كلمة المرور غير صحيحة")
+            if user.get("status") == "pending":
+                raise SessionError(403, "الحساب قيد المراجعة")
+            if user.get("status") in ("suspended", "inactive"):
+                raise SessionError(403, "الحساب غير مفعل")
+
+            tokens = await self.issue_tokens(user)
+            now = datetime.now()
+            self.record_login(user["id"], now)
+            user.pop("password_hash", None)
+            user["last_login"] = now
+            return {**tokens, "user": user}
+
+    async def register(self, user_document: Dict[str, Any], password: str) -> Dict[str, Any]:
+        """إدراج المستخدم بكلمة مرور مشفرة (DuplicateKeyError إذا كان البريد مسجلاً)"""
+        with self._measure("register"):
+            user_document["email"] = user_document["email"].lower()
+            user_document["password_hash"] = await self.hash_password(password)
+            await asyncio.to_thread(self.users.insert_one, user_document)
+            user_document.pop("_id", None)
+            user_document.pop("password_hash")
+            return user_document
+
+    async def refresh(self, refresh_token: str) -> Dict[str, Any]:
+        """تدوير رمز التجديد: الرمز المقدم يجب أن يكون الأحدث في جلسته"""
+        with self._measure("refresh"):
+            try:
+                payload = AuthService.verify_token(refresh_token)
+            except Exception:
+                raise SessionError(401, "رمز التجديد غير صالح")
+            if payload.get("type") != "refresh" or not payload.get("sid") or not payload.get("jti"):
+                raise SessionError(401, "رمز التجديد غير صالح")
+
+            new_jti = uuid.uuid4().hex
+            session = await asyncio.to_thread(
+                self.sessions.find_one_and_update,
+                {"_id": payload["sid"], "current_jti": payload["jti"], "revoked": False},
+                {"$set": {"current_jti": new_jti, "rotated_at": datetime.now()}},
+                projection={"user_id": 1, "role": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+            if session is None:
+                # رمز قديم أعيد استخدامه أو جلسة ملغاة: إلغاء الجلسة احتياطاً
+                await asyncio.to_thread(
+                    self.sessions.update_one, {"_id": payload["sid"]}, {"$set": {"revoked": True}}
+                )
+                raise SessionError(401, "انتهت الجلسة، يرجى تسجيل الدخول مرة أخرى")
+
+            return self._tokens(session["user_id"], session["role"], payload["sid"], new_jti)
+
+    async def logout(self, session_id: Optional[str]) -> None:
+        """إلغاء الجلسة: رموز التجديد تتوقف فوراً، ورمز الوصول ينتهي بانتهاء مدته القصيرة"""
+        if not session_id:
+            return
+        with self._measure("logout"):
+            await asyncio.to_thread(self.sessions.update_one, {"_id": session_id}, {"$set": {"revoked": True}})
+
+    def record_login(self, user_id: str, moment: datetime) -> None:
+        """تسجيل آخر دخول في الذاكرة؛ يُكتب على دفعات"""
+        self._last_logins[user_id] = moment
+
+    async def flush_last_logins(self) -> int:
+        if not self._last_logins:
+            return 0
+        batch, self._last_logins = self._last_logins, {}
+        try:
+            await asyncio.to_thread(self.users.bulk_write, [
+                UpdateOne({"id": user_id}, {"$set": {"last_login": moment}})
+                for user_id, moment in batch.items()
+            ], ordered=False)
+        except Exception as e:
+            logger.error(f"خطأ في تحديث آخر تسجيل دخول: {e}")
+            for user_id, moment in batch.items():
+                self._last_logins.setdefault(user_id, moment)
+            return 0
+        return len(batch)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush_last_logins()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_last_logins()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "pending_last_login_updates": len(self._last_logins),
+            "latency": {step: tracker.snapshot() for step, tracker in self.latency.items()},
+        }
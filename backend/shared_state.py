@@ -0,0 +1,398 @@
+"""
+الحالة المشتركة - Shared State
+واجهة تخزين مشتركة بين عمليات الخادم (مفاتيح/قيم + نشر/اشتراك) مع ثلاث تطبيقات:
+داخل العملية (عملية واحدة والاختبارات)، SQLite (ملف محلي مشترك بين عمليات نفس الجهاز)، و Redis (اختياري).
+"""
+
+import asyncio
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+try:
+    import redis
+    import redis.asyncio as redis_asyncio
+except ImportError:  # redis اختياري
+    redis = None
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+
+class SharedStateBackend(ABC):
+    """واجهة الحالة المشتركة"""
+
+    name = "base"
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        ...
+
+    @abstractmethod
+    def add(self, key: str, value: str) -> str:
+        """تعيين القيمة إن لم يكن المفتاح موجوداً، وإعادة القيمة المخزنة"""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def incr(self, key: str, amount: int = 1) -> int:
+        ...
+
+    @abstractmethod
+    def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        ...
+
+    @abstractmethod
+    def subscribe(self, channel: str) -> AsyncIterator[Dict[str, Any]]:
+        """مولد غير متزامن للرسائل المنشورة على القناة بعد بدء الاشتراك"""
+
+    def close(self) -> None:
+        pass
+
+
+class InMemorySharedState(SharedStateBackend):
+    """حالة داخل العملية: مناسبة لعامل واحد وللاختبارات"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._values: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key: str) -> bool:
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+            return False
+        return key in self._values
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return str(self._values[key]) if self._alive(key) else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._values[key] = value
+            if ttl is None:
+                self._expires.pop(key, None)
+            else:
+                self._expires[key] = time.monotonic() + ttl
+
+    def add(self, key: str, value: str) -> str:
+        with self._lock:
+            if not self._alive(key):
+                self._values[key] = value
+            return str(self._values[key])
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        with self._lock:
+            value = int(self._values[key]) + amount if self._alive(key) else amount
+            self._values[key] = value
+            return value
+
+    def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        for queue in list(self._subscribers.get(channel, [])):
+            queue.put_nowait(message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[Dict[str, Any]]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, []).append(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[channel].remove(queue)
+
+
+class SQLiteSharedState(SharedStateBackend):
+    """
+    حالة مشتركة في ملف SQLite لعدة عمليات على نفس الجهاز.
+    النشر يضيف الرسالة لطابور يكتبه خيط واحد لجدول الأحداث (لا ينتظر الناشر قفل الملف)،
+    والمشتركون يستطلعون الصفوف الجديدة دورياً. الخيط نفسه يحذف الأحداث القديمة كل prune_interval.
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, poll_interval: float = 0.5, event_retention: float = 3600,
+                 prune_interval: float = 60):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.event_retention = event_retention
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._outgoing: queue.SimpleQueue = queue.SimpleQueue()
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "channel TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS events_created_at ON events (created_at)")
+        self._writer = threading.Thread(target=self._write_events, name="shared-state-events", daemon=True)
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # اتصال لكل خيط؛ isolation_level=None مع BEGIN IMMEDIATE للعمليات الذرية
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._connect().execute(
+            "INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, str(value), expires_at)
+        )
+
+    def add(self, key: str, value: str) -> str:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, time.time()))
+            connection.execute("INSERT OR IGNORE INTO kv (key, value) VALUES (?, ?)", (key, str(value)))
+            row = connection.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return row[0]
+
+    def delete(self, key: str) -> None:
+        self._connect().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT INTO kv (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + ?",
+                (key, amount, amount)
+            )
+            row = connection.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return int(row[0])
+
+    def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        self._outgoing.put((channel, json.dumps(message), time.time()))
+
+    def _write_batch(self, events: List[tuple], prune_before: Optional[float]) -> None:
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT INTO events (channel, payload, created_at) VALUES (?, ?, ?)", events)
+            if prune_before is not None:
+                connection.execute("DELETE FROM events WHERE created_at < ?", (prune_before,))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    def _write_events(self):
+        """خيط الكتابة: يُدرج الأحداث المتراكمة في معاملة واحدة، ويحذف الأحداث القديمة دورياً"""
+        pruned_at = 0.0
+        while True:
+            try:
+                batch = [self._outgoing.get(timeout=self.prune_interval)]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch.append(self._outgoing.get_nowait())
+                except queue.Empty:
+                    break
+            events = [event for event in batch if event is not None]
+            now = time.time()
+            prune = now - pruned_at >= self.prune_interval
+            if events or prune:
+                try:
+                    self._write_batch(events, now - self.event_retention if prune else None)
+                    if prune:
+                        pruned_at = now
+                except Exception as e:
+                    logger.error(f"خطأ في كتابة أحداث الحالة المشتركة: {e}")
+            if None in batch:
+                return
+
+    def _last_id(self) -> int:
+        return self._connect().execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+
+    def _fetch(self, channel: str, after_id: int) -> List[tuple]:
+        return self._connect().execute(
+            "SELECT id, payload FROM events WHERE channel = ? AND id > ? ORDER BY id", (channel, after_id)
+        ).fetchall()
+
+    async def subscribe(self, channel: str) -> AsyncIterator[Dict[str, Any]]:
+        last_id = await asyncio.to_thread(self._last_id)
+        while True:
+            rows = await asyncio.to_thread(self._fetch, channel, last_id)
+            for event_id, payload in rows:
+                last_id = event_id
+                yield json.loads(payload)
+            await asyncio.sleep(self.poll_interval)
+
+    def close(self) -> None:
+        # كتابة الأحداث المتبقية قبل الإغلاق
+        self._outgoing.put(None)
+        self._writer.join(timeout=5)
+
+
+class RedisSharedState(SharedStateBackend):
+    """حالة مشتركة في Redis لعدة عمليات على عدة أجهزة"""
+
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str = "debra:"):
+        if redis is None:
+            raise RuntimeError("حزمة redis غير مثبتة")
+        self.url = url
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, decode_responses=True)
+
+    def get(self, key: str) -> Optional[str]:
+        return self._client.get(self.prefix + key)
+
+    def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        self._client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl is not None else None)
+
+    def add(self, key: str, value: str) -> str:
+        self._client.set(self.prefix + key, value, nx=True)
+        return self._client.get(self.prefix + key)
+
+    def delete(self, key: str) -> None:
+        self._client.delete(self.prefix + key)
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        return self._client.incrby(self.prefix + key, amount)
+
+    def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        self._client.publish(self.prefix + channel, json.dumps(message))
+
+    async def subscribe(self, channel: str) -> AsyncIterator[Dict[str, Any]]:
+        client = redis_asyncio.Redis.from_url(self.url, decode_responses=True)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(self.prefix + channel)
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") == "message":
+                    yield json.loads(message["data"])
+        finally:
+            await pubsub.unsubscribe(self.prefix + channel)
+            await client.aclose()
+
+    def close(self) -> None:
+        self._client.close()
+
+
+def create_shared_state() -> SharedStateBackend:
+    """
+    اختيار التطبيق حسب SHARED_STATE_BACKEND (memory | sqlite | redis).
+    مع عدة عمليات يجب اختيار sqlite (جهاز واحد) أو redis.
+    """
+    backend = os.getenv("SHARED_STATE_BACKEND", "memory").lower()
+    if backend == "redis":
+        return RedisSharedState(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "sqlite":
+        return SQLiteSharedState(
+            os.getenv("SHARED_STATE_PATH", "/tmp/debra_shared_state.sqlite3"),
+            poll_interval=float(os.getenv("SHARED_STATE_POLL_INTERVAL", "0.5")),
+        )
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        logger.warning("SHARED_STATE_BACKEND=memory مع عدة عمليات: الذاكرة المؤقتة والإبطال لن تُشارك بين العمليات")
+    return InMemorySharedState()
+
+
+class InvalidationBus:
+    """
+    نشر أحداث إبطال الذاكرة المؤقتة لجميع العمليات.
+    كل عملية تتجاهل أحداثها (طُبقت محلياً عند النشر) وتمرر أحداث غيرها للمعالج المسجل لنوع الحدث.
+    """
+
+    CHANNEL = "invalidation"
+
+    def __init__(self, backend: SharedStateBackend):
+        self.backend = backend
+        self.origin = uuid.uuid4().hex
+        self.handlers: Dict[str, Callable[[Any], None]] = {}
+        self.published = 0
+        self.received = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, handler: Callable[[Any], None]) -> None:
+        self.handlers[kind] = handler
+
+    def publish(self, kind: str, key: Any = None) -> None:
+        """نشر حدث إبطال (أخطاء النشر لا تُفشل الطلب)"""
+        try:
+            self.backend.publish(self.CHANNEL, {"origin": self.origin, "kind": kind, "key": key})
+            self.published += 1
+        except Exception as e:
+            logger.error(f"خطأ في نشر حدث الإبطال {kind}: {e}")
+
+    async def _listen(self):
+        while True:
+            try:
+                async for message in self.backend.subscribe(self.CHANNEL):
+                    if message.get("origin") == self.origin:
+                        continue
+                    handler = self.handlers.get(message.get("kind"))
+                    if handler is not None:
+                        self.received += 1
+                        handler(message.get("key"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطأ في الاشتراك بأحداث الإبطال: {e}")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {"backend": self.backend.name, "published": self.published, "received": self.received}
@@ -0,0 +1,180 @@
+"""
+إدارة بدء التشغيل - Startup Manager
+تشغيل مراحل بدء التشغيل في الخلفية (الاتصال، تهيئة الاتصالات، الفهارس، البيانات التجريبية)
+مع قياس زمن كل مرحلة والتمييز بين الجاهزية والحياة
+"""
+
+import asyncio
+import inspect
+import os
+import time
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# أخطاء لا تزول بإعادة المحاولة: مفتاح مكرر عند إنشاء فهرس فريد، أو فهرس موجود بخيارات مختلفة
+PERMANENT_ERROR_CODES = {11000, 85, 86}
+
+
+def is_permanent(error: Exception) -> bool:
+    if isinstance(error, PhaseStepsError):
+        return all(is_permanent(failure) for failure in error.failures.values())
+    return getattr(error, "code", None) in PERMANENT_ERROR_CODES
+
+
+class PhaseStepsError(Exception):
+    """فشل خطوة أو أكثر من خطوات مرحلة (failures: اسم الخطوة ← الخطأ)"""
+
+    def __init__(self, failures: Dict[str, Exception]):
+        self.failures = failures
+        super().__init__("; ".join(f"{name}: {error}" for name, error in failures.items()))
+
+
+class PhaseSteps:
+    """
+    خطوات مستقلة لمرحلة واحدة (مثل فهارس كل مكوّن): فشل خطوة لا يمنع ما بعدها،
+    وإعادة محاولة المرحلة تعيد الخطوات الفاشلة فقط.
+    """
+
+    def __init__(self, steps: Dict[str, Callable[[], Any]]):
+        self.steps = steps
+        self.done: Set[str] = set()
+
+    def __call__(self) -> None:
+        failures: Dict[str, Exception] = {}
+        for name, step in self.steps.items():
+            if name in self.done:
+                continue
+            try:
+                step()
+                self.done.add(name)
+            except Exception as e:
+                failures[name] = e
+        if failures:
+            raise PhaseStepsError(failures)
+
+
+class StartupPhase:
+    """مرحلة بدء تشغيل واحدة وحالتها"""
+
+    def __init__(self, name: str, func: Callable[[], Any], stage: int, required: bool, retry: bool):
+        self.name = name
+        self.func = func
+        self.stage = stage
+        self.required = required
+        self.retry = retry
+        self.status = "pending"
+        self.attempts = 0
+        self.duration_ms: Optional[float] = None
+        self.finished_at: Optional[datetime] = None
+        self.error: Optional[str] = None
+        self.failures: Dict[str, str] = {}
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "status": self.status,
+            "stage": self.stage,
+            "required_for_readiness": self.required,
+            "attempts": self.attempts,
+            "duration_ms": self.duration_ms,
+            "finished_at": self.finished_at,
+            "error": self.error,
+            "failed_steps": self.failures,
+        }
+
+
+class StartupManager:
+    """
+    المراحل تُنفذ حسب رقم المرحلة (stage) بالترتيب، والمراحل ذات الرقم نفسه تُنفذ معاً.
+    الخادم يستقبل الطلبات فوراً (حي)، ويصبح جاهزاً عند اكتمال المراحل المطلوبة.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, StartupPhase] = {}
+        self.started_at = time.monotonic()
+        self.retry_max_delay = float(os.getenv("STARTUP_RETRY_MAX_DELAY", "30"))
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, name: str, func: Callable[[], Any], stage: int = 0,
+                 required: bool = False, retry: bool = False) -> None:
+        """
+        تسجيل مرحلة. الدوال المتزامنة (pymongo، bcrypt) تُنفذ في خيط منفصل.
+        retry يعيد المحاولة للأخطاء المؤقتة فقط (ليس للمفتاح المكرر أو تعارض خيارات الفهرس).
+        """
+        self.phases[name] = StartupPhase(name, func, stage, required, retry)
+
+    async def _call(self, func: Callable[[], Any]) -> Any:
+        if inspect.iscoroutinefunction(func):
+            return await func()
+        return await asyncio.to_thread(func)
+
+    async def _run_phase(self, phase: StartupPhase) -> bool:
+        delay = 1.0
+        while True:
+            phase.status = "running"
+            phase.attempts += 1
+            started = time.monotonic()
+            try:
+                await self._call(phase.func)
+            except Exception as e:
+                phase.duration_ms = round((time.monotonic() - started) * 1000, 2)
+                phase.error = str(e)
+                phase.failures = {
+                    name: str(error) for name, error in getattr(e, "failures", {}).items()
+                }
+                phase.status = "failed"
+                logger.error(f"فشل مرحلة بدء التشغيل {phase.name}: {e}")
+                if not phase.retry or is_permanent(e):
+                    return False
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max_delay)
+                continue
+            phase.duration_ms = round((time.monotonic() - started) * 1000, 2)
+            phase.finished_at = datetime.now()
+            phase.error = None
+            phase.failures = {}
+            phase.status = "done"
+            logger.info(f"Startup phase {phase.name} finished in {phase.duration_ms} ms")
+            return True
+
+    async def _run_all(self):
+        for stage in sorted({phase.stage for phase in self.phases.values()}):
+            phases = [phase for phase in self.phases.values() if phase.stage == stage]
+            results = await asyncio.gather(*(self._run_phase(phase) for phase in phases))
+            # لا فائدة من المراحل اللاحقة إذا فشلت مرحلة مطلوبة
+            if not all(ok for ok, phase in zip(results, phases) if phase.required):
+                logger.error(f"Startup stopped at stage {stage}")
+                return
+        logger.info(f"Startup completed in {round((time.monotonic() - self.started_at) * 1000, 2)} ms")
+
+    async def start(self):
+        """بدء المراحل في الخلفية دون تأخير استقبال الطلبات"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run_all())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def ready(self) -> bool:
+        return all(phase.status == "done" for phase in self.phases.values() if phase.required)
+
+    @property
+    def completed(self) -> bool:
+        return all(phase.status == "done" for phase in self.phases.values())
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "live": True,
+            "ready": self.ready,
+            "completed": self.completed,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 2),
+            "phases": {name: phase.report() for name, phase in self.phases.items()},
+        }
@@ -8,6 +8,8 @@ from typing import Optional, List, Literal
 from datetime import datetime
 from enum import Enum
 
+from records import default_working_hours
+
 class UserRole(str, Enum):
     CLIENT = "client"
     LAWYER = "lawyer"
@@ -39,6 +41,10 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class TokenRefresh(BaseModel):
+    """نموذج تجديد الرمز المميز"""
+    refresh_token: str
+
 class PasswordReset(BaseModel):
     """نموذج إعادة تعيين كلمة المرور"""
     email: EmailStr
@@ -91,15 +97,7 @@ class Lawyer(User):
     total_earnings: float = 0.0
     
     # ساعات العمل
-    working_hours: dict = {
-        "sunday": {"start": "09:00", "end": "17:00", "available": True},
-        "monday": {"start": "09:00", "end": "17:00", "available": True},
-        "tuesday": {"start": "09:00", "end": "17:00", "available": True},
-        "wednesday": {"start": "09:00", "end": "17:00", "available": True},
-        "thursday": {"start": "09:00", "end": "17:00", "available": True},
-        "friday": {"start": "14:00", "end": "17:00", "available": True},
-        "saturday": {"start": "09:00", "end": "17:00", "available": False}
-    }
+    working_hours: dict = Field(default_factory=default_working_hours)
 
 class Admin(User):
     """نموذج المدير"""
@@ -115,6 +113,13 @@ class TokenResponse(BaseModel):
     expires_in: int
     user: User
 
+class RefreshResponse(BaseModel):
+    """استجابة تجديد الرمز المميز"""
+    access_token: str
+    refresh_token: str
+    token_type: str = "bearer"
+    expires_in: int
+
 class UserResponse(BaseModel):
     """استجابة بيانات المستخدم"""
     user: User
@@ -0,0 +1,60 @@
+"""
+Shared fixtures for tests that run the FastAPI app in-process against a local MongoDB.
+
+The database comes from MONGO_URL / MONGO_DB_NAME; the name must end in "_test"
+because the fixtures drop it. Tests that need it are skipped when MongoDB is not
+reachable.
+"""
+
+import os
+import sys
+import time
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+os.environ.setdefault("MONGO_DB_NAME", "debra_legal_budget_test")
+os.environ.setdefault("MONGO_SERVER_SELECTION_TIMEOUT_MS", "2000")
+# Budget tests issue bursts of requests from one client and must not hit the gateway
+os.environ["ADMISSION_CONTROL_ENABLED"] = "false"
+os.environ["MYFATOORAH_API_KEY"] = ""
+
+from tests.query_budget import QueryBudgetApp, install_counter  # noqa: E402
+
+# The listener must be registered before database.py creates the MongoClient
+install_counter()
+
+
+@pytest.fixture(scope="session")
+def mongo_client():
+    import database
+
+    if not database.DATABASE_NAME.endswith("_test"):
+        raise pytest.UsageError(f"MONGO_DB_NAME must end in '_test' (got {database.DATABASE_NAME!r})")
+    try:
+        database.ping(2000)
+    except Exception as e:
+        pytest.skip(f"MongoDB not reachable at {database.mongo_url}: {e}")
+
+    database.client.drop_database(database.DATABASE_NAME)
+    yield database.client
+    database.client.drop_database(database.DATABASE_NAME)
+
+
+@pytest.fixture(scope="session")
+def budget_app(mongo_client):
+    """(QueryBudgetApp, TestClient) with startup phases completed (indexes and seed data in place)"""
+    from fastapi.testclient import TestClient
+
+    import server
+
+    app = QueryBudgetApp(server.app, mongo_client)
+    with TestClient(app) as http:
+        deadline = time.monotonic() + 30
+        while not server.startup_manager.completed:
+            if time.monotonic() > deadline:
+                pytest.fail(f"startup did not complete: {server.startup_manager.report()}")
+            time.sleep(0.05)
+        yield app, http
@@ -0,0 +1,218 @@
+"""
+Query budgets - test support for counting MongoDB work per request.
+
+A pymongo CommandListener records every command issued while a request is being
+served, attributed through a ContextVar so background workers (outbox, health
+probes, notification flushes) running in the same process are not counted.
+Documents examined are measured by replaying each recorded command with
+``explain`` (executionStats) after the request finishes.
+
+Usage::
+
+    counter = install_counter()          # before the app creates its MongoClient
+    budget_app = QueryBudgetApp(app, client)
+    with TestClient(budget_app) as http:
+        with budget_app.measure("client dashboard") as record:
+            http.get("/api/client/dashboard", headers=...)
+        record.assert_within(queries=3, docs_examined=50, wall_ms=250)
+"""
+
+import copy
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional
+
+from pymongo import monitoring
+
+# Driver housekeeping that is not part of the request's own work
+IGNORED_COMMANDS = frozenset({
+    "hello", "ismaster", "isMaster", "ping", "buildInfo", "endSessions", "killCursors",
+    "saslStart", "saslContinue", "getnonce", "authenticate",
+})
+
+# Commands that explain can replay to report documents examined
+EXPLAINABLE_COMMANDS = frozenset({"find", "aggregate", "count", "distinct", "findAndModify", "update", "delete"})
+
+# Fields that belong to the wire protocol rather than to the query itself
+_PROTOCOL_FIELDS = ("lsid", "$clusterTime", "$db", "$readPreference", "txnNumber", "writeConcern",
+                    "readConcern", "autocommit", "startTransaction", "apiVersion", "comment")
+
+
+@dataclass
+class CommandSample:
+    """One command sent to the server while a request was measured"""
+    name: str
+    database: str
+    collection: Optional[str]
+    command: Optional[Dict[str, Any]] = None
+    duration_ms: float = 0.0
+    failed: bool = False
+
+
+@dataclass
+class QueryRecord:
+    """Everything a single measured block did against MongoDB"""
+    label: str
+    commands: List[CommandSample] = field(default_factory=list)
+    wall_ms: float = 0.0
+    docs_examined: Optional[int] = None
+
+    @property
+    def queries(self) -> int:
+        return len(self.commands)
+
+    @property
+    def db_ms(self) -> float:
+        return sum(sample.duration_ms for sample in self.commands)
+
+    def by_collection(self) -> Dict[str, int]:
+        counts: Dict[str, int] = {}
+        for sample in self.commands:
+            key = f"{sample.name}:{sample.collection or '-'}"
+            counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def summary(self) -> str:
+        examined = "?" if self.docs_examined is None else self.docs_examined
+        return (f"{self.label}: {self.queries} queries {self.by_collection()}, "
+                f"{examined} docs examined, {self.wall_ms:.1f} ms wall ({self.db_ms:.1f} ms in MongoDB)")
+
+    def assert_within(self, queries: Optional[int] = None, docs_examined: Optional[int] = None,
+                      wall_ms: Optional[float] = None) -> None:
+        """Fail with the full breakdown when any given budget is exceeded"""
+        problems = []
+        if queries is not None and self.queries > queries:
+            problems.append(f"{self.queries} queries > {queries}")
+        if docs_examined is not None and self.docs_examined is not None and self.docs_examined > docs_examined:
+            problems.append(f"{self.docs_examined} docs examined > {docs_examined}")
+        if wall_ms is not None and self.wall_ms > wall_ms:
+            problems.append(f"{self.wall_ms:.1f} ms > {wall_ms} ms")
+        if problems:
+            raise AssertionError(f"over budget ({'; '.join(problems)}) - {self.summary()}")
+
+
+_active: ContextVar[Optional[QueryRecord]] = ContextVar("query_budget_record", default=None)
+
+
+class QueryCounter(monitoring.CommandListener):
+    """Appends each started command to the record of the measured request that issued it"""
+
+    def __init__(self):
+        self._pending: Dict[tuple, CommandSample] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        record = _active.get()
+        if record is None or event.command_name in IGNORED_COMMANDS:
+            return
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        sample = CommandSample(
+            name=event.command_name,
+            database=event.database_name,
+            collection=target if isinstance(target, str) else None,
+            command=copy.deepcopy(dict(event.command)) if event.command_name in EXPLAINABLE_COMMANDS else None,
+        )
+        record.commands.append(sample)
+        self._pending[(event.connection_id, event.request_id)] = sample
+
+    def _finish(self, event, failed: bool) -> None:
+        sample = self._pending.pop((event.connection_id, event.request_id), None)
+        if sample is not None:
+            sample.duration_ms = event.duration_micros / 1000
+            sample.failed = failed
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, failed=True)
+
+
+_counter: Optional[QueryCounter] = None
+
+
+def install_counter() -> QueryCounter:
+    """Register the listener globally; must run before the MongoClient under test is created"""
+    global _counter
+    if _counter is None:
+        _counter = QueryCounter()
+        monitoring.register(_counter)
+    return _counter
+
+
+def _total_docs_examined(node: Any) -> int:
+    """Sum totalDocsExamined over every stage of an explain tree ($lookup stages report their own)"""
+    if isinstance(node, dict):
+        total = node.get("totalDocsExamined")
+        total = total if isinstance(total, int) else 0
+        return total + sum(_total_docs_examined(value) for key, value in node.items() if key != "totalDocsExamined")
+    if isinstance(node, list):
+        return sum(_total_docs_examined(value) for value in node)
+    return 0
+
+
+def _explainable(sample: CommandSample) -> Iterator[Dict[str, Any]]:
+    """The recorded command split into statements explain accepts (one per update/delete)"""
+    command = {key: value for key, value in sample.command.items() if key not in _PROTOCOL_FIELDS}
+    if sample.name == "update":
+        for statement in command.pop("updates", []):
+            yield {**command, "updates": [statement]}
+    elif sample.name == "delete":
+        for statement in command.pop("deletes", []):
+            yield {**command, "deletes": [statement]}
+    else:
+        yield command
+
+
+def examine(record: QueryRecord, client) -> int:
+    """Replay the record's commands with explain and store the documents they examined"""
+    total = 0
+    for sample in record.commands:
+        if sample.command is None or sample.failed:
+            continue
+        for command in _explainable(sample):
+            explained = client[sample.database].command("explain", command, verbosity="executionStats")
+            total += _total_docs_examined(explained)
+    record.docs_examined = total
+    return total
+
+
+class QueryBudgetApp:
+    """
+    ASGI wrapper around the application under test. HTTP requests made inside
+    measure() are attributed to its record; everything else passes through untouched.
+    """
+
+    def __init__(self, app, client=None):
+        self.app = app
+        self.client = client
+        self._record: Optional[QueryRecord] = None
+
+    async def __call__(self, scope, receive, send):
+        record = self._record
+        if scope["type"] != "http" or record is None:
+            await self.app(scope, receive, send)
+            return
+        token = _active.set(record)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _active.reset(token)
+
+    @contextmanager
+    def measure(self, label: str = "", explain: bool = True) -> Iterator[QueryRecord]:
+        if _counter is None:
+            raise RuntimeError("install_counter() must be called before measuring")
+        record = QueryRecord(label)
+        self._record = record
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.wall_ms = (time.perf_counter() - started) * 1000
+            self._record = None
+        if explain and self.client is not None:
+            examine(record, self.client)